@@ -0,0 +1,341 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # in requirements.txt; without it windows are summed in pure Python
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Hourly buckets are kept this many days back, daily ones this many
+ANALYTICS_HOURLY_DAYS = int(os.getenv("ANALYTICS_HOURLY_DAYS", "14"))
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "730"))
+# Every worker's rollups are summed in this SQLite file, which also keeps them across
+# restarts (empty keeps them in this process only)
+ANALYTICS_FILE = os.getenv("ANALYTICS_FILE", os.path.join(os.getenv("DATA_DIR", "."), "analytics.sqlite3"))
+# How often a worker flushes its counts to ANALYTICS_FILE and reads back the others'
+ANALYTICS_SAVE_INTERVAL_SECONDS = float(os.getenv("ANALYTICS_SAVE_INTERVAL_SECONDS", "10"))
+# Rollups were saved here, per process, before ANALYTICS_FILE; imported once if found
+LEGACY_ANALYTICS_FILE = os.path.join(os.getenv("DATA_DIR", "."), "analytics.json")
+
+METRICS = ("usage.conversation", "usage.analysis", "memberships_created", "revenue_cents")
+DIMENSIONS = ("all", "template", "customer_type", "company")
+GRANULARITIES = {"hour": 3600, "day": 86400}
+
+
+class RingSeries:
+    """Counts for the last `size` periods (hours or days) of one metric and group.
+
+    Two flat int64 arrays: a slot holds period % size, and `periods` says which period
+    it currently counts, so a slot left over from an older lap reads as zero. Being flat
+    buffers, many series stack into one NumPy matrix and are windowed together.
+    """
+
+    __slots__ = ("counts", "periods")
+
+    def __init__(self, size: int):
+        self.counts = array("q", bytes(8 * size))
+        self.periods = array("q", [-1]) * size
+
+    def add(self, period: int, amount: int):
+        slot = period % len(self.counts)
+        if self.periods[slot] != period:
+            self.periods[slot] = period
+            self.counts[slot] = 0
+        self.counts[slot] += amount
+
+    def set(self, period: int, count: int):
+        """Overwrite a period's count, unless its slot already moved on to a newer period"""
+        slot = period % len(self.counts)
+        if self.periods[slot] <= period:
+            self.periods[slot] = period
+            self.counts[slot] = count
+
+    def window(self, start: int, end: int) -> List[int]:
+        """Counts for periods start..end-1; periods older than the ring read as zero"""
+        size = len(self.counts)
+        window = [0] * (end - start)
+        for period in range(max(start, end - size), end):
+            slot = period % size
+            if self.periods[slot] == period:
+                window[period - start] = self.counts[slot]
+        return window
+
+    def items(self) -> List[Tuple[int, int]]:
+        return sorted((p, c) for p, c in zip(self.periods, self.counts) if p >= 0 and c)
+
+
+class Rollups:
+    """Hourly and daily counters per (metric, dimension, group), updated as events happen.
+
+    Every event adds to the "all" series and to one series per dimension it carries, so
+    a dashboard query reads a few precomputed series instead of scanning memberships.
+    When shared, the counts added since the last flush are also kept as pending, for
+    RollupStore to add to every worker's totals.
+    """
+
+    def __init__(self, hourly_size: int, daily_size: int, shared: bool = False):
+        self.sizes = {"hour": hourly_size, "day": daily_size}
+        self._series: Dict[str, Dict[Tuple[str, str, str], RingSeries]] = {"hour": {}, "day": {}}
+        self._lock = threading.Lock()
+        # (granularity, metric, dimension, value, period) -> count not flushed yet
+        self._pending: Optional[Dict[tuple, int]] = {} if shared else None
+
+    def add(self, metric: str, groups: Iterable[Tuple[str, str]], amount: int = 1, at: Optional[float] = None):
+        at = time.time() if at is None else at
+        keys = [(metric, "all", "")] + [(metric, dimension, value) for dimension, value in groups if value]
+        with self._lock:
+            for granularity, seconds in GRANULARITIES.items():
+                period = int(at // seconds)
+                for key in keys:
+                    self._add(granularity, key, period, amount)
+
+    def _add(self, granularity: str, key: Tuple[str, str, str], period: int, amount: int):
+        series = self._series[granularity].get(key)
+        if series is None:
+            series = self._series[granularity][key] = RingSeries(self.sizes[granularity])
+        series.add(period, amount)
+        if self._pending is not None:
+            pending_key = (granularity, *key, period)
+            self._pending[pending_key] = self._pending.get(pending_key, 0) + amount
+
+    def query(self, metric: str, dimension: str, granularity: str, start: int, end: int, limit: int) -> dict:
+        """Per-group counts for periods start..end-1, the `limit` largest groups first"""
+        with self._lock:
+            matching = [
+                (key[2], series) for key, series in self._series[granularity].items()
+                if key[0] == metric and key[1] == dimension
+            ]
+            if np is not None and matching:
+                # Copy every group's ring into one matrix, then read the window for all at once
+                periods = np.stack([np.frombuffer(series.periods, dtype=np.int64) for _, series in matching])
+                counts = np.stack([np.frombuffer(series.counts, dtype=np.int64) for _, series in matching])
+            elif matching:
+                windows = [series.window(start, end) for _, series in matching]
+        keys = [key for key, _ in matching]
+        if np is not None and matching:
+            wanted = np.arange(start, end, dtype=np.int64)
+            slots = wanted % self.sizes[granularity]
+            matrix = np.where(periods[:, slots] == wanted, counts[:, slots], 0)
+            totals = matrix.sum(axis=1)
+            total = int(totals.sum())
+            groups = [
+                {"key": keys[i] or None, "total": int(totals[i]), "counts": matrix[i].tolist()}
+                for i in np.argsort(-totals, kind="stable")[:limit]
+            ]
+        else:
+            groups = sorted(
+                ({"key": key or None, "total": sum(window), "counts": window} for key, window in zip(keys, windows)),
+                key=lambda group: -group["total"]
+            ) if matching else []
+            total = sum(group["total"] for group in groups)
+            groups = groups[:limit]
+        seconds = GRANULARITIES[granularity]
+        return {
+            "metric": metric,
+            "group_by": dimension,
+            "granularity": granularity,
+            "buckets": [
+                datetime.fromtimestamp(period * seconds, timezone.utc).isoformat() for period in range(start, end)
+            ],
+            "total": total,
+            "groups": groups,
+        }
+
+    def take_pending(self) -> Dict[tuple, int]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore_pending(self, pending: Dict[tuple, int]):
+        """Put back counts whose flush failed, so the next one retries them"""
+        with self._lock:
+            for pending_key, amount in pending.items():
+                self._pending[pending_key] = self._pending.get(pending_key, 0) + amount
+
+    def apply_totals(self, rows: Iterable[tuple]):
+        """Take every worker's totals, as (granularity, metric, dimension, value, period, count),
+        plus what this one has added since its last flush"""
+        with self._lock:
+            for granularity, metric, dimension, value, period, count in rows:
+                if granularity not in self._series:
+                    continue
+                key = (metric, dimension, value)
+                series = self._series[granularity].get(key)
+                if series is None:
+                    series = self._series[granularity][key] = RingSeries(self.sizes[granularity])
+                series.set(period, count + self._pending.get((granularity, *key, period), 0))
+
+    def load(self, data: dict):
+        """Add rollups saved in the old analytics.json layout"""
+        with self._lock:
+            for granularity, entries in data.items():
+                if granularity not in self._series:
+                    continue
+                for metric, dimension, value, items in entries:
+                    # Oldest first, so a newer period wins a slot it shares with an older one
+                    for period, count in items:
+                        self._add(granularity, (metric, dimension, value), period, count)
+
+
+class RollupStore:
+    """Every worker's rollups summed in one SQLite database.
+
+    A sync adds the counts this worker gathered since its last one, then reads back the
+    rows any worker changed since its last read. Each flush stamps its rows with the next
+    value of a shared sequence, so "changed since" is one indexed range scan.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS rollups (
+                granularity TEXT, metric TEXT, dimension TEXT, value TEXT, period INTEGER,
+                count INTEGER NOT NULL, seq INTEGER NOT NULL,
+                PRIMARY KEY (granularity, metric, dimension, value, period)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_rollups_seq ON rollups (seq);
+            CREATE INDEX IF NOT EXISTS idx_rollups_period ON rollups (granularity, period);
+            CREATE TABLE IF NOT EXISTS rollup_sequence (seq INTEGER NOT NULL);
+            """
+        )
+        self._lock = threading.Lock()
+        self._seen = 0
+
+    def sync(self, rollups: Rollups):
+        with self._lock:
+            pending = rollups.take_pending()
+            try:
+                if pending:
+                    self._flush(pending, rollups.sizes)
+            except BaseException:
+                rollups.restore_pending(pending)
+                raise
+            rows = self._conn.execute(
+                "SELECT granularity, metric, dimension, value, period, count, seq FROM rollups WHERE seq > ?",
+                (self._seen,)
+            ).fetchall()
+            rollups.apply_totals(row[:6] for row in rows)
+            self._seen = max((row[6] for row in rows), default=self._seen)
+
+    def _flush(self, pending: Dict[tuple, int], sizes: Dict[str, int]):
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT seq FROM rollup_sequence").fetchone()
+            seq = (row[0] if row else 0) + 1
+            if row is None:
+                conn.execute("INSERT INTO rollup_sequence (seq) VALUES (?)", (seq,))
+            else:
+                conn.execute("UPDATE rollup_sequence SET seq = ?", (seq,))
+            conn.executemany(
+                "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (granularity, metric, dimension, value, period) "
+                "DO UPDATE SET count = count + excluded.count, seq = excluded.seq",
+                [(*pending_key, amount, seq) for pending_key, amount in pending.items()]
+            )
+            # Drop periods every ring has lapped
+            now = time.time()
+            for granularity, seconds in GRANULARITIES.items():
+                conn.execute(
+                    "DELETE FROM rollups WHERE granularity = ? AND period <= ?",
+                    (granularity, int(now // seconds) - sizes[granularity])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+rollups = Rollups(ANALYTICS_HOURLY_DAYS * 24, ANALYTICS_RETENTION_DAYS, shared=bool(ANALYTICS_FILE))
+rollup_store: Optional[RollupStore] = None
+
+
+def _enum_value(value) -> Optional[str]:
+    return getattr(value, "value", value)
+
+
+def record_usage(feature_type: str, template_id: Optional[str], customer_type, company_id: Optional[str] = None):
+    """Count one use of a feature, by template, customer type and company"""
+    rollups.add(
+        f"usage.{feature_type}",
+        (("template", template_id), ("customer_type", _enum_value(customer_type)), ("company", company_id))
+    )
+
+
+def record_created(
+    template_id: Optional[str], customer_type, company_id: Optional[str] = None,
+    count: int = 1, revenue: float = 0.0
+):
+    """Count new memberships (and what was paid for them), by template, customer type and company"""
+    groups = (("template", template_id), ("customer_type", _enum_value(customer_type)), ("company", company_id))
+    rollups.add("memberships_created", groups, count)
+    if revenue:
+        rollups.add("revenue_cents", groups, round(revenue * 100))
+
+
+def periods(granularity: str, start: datetime, end: datetime) -> Tuple[int, int]:
+    """The period range covering start..end, end's period included"""
+    seconds = GRANULARITIES[granularity]
+    return int(start.timestamp() // seconds), int(end.timestamp() // seconds) + 1
+
+
+def load():
+    global rollups, rollup_store
+    if not ANALYTICS_FILE:
+        return
+    try:
+        rollup_store = RollupStore(ANALYTICS_FILE)
+    except sqlite3.Error as exc:
+        logger.warning("Could not open analytics rollups in %s, keeping them in memory: %r", ANALYTICS_FILE, exc)
+        rollups = Rollups(ANALYTICS_HOURLY_DAYS * 24, ANALYTICS_RETENTION_DAYS)
+        return
+    # Only the worker whose rename succeeds imports the old per-process file
+    imported = LEGACY_ANALYTICS_FILE + ".imported"
+    try:
+        os.rename(LEGACY_ANALYTICS_FILE, imported)
+        with open(imported) as f:
+            rollups.load(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as exc:
+        logger.warning("Could not import analytics rollups from %s: %r", LEGACY_ANALYTICS_FILE, exc)
+    refresh()
+
+
+def save():
+    """Add this worker's new counts to ANALYTICS_FILE and read back every worker's totals.
+
+    Counts stay pending until their flush commits, so a failed one is retried next time.
+    """
+    if rollup_store is not None:
+        rollup_store.sync(rollups)
+
+
+def refresh():
+    """save() before a query; on failure the query answers from this worker's copy"""
+    try:
+        save()
+    except Exception:
+        logger.exception("Saving analytics rollups failed")
+
+
+async def run_analytics_saver():
+    """Sync the rollups every ANALYTICS_SAVE_INTERVAL_SECONDS for the app's lifetime"""
+    while True:
+        await asyncio.sleep(ANALYTICS_SAVE_INTERVAL_SECONDS)
+        await asyncio.to_thread(refresh)
+
+
+load()
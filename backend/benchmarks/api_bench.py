@@ -0,0 +1,276 @@
+"""In-process latency/throughput benchmark for the membership and usage API.
+
+Run from the backend directory:
+
+    python -m benchmarks.api_bench --sizes 1000 100000 --output bench.json
+
+Each dataset size runs in a fresh subprocess with its own temporary DATA_DIR, so
+STORAGE_BACKEND / PERSISTENCE_MODE from the environment apply and sizes don't share
+state. Results are written as JSON for comparing scaling curves across commits.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _summary(operation, size, latencies, errors, wall_seconds=None, concurrency=1):
+    result = {
+        "operation": operation,
+        "size": size,
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+    }
+    if wall_seconds is not None:
+        result["throughput_rps"] = round(len(latencies) / wall_seconds, 1)
+    return result
+
+
+def seed(size):
+    """Replace the store's contents with `size` memberships over size // 2 users.
+
+    Every user has one expired membership followed by one active membership with
+    effectively unlimited counters, so usage calls never run out mid-benchmark.
+    """
+    import db
+    from models import CustomerType, FeatureLimit, FeatureUsage, Membership, MembershipStatus, User
+    from storage import SQLiteStore
+
+    now = datetime.now(timezone.utc)
+    templates = list(db.MEMBERSHIP_TEMPLATES.values()) or [db.store.get_template("basic-b2c")]
+    users, memberships = [], []
+    for i in range(max(size // 2, 1)):
+        b2b = i % 4 == 0
+        user = User(
+            id=f"bench-user-{i}",
+            name=f"Bench User {i}",
+            email=f"user{i}@bench.test",
+            customer_type=CustomerType.B2B if b2b else CustomerType.B2C,
+            company_id=f"bench-company-{i // 200}" if b2b else None
+        )
+        users.append(user)
+        for n, status in enumerate((MembershipStatus.EXPIRED, MembershipStatus.ACTIVE)):
+            template = templates[(i + n) % len(templates)]
+            memberships.append(Membership(
+                id=f"bench-membership-{i}-{n}",
+                user_id=user.id,
+                name=template.name,
+                template_id=template.id,
+                customer_type=user.customer_type,
+                status=status,
+                created_at=now - timedelta(days=400),
+                expires_at=now - timedelta(days=1) if status == MembershipStatus.EXPIRED else now + timedelta(days=365),
+                limits=FeatureLimit(conversation=10**9, analysis=10**9),
+                usage=FeatureUsage()
+            ))
+
+    if isinstance(db.store, SQLiteStore):
+        db.store.import_data(users, [], memberships)
+    else:
+        for user in users:
+            db.add_user(user)
+        for membership in memberships:
+            db.add_membership(membership)
+    return users, memberships
+
+
+async def _measure(client, operation, size, make_request, count, concurrency):
+    """Sequential pass for latency percentiles, then a concurrent pass for throughput.
+
+    Error responses are counted rather than fatal, so gateway failure rates can be simulated.
+    """
+    results = []
+    latencies = []
+    errors = 0
+    for _ in range(count):
+        started = time.perf_counter()
+        response = await make_request(client)
+        latencies.append(time.perf_counter() - started)
+        errors += response.is_error
+    results.append(_summary(operation, size, latencies, errors))
+
+    if concurrency > 1:
+        latencies = []
+        statuses = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await make_request(client)
+                latencies.append(time.perf_counter() - started)
+                statuses.append(response.is_error)
+
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(count)))
+        results.append(_summary(
+            operation, size, latencies, sum(statuses), time.perf_counter() - wall_started, concurrency
+        ))
+    return results
+
+
+async def run_size(size, count, concurrency, full_list_max):
+    import httpx
+    import db
+    import main
+    from storage import SQLiteStore
+
+    results = []
+    started = time.perf_counter()
+    users, memberships = seed(size)
+    results.append({"operation": "seed", "size": size, "seconds": round(time.perf_counter() - started, 3)})
+
+    if not isinstance(db.store, SQLiteStore):
+        # The persistence and startup work the JSON backend does, timed directly
+        started = time.perf_counter()
+        db._save_data()
+        results.append({"operation": "_save_data", "size": size, "seconds": round(time.perf_counter() - started, 4)})
+        started = time.perf_counter()
+        db._read_data_file()
+        db._rebuild_indexes()
+        results.append({"operation": "_load_data", "size": size, "seconds": round(time.perf_counter() - started, 4)})
+
+    rng = random.Random(size)
+    active_ids = [m.id for m in memberships if m.id.endswith("-1")]
+    b2c_ids = [u.id for u in users if u.customer_type.value == "B2C"]
+
+    def usage_body():
+        return {"user_id": rng.choice(users).id, "feature_type": "conversation"}
+
+    operations = {
+        "usage/check": lambda c: c.post("/api/v1/usage/check", json=usage_body()),
+        "usage/start-conversation": lambda c: c.post("/api/v1/usage/start-conversation", json=usage_body()),
+        "deduct-coupon": lambda c: c.post(f"/api/v1/memberships/{rng.choice(active_ids)}/deduct-coupon"),
+        # Charged against the in-process stand-in gateway unless PAYMENT_GATEWAY_URL is set
+        "payments/process": lambda c: c.post("/api/v1/payments/process", json={
+            "user_id": rng.choice(b2c_ids), "template_id": "basic-b2c", "payment_method": "card", "amount": 9.99
+        }),
+        "GET /memberships?limit=100": lambda c: c.get("/api/v1/memberships", params={"limit": 100}),
+        "GET /admin/memberships?limit=100&status=active": lambda c: c.get(
+            "/api/v1/admin/memberships", params={"limit": 100, "status": "active"}
+        ),
+        "GET /users?limit=100": lambda c: c.get("/api/v1/users", params={"limit": 100}),
+    }
+    if size <= full_list_max:
+        operations["GET /memberships (full list)"] = lambda c: c.get("/api/v1/memberships")
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for operation, make_request in operations.items():
+            results.extend(await _measure(client, operation, size, make_request, count, concurrency))
+    return results
+
+
+def _worker(args):
+    logging.getLogger().setLevel(logging.INFO if args.log else logging.WARNING)
+    results = asyncio.run(run_size(args.size, args.requests, args.concurrency, args.full_list_max))
+    # db.py reports on stdout, so results travel through a file
+    with open(args.worker_output, "w") as f:
+        json.dump(results, f)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="membership counts to benchmark (default: 1k 100k 1M)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per operation and pass")
+    parser.add_argument("--concurrency", type=int, default=16, help="in-flight requests for the throughput pass")
+    parser.add_argument("--full-list-max", type=int, default=10000,
+                        help="only benchmark the unpaginated list up to this size")
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--log", action="store_true", help="keep INFO request logging on")
+    parser.add_argument("--gateway-latency-ms", type=float,
+                        help="simulated payment gateway latency (sets MOCK_GATEWAY_LATENCY_MS)")
+    parser.add_argument("--gateway-failure-rate", type=float,
+                        help="share of simulated gateway calls that fail (sets MOCK_GATEWAY_FAILURE_RATE)")
+    parser.add_argument("--rate-limits",
+                        help="RATE_LIMITS policies to run under (default: none, so nothing is throttled)")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        _worker(args)
+        return
+
+    if args.gateway_latency_ms is not None:
+        os.environ["MOCK_GATEWAY_LATENCY_MS"] = str(args.gateway_latency_ms)
+    if args.gateway_failure_rate is not None:
+        os.environ["MOCK_GATEWAY_FAILURE_RATE"] = str(args.gateway_failure_rate)
+    # Every benchmark request comes from one client, which the default policies would throttle
+    os.environ["RATE_LIMITS"] = args.rate_limits or ""
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "storage_backend": os.getenv("STORAGE_BACKEND", "json"),
+            "persistence_mode": os.getenv("PERSISTENCE_MODE", "snapshot"),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "gateway_latency_ms": float(os.getenv("MOCK_GATEWAY_LATENCY_MS", "0")),
+            "gateway_failure_rate": float(os.getenv("MOCK_GATEWAY_FAILURE_RATE", "0")),
+            "rate_limits": os.environ["RATE_LIMITS"],
+            "rate_limit_store": os.getenv("RATE_LIMIT_STORE", "memory"),
+        },
+        "results": [],
+    }
+    for size in args.sizes:
+        print(f"Benchmarking {size} memberships...", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as data_dir:
+            env = dict(os.environ, DATA_DIR=data_dir, PYTHONPATH=BACKEND_DIR)
+            worker_output = os.path.join(data_dir, "results.json")
+            command = [
+                sys.executable, "-m", "benchmarks.api_bench", "--worker", "--size", str(size),
+                "--worker-output", worker_output,
+                "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+                "--full-list-max", str(args.full_list_max),
+            ] + (["--log"] if args.log else [])
+            completed = subprocess.run(command, cwd=data_dir, env=env, capture_output=True, text=True)
+            if completed.returncode != 0:
+                sys.stderr.write(completed.stderr)
+                raise SystemExit(f"Benchmark worker for size {size} failed")
+            with open(worker_output) as f:
+                report["results"].extend(json.load(f))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Memory and scan cost of the json backend's membership layouts.
+
+Run from the backend directory:
+
+    python -m benchmarks.membership_layout --sizes 100000 1000000 --output layout.json
+
+`model` holds every membership as a pydantic Membership (the layout before records.py),
+`record` as a MembershipRecord. Each layout and size is built in a fresh subprocess so
+the RSS growth it reports belongs to that layout alone. The scan is one pass over all
+rows checking has-remaining-conversation-usage, the json backend's hot path.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYOUTS = ("model", "record")
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _build(layout, size):
+    from models import CustomerType, FeatureLimit, FeatureUsage, Membership, MembershipStatus
+    from records import MembershipRecord
+
+    now = datetime.now(timezone.utc)
+    rows = {}
+    for i in range(size):
+        user_id = f"bench-user-{i // 2}"
+        membership = Membership(
+            id=f"bench-membership-{i}",
+            user_id=user_id,
+            name="Premium Plan (B2C)" if i % 3 else "Basic Plan (B2C)",
+            template_id="premium-b2c" if i % 3 else "basic-b2c",
+            customer_type=CustomerType.B2C,
+            status=MembershipStatus.ACTIVE if i % 2 else MembershipStatus.EXPIRED,
+            created_at=now - timedelta(days=30),
+            expires_at=now + timedelta(days=i % 365),
+            limits=FeatureLimit(conversation=None if i % 3 else 10, analysis=5),
+            usage=FeatureUsage(conversation=i % 7)
+        )
+        rows[membership.id] = membership if layout == "model" else MembershipRecord.from_model(membership)
+    return rows
+
+
+def _scan(layout, rows):
+    from storage import has_remaining_usage
+
+    if layout == "model":
+        now = datetime.now(timezone.utc)
+        return sum(1 for membership in rows.values() if has_remaining_usage(membership, "conversation", now))
+    now_ts = time.time()
+    return sum(1 for record in rows.values() if record.has_remaining("conversation", now_ts))
+
+
+def _worker(layout, size):
+    gc.collect()
+    baseline = _rss_bytes()
+    started = time.perf_counter()
+    rows = _build(layout, size)
+    build_seconds = time.perf_counter() - started
+    gc.collect()
+    rss = _rss_bytes() - baseline
+
+    scans = []
+    for _ in range(3):
+        started = time.perf_counter()
+        matched = _scan(layout, rows)
+        scans.append(time.perf_counter() - started)
+    return {
+        "layout": layout,
+        "size": size,
+        "rss_mb": round(rss / 2**20, 1),
+        "bytes_per_row": round(rss / size),
+        "build_seconds": round(build_seconds, 3),
+        "scan_ms": round(min(scans) * 1000, 2),
+        "matched": matched,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=list(LAYOUTS))
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        layout, size = args.worker
+        print(json.dumps(_worker(layout, int(size))))
+        return
+
+    report = {"meta": {"timestamp": datetime.now(timezone.utc).isoformat(), "python": platform.python_version()},
+              "results": []}
+    for size in args.sizes:
+        for layout in args.layouts:
+            print(f"Measuring {size} memberships as {layout}s...", file=sys.stderr)
+            completed = subprocess.run(
+                [sys.executable, "-m", "benchmarks.membership_layout", "--worker", layout, str(size)],
+                cwd=BACKEND_DIR, capture_output=True, text=True
+            )
+            if completed.returncode != 0:
+                sys.stderr.write(completed.stderr)
+                raise SystemExit(f"Layout worker for {layout} x {size} failed")
+            report["results"].append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
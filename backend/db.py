@@ -1,57 +1,605 @@
+import atexit
+import bisect
+import gc
+import heapq
 import json
 import os
-from typing import Dict
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from uuid import uuid4
-from models import Membership, MembershipTemplate, User, CustomerType, FeatureLimit, MembershipStatus
-from datetime import datetime, timedelta
+from pydantic_core import from_json
+from models import (
+    Membership, MembershipTemplate, User, CustomerType, FeatureLimit, MembershipStatus, IdempotencyRecord,
+    CompanyQuota, QuotaAllocation
+)
+from datetime import datetime, timedelta, timezone
+from journal import Journal, replay
+from metrics import timed
+from records import MembershipRecord
+from storage import (
+    FEATURES, Store, SQLiteStore, UsageResult, apply_usage_batch, idempotency_key_taken, quota_has_room
+)
+
+try:
+    import orjson
+except ImportError:  # optional: pydantic_core's parser (installed with pydantic) is used without it
+    orjson = None
 
 # Use mounted volume for persistent storage, fallback to local file
 # In Docker container: /app/data, in local development: current directory
 DATA_DIR = os.getenv("DATA_DIR", ".")
 DATA_FILE = os.path.join(DATA_DIR, "data.json")
 
-MEMBERSHIPS: Dict[str, Membership] = {}
+# "json" keeps everything in the dicts below (persisted to data.json), "sqlite" keeps
+# it in data.sqlite3 and imports data.json on first start
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.path.join(DATA_DIR, "data.sqlite3")
+
+# "snapshot" rewrites data.json on every change, "journal" appends each change to
+# data.journal and folds it back into data.json in the background, "debounced" marks
+# the data dirty and lets a background flusher coalesce many changes into one write
+PERSISTENCE_MODE = os.getenv("PERSISTENCE_MODE", "snapshot")
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "50"))
+FLUSH_MAX_PENDING = int(os.getenv("FLUSH_MAX_PENDING", "100"))
+JOURNAL_FILE = os.path.join(DATA_DIR, "data.journal")
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "interval")  # always, interval or off
+JOURNAL_FSYNC_INTERVAL_MS = int(os.getenv("JOURNAL_FSYNC_INTERVAL_MS", "50"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+
+# "eager" loads data.json before the app starts serving; "background" loads it on a
+# thread while the app is already up, so health checks pass at once: requests wait
+# (up to LOAD_WAIT_SECONDS, then 503) until it is done, and /health reports progress
+LOAD_MODE = os.getenv("LOAD_MODE", "eager")
+LOAD_WAIT_SECONDS = float(os.getenv("LOAD_WAIT_SECONDS", "30"))
+
+# Memberships are held as compact records (see records.py) and only become pydantic
+# models on their way out of the store
+MEMBERSHIPS: Dict[str, MembershipRecord] = {}
 MEMBERSHIP_TEMPLATES: Dict[str, MembershipTemplate] = {}
 USERS: Dict[str, User] = {}
+# Responses to requests sent with an Idempotency-Key, oldest first (see idempotency.py).
+# Pending records (status_code None) live only in memory and are never persisted.
+IDEMPOTENCY_RECORDS: Dict[str, IdempotencyRecord] = {}
+# Pooled B2B usage by company_id, and users' allocations within it by allocation_key
+COMPANY_QUOTAS: Dict[str, CompanyQuota] = {}
+QUOTA_ALLOCATIONS: Dict[str, QuotaAllocation] = {}
+
+# Secondary indexes (dicts used as insertion-ordered sets), rebuilt on load and
+# kept current by the add_/remove_ helpers below
+USER_MEMBERSHIPS: Dict[str, Dict[str, None]] = {}  # user_id -> membership ids
+COMPANY_USERS: Dict[str, Dict[str, None]] = {}     # company_id -> user ids
+
+class _ScanOrder:
+    """Keyset positions for paging through a dict.
+
+    Each key gets a sequence number when it is first inserted, and a page resumes after
+    the last number it handed out, so inserts and deletes elsewhere never shift a page.
+    Deleted keys stay behind as dead entries until they outnumber the live ones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sequences: List[int] = []
+        self._keys: List[str] = []
+        self._sequence_of: Dict[str, int] = {}
+        self._next = 1
+
+    def rebuild(self, keys):
+        with self._lock:
+            self._keys = list(keys)
+            self._sequences = list(range(1, len(self._keys) + 1))
+            self._sequence_of = dict(zip(self._keys, self._sequences))
+            self._next = len(self._keys) + 1
+
+    def add(self, key: str):
+        with self._lock:
+            if key in self._sequence_of:
+                return
+            self._sequence_of[key] = self._next
+            self._sequences.append(self._next)
+            self._keys.append(key)
+            self._next += 1
+
+    def remove(self, key: str):
+        with self._lock:
+            if self._sequence_of.pop(key, None) is None:
+                return
+            if len(self._keys) > 2 * len(self._sequence_of) + 1024:
+                live = [(seq, key) for seq, key in zip(self._sequences, self._keys) if self._sequence_of.get(key) == seq]
+                self._sequences = [seq for seq, _ in live]
+                self._keys = [key for _, key in live]
+
+    def after(self, position: int, count: int) -> Tuple[List[Tuple[int, str]], bool]:
+        """Up to `count` live (sequence, key) pairs past `position`, and whether more follow"""
+        with self._lock:
+            found = []
+            index = bisect.bisect_right(self._sequences, position)
+            while index < len(self._keys):
+                seq, key = self._sequences[index], self._keys[index]
+                if self._sequence_of.get(key) == seq:
+                    if len(found) == count:
+                        return found, True
+                    found.append((seq, key))
+                index += 1
+            return found, False
+
+_USER_ORDER = _ScanOrder()
+_MEMBERSHIP_ORDER = _ScanOrder()
+
+# Min-heap of (expires_at timestamp, membership id) over ACTIVE memberships, drained by
+# expire_due. _EXPIRY_SCHEDULED holds each id's live entry; entries of memberships
+# deleted or re-dated since they were pushed are skipped when popped.
+_EXPIRY_HEAP: List[tuple] = []
+_EXPIRY_SCHEDULED: Dict[str, float] = {}
+_expiry_lock = threading.Lock()
+
+def _model_dump(item) -> dict:
+    return item.model_dump(mode="json")
+
+# collection -> (dict, load a JSON entry, dump an entry to JSON)
+_COLLECTIONS = {
+    "users": (USERS, lambda value: User(**value), _model_dump),
+    "membership_templates": (MEMBERSHIP_TEMPLATES, lambda value: MembershipTemplate(**value), _model_dump),
+    "memberships": (MEMBERSHIPS, MembershipRecord.from_dict, MembershipRecord.to_dict),
+    "idempotency_keys": (IDEMPOTENCY_RECORDS, lambda value: IdempotencyRecord(**value), _model_dump),
+    "company_quotas": (COMPANY_QUOTAS, lambda value: CompanyQuota(**value), _model_dump),
+    "quota_allocations": (QUOTA_ALLOCATIONS, lambda value: QuotaAllocation(**value), _model_dump),
+}
+
+# Serializes usage check-and-increment within this process (the JSON backend's
+# single authority; the SQLite backend uses database locks instead)
+_usage_lock = threading.Lock()
+_idempotency_lock = threading.Lock()
+_quota_lock = threading.Lock()
+
+_journal: Optional[Journal] = None
+_compact_requested = threading.Event()
+_snapshot_lock = threading.Lock()
+
+# Debounced mode: changes counted so far vs. changes covered by a finished flush
+_flush_cond = threading.Condition()
+_changes_recorded = 0
+_changes_flushed = 0
+_flusher: Optional[threading.Thread] = None
+
+# Startup loading, as reported on /health
+_loaded = threading.Event()
+_load_progress: Dict[str, Any] = {
+    "state": "pending", "phase": None, "collection": None, "entries": 0, "percent": 0.0, "error": None
+}
+_loader: Optional[threading.Thread] = None
+_loader_lock = threading.Lock()
+_load_started: Optional[float] = None
+_load_seconds: Optional[float] = None
+LOAD_PROGRESS_EVERY = 10000
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+def _decode(raw: bytes) -> dict:
+    """Parse a whole data.json with the fastest parser at hand"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    try:
+        return from_json(raw)
+    except ValueError as exc:
+        # Callers treat a corrupt file the way they always have, as a JSONDecodeError
+        raise json.JSONDecodeError(str(exc), "", 0) from None
+
+def _iter_entries(text: str) -> Iterator[Tuple[str, str, Any, int]]:
+    """(collection, key, value, position) for each entry of data.json's collections.
+
+    Parses one entry at a time with the json module's scanner. A whole-file parse holds
+    the GIL for seconds on a large file; this lets the event loop run in between.
+    """
+    def skip(position: int, char: str) -> int:
+        position = _WHITESPACE.match(text, position).end()
+        if not text.startswith(char, position):
+            raise json.JSONDecodeError(f"Expecting {char!r}", text, position)
+        return _WHITESPACE.match(text, position + 1).end()
+
+    def next_member(position: int) -> int:
+        # Past the comma after a member, or onto the brace closing the object
+        position = _WHITESPACE.match(text, position).end()
+        if text.startswith(",", position):
+            return _WHITESPACE.match(text, position + 1).end()
+        if not text.startswith("}", position):
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, position)
+        return position
+
+    position = skip(0, "{")
+    while not text.startswith("}", position):
+        collection, position = _decoder.raw_decode(text, position)
+        position = skip(position, ":")
+        if text.startswith("{", position):
+            position = skip(position, "{")
+            while not text.startswith("}", position):
+                key, position = _decoder.raw_decode(text, position)
+                value, position = _decoder.raw_decode(text, skip(position, ":"))
+                yield collection, key, value, position
+                position = next_member(position)
+            position += 1
+        else:
+            _, position = _decoder.raw_decode(text, position)
+        position = next_member(position)
+
+def _clear_collections():
+    for items, _, _ in _COLLECTIONS.values():
+        items.clear()
+
+@timed("load_data")
+def _read_data_file(incremental: bool = False):
+    # Only create directory if we're in a Docker container (DATA_DIR is /app/data)
+    if DATA_DIR.startswith("/app"):
+        os.makedirs(DATA_DIR, exist_ok=True)
+
+    with open(DATA_FILE, "rb") as f:
+        raw = f.read()
+    _load_progress["phase"] = "reading"
+    if not incremental:
+        data = _decode(raw)
+        del raw
+        # Fill the dicts in place so modules that imported them keep valid references
+        _clear_collections()
+        for collection, (items, load, _) in _COLLECTIONS.items():
+            _load_progress["collection"] = collection
+            items.update({k: load(v) for k, v in data.get(collection, {}).items()})
+        return
+
+    text = raw.decode()
+    del raw
+    _clear_collections()
+    for count, (collection, key, value, position) in enumerate(_iter_entries(text), 1):
+        target = _COLLECTIONS.get(collection)
+        if target is not None:
+            target[0][key] = target[1](value)
+        if count % LOAD_PROGRESS_EVERY == 0:
+            _load_progress.update(
+                collection=collection, entries=count, percent=round(100 * position / len(text), 1)
+            )
 
 def _load_data():
-    global MEMBERSHIPS, MEMBERSHIP_TEMPLATES, USERS
+    global _load_started, _load_seconds
+    _load_started = time.perf_counter()
+    _load_progress["state"] = "loading"
+    # A blocking load allocates millions of containers and none of them form cycles, so
+    # the cyclic collector would only rescan them over and over; it resumes afterwards.
+    # A background load leaves it alone, since requests are being served meanwhile.
+    blocking = LOAD_MODE != "background"
+    if blocking:
+        gc.disable()
     try:
-        # Only create directory if we're in a Docker container (DATA_DIR is /app/data)
-        if DATA_DIR.startswith("/app"):
-            os.makedirs(DATA_DIR, exist_ok=True)
-        
-        with open(DATA_FILE, "r") as f:
-            data = json.load(f)
-            USERS = {k: User(**v) for k, v in data.get("users", {}).items()}
-            MEMBERSHIP_TEMPLATES = {k: MembershipTemplate(**v) for k, v in data.get("membership_templates", {}).items()}
-            MEMBERSHIPS = {k: Membership(**v) for k, v in data.get("memberships", {}).items()}
-            # Convert datetime strings back to datetime objects
-            for mid, membership in MEMBERSHIPS.items():
-                membership.created_at = datetime.fromisoformat(str(membership.created_at))
-                membership.expires_at = datetime.fromisoformat(str(membership.expires_at))
-    except (FileNotFoundError, json.JSONDecodeError):
+        _read_data_file(incremental=not blocking)
+    except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
         print(f"Data file {DATA_FILE} not found or invalid, initializing with seed data.")
+        _clear_collections()
         init_seed_data_defaults()
+        _save_data() # Save initial seed data to file
+    finally:
+        if blocking:
+            gc.enable()
+
+    _load_progress.update(phase="journal", collection=None, percent=100.0)
+    if PERSISTENCE_MODE == "journal":
+        _open_journal()
+    elif PERSISTENCE_MODE == "debounced":
+        _start_flusher()
+    _load_progress["phase"] = "indexing"
+    _rebuild_indexes()
+    if blocking:
+        # Keep the loaded data out of every later full collection
+        gc.freeze()
+    _load_seconds = time.perf_counter() - _load_started
+    _load_progress.update(state="ready", phase=None)
+    _loaded.set()
+
+def _load_in_background():
+    global _load_seconds
+    try:
+        _load_data()
+    except Exception as exc:
+        print(f"Loading {DATA_FILE} failed: {exc!r}")
+        _load_seconds = time.perf_counter() - _load_started
+        _load_progress.update(state="failed", error=repr(exc))
+
+def start_loading():
+    """Start the LOAD_MODE=background load, once; a no-op when the data is already loaded"""
+    global _loader
+    with _loader_lock:
+        if _loader is None and not _loaded.is_set():
+            _loader = threading.Thread(target=_load_in_background, name="data-loader", daemon=True)
+            _loader.start()
+
+def is_loaded() -> bool:
+    return _loaded.is_set()
+
+def load_progress() -> Dict[str, Any]:
+    """Where startup loading is, for /health"""
+    progress = dict(_load_progress)
+    if _load_seconds is not None:
+        progress["seconds"] = round(_load_seconds, 3)
+    elif _load_started is not None:
+        progress["seconds"] = round(time.perf_counter() - _load_started, 3)
+    return progress
+
+def _rebuild_indexes():
+    USER_MEMBERSHIPS.clear()
+    COMPANY_USERS.clear()
+    with _expiry_lock:
+        _EXPIRY_HEAP.clear()
+        _EXPIRY_SCHEDULED.clear()
+    for membership in MEMBERSHIPS.values():
+        USER_MEMBERSHIPS.setdefault(membership.user_id, {})[membership.id] = None
+        _schedule_expiry(membership)
+    for user in USERS.values():
+        if user.company_id:
+            COMPANY_USERS.setdefault(user.company_id, {})[user.id] = None
+    _MEMBERSHIP_ORDER.rebuild(MEMBERSHIPS)
+    _USER_ORDER.rebuild(USERS)
+
+def add_membership(membership: Membership):
+    """Insert or replace a membership, keeping the user index current"""
+    record = MembershipRecord.from_model(membership)
+    previous = MEMBERSHIPS.get(record.id)
+    if previous is not None and previous.user_id != record.user_id:
+        USER_MEMBERSHIPS.get(previous.user_id, {}).pop(record.id, None)
+    MEMBERSHIPS[record.id] = record
+    _MEMBERSHIP_ORDER.add(record.id)
+    USER_MEMBERSHIPS.setdefault(record.user_id, {})[record.id] = None
+    _schedule_expiry(record)
+
+def remove_membership(membership_id: str) -> Optional[MembershipRecord]:
+    membership = MEMBERSHIPS.pop(membership_id, None)
+    if membership is not None:
+        _MEMBERSHIP_ORDER.remove(membership_id)
+        USER_MEMBERSHIPS.get(membership.user_id, {}).pop(membership_id, None)
+        with _expiry_lock:
+            _EXPIRY_SCHEDULED.pop(membership_id, None)
+    return membership
 
+def _schedule_expiry(membership: MembershipRecord):
+    if membership.status != MembershipStatus.ACTIVE:
+        return
+    deadline = membership.expires_ts
+    with _expiry_lock:
+        if _EXPIRY_SCHEDULED.get(membership.id) != deadline:
+            _EXPIRY_SCHEDULED[membership.id] = deadline
+            heapq.heappush(_EXPIRY_HEAP, (deadline, membership.id))
+
+def expire_due(now: datetime) -> List[str]:
+    """Pop every heap entry whose deadline has passed and expire those memberships"""
+    expired = []
+    now_ts = now.timestamp()
+    with _expiry_lock:
+        while _EXPIRY_HEAP and _EXPIRY_HEAP[0][0] <= now_ts:
+            deadline, membership_id = heapq.heappop(_EXPIRY_HEAP)
+            if _EXPIRY_SCHEDULED.get(membership_id) != deadline:
+                continue
+            del _EXPIRY_SCHEDULED[membership_id]
+            membership = MEMBERSHIPS.get(membership_id)
+            if membership is not None and membership.status == MembershipStatus.ACTIVE:
+                membership.status = MembershipStatus.EXPIRED
+                expired.append(membership_id)
+    record_changes("memberships", expired)
+    return expired
+
+def next_expiry() -> Optional[datetime]:
+    with _expiry_lock:
+        if not _EXPIRY_HEAP:
+            return None
+        return datetime.fromtimestamp(_EXPIRY_HEAP[0][0], timezone.utc)
+
+def records_for_user(user_id: str) -> List[MembershipRecord]:
+    """All membership records of one user, in creation order, without scanning MEMBERSHIPS"""
+    return [MEMBERSHIPS[mid] for mid in USER_MEMBERSHIPS.get(user_id, ())]
+
+def memberships_for_user(user_id: str) -> List[Membership]:
+    return [record.to_model() for record in records_for_user(user_id)]
+
+def add_user(user: User):
+    """Insert or replace a user, keeping the company index current"""
+    previous = USERS.get(user.id)
+    if previous is not None and previous.company_id and previous.company_id != user.company_id:
+        COMPANY_USERS.get(previous.company_id, {}).pop(user.id, None)
+    USERS[user.id] = user
+    _USER_ORDER.add(user.id)
+    if user.company_id:
+        COMPANY_USERS.setdefault(user.company_id, {})[user.id] = None
+
+def remove_user(user_id: str) -> Optional[User]:
+    user = USERS.pop(user_id, None)
+    if user is not None:
+        _USER_ORDER.remove(user_id)
+    if user is not None and user.company_id:
+        COMPANY_USERS.get(user.company_id, {}).pop(user_id, None)
+    return user
+
+def users_for_company(company_id: str) -> List[User]:
+    """All users of one B2B company"""
+    return [USERS[uid] for uid in COMPANY_USERS.get(company_id, ())]
+
+def allocation_key(company_id: str, user_id: str) -> str:
+    return f"{company_id}/{user_id}"
+
+def _snapshot_dict() -> dict:
+    # Copy the dicts first: request threads may insert or delete while we serialize.
+    # Entries are dumped the way the journal dumps them, so both read back the same.
+    return {
+        collection: {
+            k: dump(v) for k, v in dict(items).items()
+            # Pending idempotency claims live only in memory
+            if items is not IDEMPOTENCY_RECORDS or v.status_code is not None
+        }
+        for collection, (items, _, dump) in _COLLECTIONS.items()
+    }
+
+@timed("save_data")
 def _save_data():
     # Only create directory if we're in a Docker container (DATA_DIR is /app/data)
     if DATA_DIR.startswith("/app"):
         os.makedirs(DATA_DIR, exist_ok=True)
     
-    data = {
-        "users": {k: v.dict() for k, v in USERS.items()},
-        "membership_templates": {k: v.dict() for k, v in MEMBERSHIP_TEMPLATES.items()},
-        "memberships": {k: v.dict() for k, v in MEMBERSHIPS.items()}
-    }
-    # Convert datetime objects to ISO format strings for JSON serialization
-    for mid, membership_data in data["memberships"].items():
-        membership_data["created_at"] = membership_data["created_at"].isoformat()
-        membership_data["expires_at"] = membership_data["expires_at"].isoformat()
+    data = _snapshot_dict()
 
     with open(DATA_FILE, "w") as f:
         json.dump(data, f, indent=4)
 
+@timed("write_snapshot")
+def _write_snapshot(data: dict):
+    """Atomically replace data.json: write a temp file, fsync it, then rename over"""
+    tmp_file = DATA_FILE + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, DATA_FILE)
+
+def record_changes(collection: str, keys: List[str]):
+    """Persist a batch of changed entries with a single snapshot write"""
+    if not keys:
+        return
+    if _flusher is not None:
+        _mark_dirty(len(keys))
+    elif _journal is None:
+        _save_data()
+    else:
+        for key in keys:
+            record_change(collection, key)
+
+def record_change(collection: str, key: str):
+    """Persist one created, updated or deleted entry of a collection.
+
+    In journal mode this appends a single record instead of rewriting data.json; in
+    debounced mode it only marks the data dirty for the background flusher.
+    """
+    if _flusher is not None:
+        _mark_dirty(1)
+        return
+    if _journal is None:
+        _save_data()
+        return
+
+    items, _, dump = _COLLECTIONS[collection]
+    item = items.get(key)
+    _journal.append(collection, key, dump(item) if item is not None else None)
+    if _journal.size >= JOURNAL_COMPACT_BYTES:
+        _compact_requested.set()
+
+def _open_journal():
+    """Replay leftover journal records over the snapshot, then start journaling"""
+    global _journal
+    replayed = 0
+    # data.journal.1 only survives a crash in the middle of compaction
+    for path in (JOURNAL_FILE + ".1", JOURNAL_FILE):
+        for collection, key, value in replay(path):
+            items, load, _ = _COLLECTIONS[collection]
+            if value is None:
+                items.pop(key, None)
+            else:
+                items[key] = load(value)
+            replayed += 1
+
+    if replayed:
+        print(f"Replayed {replayed} journal records from {JOURNAL_FILE}.")
+        _write_snapshot(_snapshot_dict())
+    for path in (JOURNAL_FILE + ".1", JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+    _journal = Journal(JOURNAL_FILE, fsync=JOURNAL_FSYNC)
+    threading.Thread(target=_journal_worker, name="journal-compactor", daemon=True).start()
+    atexit.register(_close_journal)
+
+def _journal_worker():
+    """Group-fsync the journal and fold it into data.json once it grows too large"""
+    while True:
+        _compact_requested.wait(JOURNAL_FSYNC_INTERVAL_MS / 1000)
+        _journal.sync()
+        if _compact_requested.is_set():
+            _compact_requested.clear()
+            compact()
+
+def compact():
+    """Fold the journal back into data.json.
+
+    New changes go to a fresh journal while the snapshot is written; journal records
+    are full-entry upserts, so replaying ones the snapshot already holds is harmless.
+    """
+    if _journal is None:
+        return
+    with _snapshot_lock:
+        rotated = _journal.rotate()
+        _write_snapshot(_snapshot_dict())
+        os.remove(rotated)
+
+def _close_journal():
+    if _journal is not None:
+        _journal.close()
+
+def _mark_dirty(count: int):
+    global _changes_recorded
+    with _flush_cond:
+        _changes_recorded += count
+        _flush_cond.notify_all()
+
+def _start_flusher():
+    global _flusher
+    _flusher = threading.Thread(target=_flush_worker, name="data-flusher", daemon=True)
+    _flusher.start()
+    atexit.register(flush)
+
+def _flush_worker():
+    """Write data.json at most once per FLUSH_INTERVAL_MS, or sooner once
+    FLUSH_MAX_PENDING changes are waiting"""
+    while True:
+        with _flush_cond:
+            while _changes_recorded == _changes_flushed:
+                _flush_cond.wait()
+            deadline = time.monotonic() + FLUSH_INTERVAL_MS / 1000
+            while _changes_recorded - _changes_flushed < FLUSH_MAX_PENDING:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _flush_cond.wait(remaining)
+        flush()
+
+def flush():
+    """Write every change recorded so far to data.json (debounced mode)"""
+    global _changes_flushed
+    with _snapshot_lock:
+        with _flush_cond:
+            target = _changes_recorded
+        if target == _changes_flushed:
+            return
+        # Changes are applied before they are counted, so this snapshot covers target
+        _write_snapshot(_snapshot_dict())
+        with _flush_cond:
+            _changes_flushed = target
+            _flush_cond.notify_all()
+
+def wait_for_flush(timeout: Optional[float] = None) -> bool:
+    """Block until every change recorded so far is durable on disk.
+
+    Returns False if the timeout ran out first. Snapshot mode is already durable when
+    the change returns; journal mode fsyncs the journal now.
+    """
+    if _journal is not None:
+        _journal.sync()
+        return True
+    if _flusher is None:
+        return True
+    with _flush_cond:
+        target = _changes_recorded
+        return _flush_cond.wait_for(lambda: _changes_flushed >= target, timeout)
+
+def close():
+    """Make all pending changes durable; called on app shutdown"""
+    if _flusher is not None:
+        flush()
+    _close_journal()
+
 def init_seed_data_defaults():
     """Initialize with basic B2C membership templates and users if no data file exists"""
     basic_b2c_template = MembershipTemplate(
@@ -118,6 +666,7 @@ def init_seed_data_defaults():
     USERS[b2b_user.id] = b2b_user
 
     # Create initial active memberships
+    now = datetime.now(timezone.utc)
     # B2C user gets a basic B2C membership
     b2c_membership_id = str(uuid4())
     b2c_membership = Membership(
@@ -125,13 +674,13 @@ def init_seed_data_defaults():
         name=basic_b2c_template.name,
         user_id=b2c_user.id,
         template_id=basic_b2c_template.id,
-        created_at=datetime.now(),
-        expires_at=datetime.now() + timedelta(days=basic_b2c_template.duration_days),
+        created_at=now,
+        expires_at=now + timedelta(days=basic_b2c_template.duration_days),
         status=MembershipStatus.ACTIVE,
         limits=basic_b2c_template.limits,
         customer_type=basic_b2c_template.customer_type
     )
-    MEMBERSHIPS[b2c_membership_id] = b2c_membership
+    MEMBERSHIPS[b2c_membership_id] = MembershipRecord.from_model(b2c_membership)
 
     # B2B user gets a basic B2B membership
     b2b_membership_id = str(uuid4())
@@ -140,15 +689,304 @@ def init_seed_data_defaults():
         name=basic_b2b_template.name,
         user_id=b2b_user.id,
         template_id=basic_b2b_template.id,
-        created_at=datetime.now(),
-        expires_at=datetime.now() + timedelta(days=basic_b2b_template.duration_days),
+        created_at=now,
+        expires_at=now + timedelta(days=basic_b2b_template.duration_days),
         status=MembershipStatus.ACTIVE,
         limits=basic_b2b_template.limits,
         customer_type=basic_b2b_template.customer_type
     )
-    MEMBERSHIPS[b2b_membership_id] = b2b_membership
+    MEMBERSHIPS[b2b_membership_id] = MembershipRecord.from_model(b2b_membership)
+
+def _scan(
+    items: dict, order: _ScanOrder, after: int, limit: int, matches: Callable[[object], bool]
+) -> Tuple[list, Optional[int]]:
+    """Page through a dict in insertion order; the scan position is the last sequence number seen"""
+    page = []
+    position = after
+    while True:
+        chunk, more = order.after(position, max(limit, 256))
+        for index, (seq, key) in enumerate(chunk):
+            position = seq
+            item = items.get(key)
+            if item is not None and matches(item):
+                page.append(item)
+                if len(page) == limit:
+                    return page, position if more or index + 1 < len(chunk) else None
+        if not more:
+            return page, None
+
+class JsonStore(Store):
+    """Store over the in-memory dicts, persisted through record_change"""
+
+    # Users
+    def get_user(self, user_id: str) -> Optional[User]:
+        return USERS.get(user_id)
+
+    def users_for_company(self, company_id: str) -> List[User]:
+        return users_for_company(company_id)
+
+    @timed("scan_users")
+    def scan_users(
+        self, after: int, limit: int, customer_type: Optional[CustomerType] = None
+    ) -> Tuple[List[User], Optional[int]]:
+        return _scan(USERS, _USER_ORDER, after, limit, lambda u: customer_type is None or u.customer_type == customer_type)
+
+    def iter_users(self, customer_type: Optional[CustomerType] = None) -> Iterator[User]:
+        # A shallow copy of the values is just pointers, and keeps a long stream safe
+        # from concurrent inserts
+        for user in list(USERS.values()):
+            if customer_type is None or user.customer_type == customer_type:
+                yield user
+
+    def save_user(self, user: User):
+        add_user(user)
+        record_change("users", user.id)
+
+    def delete_user(self, user_id: str) -> bool:
+        if remove_user(user_id) is None:
+            return False
+        record_change("users", user_id)
+        return True
+
+    # Membership templates
+    def get_template(self, template_id: str) -> Optional[MembershipTemplate]:
+        return MEMBERSHIP_TEMPLATES.get(template_id)
+
+    def list_templates(self) -> List[MembershipTemplate]:
+        return list(MEMBERSHIP_TEMPLATES.values())
+
+    def save_template(self, template: MembershipTemplate):
+        MEMBERSHIP_TEMPLATES[template.id] = template
+        record_change("membership_templates", template.id)
+
+    def delete_template(self, template_id: str) -> bool:
+        if MEMBERSHIP_TEMPLATES.pop(template_id, None) is None:
+            return False
+        record_change("membership_templates", template_id)
+        return True
+
+    # Memberships
+    def get_membership(self, membership_id: str) -> Optional[Membership]:
+        record = MEMBERSHIPS.get(membership_id)
+        return record.to_model() if record is not None else None
+
+    def memberships_for_user(self, user_id: str) -> List[Membership]:
+        return memberships_for_user(user_id)
+
+    @timed("scan_memberships")
+    def scan_memberships(
+        self,
+        after: int,
+        limit: int,
+        status: Optional[MembershipStatus] = None,
+        customer_type: Optional[CustomerType] = None
+    ) -> Tuple[List[Membership], Optional[int]]:
+        # Filter on the records; only the page that is returned is turned into models
+        page, position = _scan(
+            MEMBERSHIPS, _MEMBERSHIP_ORDER, after, limit,
+            lambda m: (status is None or m.status == status)
+            and (customer_type is None or m.shape.customer_type == customer_type)
+        )
+        return [record.to_model() for record in page], position
+
+    def iter_memberships(
+        self,
+        status: Optional[MembershipStatus] = None,
+        customer_type: Optional[CustomerType] = None
+    ) -> Iterator[Membership]:
+        for record in list(MEMBERSHIPS.values()):
+            if (status is None or record.status == status) and \
+                    (customer_type is None or record.shape.customer_type == customer_type):
+                yield record.to_model()
+
+    def save_membership(self, membership: Membership):
+        add_membership(membership)
+        record_change("memberships", membership.id)
+
+    def save_memberships(self, memberships: List[Membership]):
+        for membership in memberships:
+            add_membership(membership)
+        record_changes("memberships", [membership.id for membership in memberships])
+
+    def delete_membership(self, membership_id: str) -> bool:
+        if remove_membership(membership_id) is None:
+            return False
+        record_change("memberships", membership_id)
+        return True
+
+    def consume_usage(self, user_id: str, feature_type: str, count_unlimited: bool = True) -> Optional[Membership]:
+        now = time.time()
+        with _usage_lock:
+            for record in records_for_user(user_id):
+                if record.has_remaining(feature_type, now):
+                    return self._spend(record, feature_type, count_unlimited)
+        return None
+
+    def consume_membership(self, membership_id: str, feature_type: str) -> Optional[Membership]:
+        now = time.time()
+        with _usage_lock:
+            record = MEMBERSHIPS.get(membership_id)
+            if record is None or not record.has_remaining(feature_type, now):
+                return None
+            return self._spend(record, feature_type, True)
+
+    def consume_usage_batch(self, updates: List[Tuple[str, str]]) -> List[UsageResult]:
+        with _usage_lock:
+            results, changed = apply_usage_batch(updates, memberships_for_user, datetime.now(timezone.utc))
+            # The batch counted on model copies; write the new counts back to the records
+            for membership_id, membership in changed.items():
+                record = MEMBERSHIPS.get(membership_id)
+                if record is not None:
+                    record.conversation = membership.usage.conversation
+                    record.analysis = membership.usage.analysis
+            record_changes("memberships", list(changed))
+        return results
+
+    # Company quotas
+    def get_company_quota(self, company_id: str) -> Optional[CompanyQuota]:
+        return COMPANY_QUOTAS.get(company_id)
+
+    def save_company_quota(self, quota: CompanyQuota):
+        COMPANY_QUOTAS[quota.company_id] = quota
+        record_change("company_quotas", quota.company_id)
+
+    def delete_company_quota(self, company_id: str) -> bool:
+        with _quota_lock:
+            if COMPANY_QUOTAS.pop(company_id, None) is None:
+                return False
+            removed = [key for key, allocation in QUOTA_ALLOCATIONS.items() if allocation.company_id == company_id]
+            for key in removed:
+                del QUOTA_ALLOCATIONS[key]
+        record_change("company_quotas", company_id)
+        record_changes("quota_allocations", removed)
+        return True
+
+    def get_quota_allocation(self, company_id: str, user_id: str) -> Optional[QuotaAllocation]:
+        return QUOTA_ALLOCATIONS.get(allocation_key(company_id, user_id))
+
+    def quota_allocations(self, company_id: str) -> List[QuotaAllocation]:
+        return [allocation for allocation in list(QUOTA_ALLOCATIONS.values()) if allocation.company_id == company_id]
+
+    def save_quota_allocation(self, allocation: QuotaAllocation):
+        key = allocation_key(allocation.company_id, allocation.user_id)
+        QUOTA_ALLOCATIONS[key] = allocation
+        record_change("quota_allocations", key)
+
+    def delete_quota_allocation(self, company_id: str, user_id: str) -> bool:
+        key = allocation_key(company_id, user_id)
+        if QUOTA_ALLOCATIONS.pop(key, None) is None:
+            return False
+        record_change("quota_allocations", key)
+        return True
+
+    def consume_company_quota(
+        self, company_id: str, user_id: str, feature_type: str
+    ) -> Optional[Tuple[CompanyQuota, QuotaAllocation]]:
+        if feature_type not in FEATURES:
+            return None
+        key = allocation_key(company_id, user_id)
+        with _quota_lock:
+            quota = COMPANY_QUOTAS.get(company_id)
+            if quota is None:
+                return None
+            allocation = QUOTA_ALLOCATIONS.get(key) or QuotaAllocation(company_id=company_id, user_id=user_id)
+            if not (quota_has_room(quota.limits, quota.usage, feature_type)
+                    and quota_has_room(allocation.limits, allocation.usage, feature_type)):
+                return None
+            setattr(quota.usage, feature_type, getattr(quota.usage, feature_type) + 1)
+            setattr(allocation.usage, feature_type, getattr(allocation.usage, feature_type) + 1)
+            QUOTA_ALLOCATIONS[key] = allocation
+        record_change("company_quotas", company_id)
+        record_change("quota_allocations", key)
+        return quota, allocation
+
+    @timed("expire_due")
+    def expire_due(self, now: datetime) -> int:
+        return len(expire_due(now))
+
+    def next_expiry(self) -> Optional[datetime]:
+        return next_expiry()
+
+    # Idempotency keys
+    def get_idempotency_record(self, key: str) -> Optional[IdempotencyRecord]:
+        return IDEMPOTENCY_RECORDS.get(key)
+
+    def claim_idempotency_key(
+        self, record: IdempotencyRecord, expired_before: float, stale_before: float
+    ) -> Optional[IdempotencyRecord]:
+        with _idempotency_lock:
+            existing = IDEMPOTENCY_RECORDS.get(record.key)
+            if existing is not None and idempotency_key_taken(existing, expired_before, stale_before):
+                return existing
+            # Re-insert so the dict stays ordered oldest first for pruning
+            IDEMPOTENCY_RECORDS.pop(record.key, None)
+            IDEMPOTENCY_RECORDS[record.key] = record
+            return None
+
+    def save_idempotency_record(self, record: IdempotencyRecord):
+        IDEMPOTENCY_RECORDS[record.key] = record
+        record_change("idempotency_keys", record.key)
+
+    def release_idempotency_key(self, key: str):
+        with _idempotency_lock:
+            existing = IDEMPOTENCY_RECORDS.get(key)
+            if existing is not None and existing.status_code is None:
+                del IDEMPOTENCY_RECORDS[key]
+
+    def prune_idempotency_records(self, expired_before: float, keep: int):
+        removed = []
+        with _idempotency_lock:
+            # Claims re-insert their key, so the dict is ordered by created_at
+            excess = len(IDEMPOTENCY_RECORDS) - keep
+            for position, (key, record) in enumerate(IDEMPOTENCY_RECORDS.items()):
+                if position >= excess and record.created_at >= expired_before:
+                    break
+                if record.status_code is not None:
+                    removed.append(key)
+            for key in removed:
+                del IDEMPOTENCY_RECORDS[key]
+        record_changes("idempotency_keys", removed)
+
+    def _spend(self, record: MembershipRecord, feature_type: str, count_unlimited: bool) -> Membership:
+        if count_unlimited or record.limit(feature_type) is not None:
+            setattr(record, feature_type, getattr(record, feature_type) + 1)
+            record_change("memberships", record.id)
+        return record.to_model()
 
-    _save_data() # Save initial seed data to file
+def _open_sqlite_store() -> SQLiteStore:
+    sqlite_store = SQLiteStore(SQLITE_FILE)
+    if sqlite_store.is_empty():
+        # First start on SQLite: import data.json if there is one, otherwise the seed data
+        try:
+            _read_data_file()
+        except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+            init_seed_data_defaults()
+        print(f"Importing {len(MEMBERSHIPS)} memberships into {SQLITE_FILE}.")
+        sqlite_store.import_data(
+            USERS.values(), MEMBERSHIP_TEMPLATES.values(),
+            (record.to_model() for record in MEMBERSHIPS.values()), IDEMPOTENCY_RECORDS.values(),
+            COMPANY_QUOTAS.values(), QUOTA_ALLOCATIONS.values()
+        )
+        USERS.clear()
+        MEMBERSHIP_TEMPLATES.clear()
+        MEMBERSHIPS.clear()
+        IDEMPOTENCY_RECORDS.clear()
+        COMPANY_QUOTAS.clear()
+        QUOTA_ALLOCATIONS.clear()
+    return sqlite_store
 
 # Load data on startup
-_load_data()
+if STORAGE_BACKEND != "sqlite" and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+    # Each worker would hold its own copy of the dicts and overwrite the others' data.json
+    print("Running several workers on the json backend loses writes; set STORAGE_BACKEND=sqlite.")
+if STORAGE_BACKEND == "sqlite":
+    store: Store = _open_sqlite_store()
+    # Rows are read on demand; there is nothing to load
+    _load_progress.update(state="ready", percent=100.0)
+    _loaded.set()
+elif LOAD_MODE == "background":
+    # Loaded once the app is up (main.py calls start_loading), so imports aren't slowed
+    store = JsonStore()
+else:
+    _load_data()
+    store = JsonStore()
@@ -0,0 +1,34 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from storage import Store
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long the scheduler sleeps, so memberships created with an
+# earlier deadline than the one it is waiting for are still expired promptly
+EXPIRY_MAX_SLEEP_SECONDS = float(os.getenv("EXPIRY_MAX_SLEEP_SECONDS", "1"))
+
+
+async def run_expiry_scheduler(store: Store):
+    """Expire memberships in batches as their deadlines pass.
+
+    Runs for the lifetime of the app; each pass costs O(expired memberships) instead
+    of every read re-checking expires_at.
+    """
+    while True:
+        try:
+            now = datetime.now(timezone.utc)
+            expired = await asyncio.to_thread(store.expire_due, now)
+            if expired:
+                logger.info("Expired %d memberships", expired)
+            next_expiry = await asyncio.to_thread(store.next_expiry)
+        except Exception:
+            logger.exception("Membership expiry pass failed")
+            next_expiry = None
+
+        delay = EXPIRY_MAX_SLEEP_SECONDS
+        if next_expiry is not None:
+            delay = min(delay, max((next_expiry - datetime.now(timezone.utc)).total_seconds(), 0))
+        await asyncio.sleep(delay)
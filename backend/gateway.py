@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Optional
+import httpx
+from metrics import observe
+
+logger = logging.getLogger(__name__)
+
+# Empty: charge against the in-process stand-in (mock_gateway.py) instead of a real gateway
+PAYMENT_GATEWAY_URL = os.getenv("PAYMENT_GATEWAY_URL", "")
+PAYMENT_GATEWAY_CONCURRENCY = int(os.getenv("PAYMENT_GATEWAY_CONCURRENCY", "32"))
+PAYMENT_GATEWAY_TIMEOUT_SECONDS = float(os.getenv("PAYMENT_GATEWAY_TIMEOUT_SECONDS", "5"))
+PAYMENT_GATEWAY_RETRIES = int(os.getenv("PAYMENT_GATEWAY_RETRIES", "2"))
+PAYMENT_GATEWAY_BACKOFF_SECONDS = float(os.getenv("PAYMENT_GATEWAY_BACKOFF_SECONDS", "0.1"))
+# Consecutive failed attempts that open the circuit, and how long it stays open
+PAYMENT_GATEWAY_BREAKER_THRESHOLD = int(os.getenv("PAYMENT_GATEWAY_BREAKER_THRESHOLD", "5"))
+PAYMENT_GATEWAY_BREAKER_COOLDOWN_SECONDS = float(os.getenv("PAYMENT_GATEWAY_BREAKER_COOLDOWN_SECONDS", "30"))
+
+_MAX_BACKOFF_SECONDS = 2.0
+
+
+class GatewayUnavailable(Exception):
+    """The gateway couldn't be reached, kept failing, or the circuit is open"""
+
+
+class CircuitBreaker:
+    """Fails fast after repeated failures, then lets a single probe through after a cooldown"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        # Half-open: this caller is the probe
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            if self.opened_at is None or self.probing:
+                logger.warning("Payment gateway circuit opened after %d failures", self.failures)
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """End an attempt that neither failed nor succeeded; a half-open probe lets the next caller probe"""
+        self.probing = False
+
+
+class PaymentGatewayClient:
+    """Pooled async client for the payment gateway.
+
+    The connection pool, semaphore and breaker are shared by every request in the
+    process. They're created on first use, in whichever event loop the app runs.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.breaker = CircuitBreaker(PAYMENT_GATEWAY_BREAKER_THRESHOLD, PAYMENT_GATEWAY_BREAKER_COOLDOWN_SECONDS)
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            # Pooled connections and the semaphore belong to one event loop
+            timeout = httpx.Timeout(PAYMENT_GATEWAY_TIMEOUT_SECONDS)
+            limits = httpx.Limits(
+                max_connections=PAYMENT_GATEWAY_CONCURRENCY, max_keepalive_connections=PAYMENT_GATEWAY_CONCURRENCY
+            )
+            if PAYMENT_GATEWAY_URL:
+                self._client = httpx.AsyncClient(base_url=PAYMENT_GATEWAY_URL, timeout=timeout, limits=limits)
+            else:
+                import mock_gateway
+                self._client = httpx.AsyncClient(
+                    transport=httpx.ASGITransport(app=mock_gateway.app), base_url="http://mock-gateway",
+                    timeout=timeout, limits=limits
+                )
+            self._semaphore = asyncio.Semaphore(PAYMENT_GATEWAY_CONCURRENCY)
+            self._loop = loop
+        return self._client
+
+    async def charge(self, payment_method: str, amount: float, currency: str, idempotency_key: str) -> dict:
+        """Charge once, retrying transient failures; the gateway dedupes retries by idempotency_key"""
+        client = self._ensure_client()
+        attempts = PAYMENT_GATEWAY_RETRIES + 1
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise GatewayUnavailable("Payment gateway circuit is open")
+            try:
+                result = await self._attempt(client, payment_method, amount, currency, idempotency_key)
+            except (httpx.TransportError, httpx.HTTPStatusError, asyncio.TimeoutError) as exc:
+                self.breaker.record_failure()
+                logger.warning("Payment gateway attempt %d/%d failed: %r", attempt + 1, attempts, exc)
+                if attempt + 1 == attempts:
+                    raise GatewayUnavailable("Payment gateway request failed") from exc
+                # Exponential backoff with full jitter, so retries from many requests spread out
+                backoff = min(_MAX_BACKOFF_SECONDS, PAYMENT_GATEWAY_BACKOFF_SECONDS * 2 ** attempt)
+                await asyncio.sleep(random.uniform(0, backoff))
+                continue
+            except asyncio.CancelledError:
+                # The caller went away, which says nothing about the gateway
+                self.breaker.release()
+                raise
+            except Exception:
+                # A malformed reply is a gateway failure too, and ends a half-open probe
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return result
+
+    async def _attempt(self, client: httpx.AsyncClient, payment_method: str, amount: float,
+                       currency: str, idempotency_key: str) -> dict:
+        # Waiting for a slot counts against the attempt's timeout too
+        response = await asyncio.wait_for(
+            self._post(client, payment_method, amount, currency, idempotency_key), PAYMENT_GATEWAY_TIMEOUT_SECONDS
+        )
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        # Other 4xx are answers (e.g. a declined card), not failures worth retrying
+        if response.status_code >= 400:
+            return {"success": False, "message": response.text}
+        return response.json()
+
+    async def _post(self, client: httpx.AsyncClient, payment_method: str, amount: float,
+                    currency: str, idempotency_key: str) -> httpx.Response:
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                return await client.post(
+                    "/charges",
+                    json={"payment_method": payment_method, "amount": amount, "currency": currency},
+                    headers={"Idempotency-Key": idempotency_key}
+                )
+            finally:
+                observe("payment_gateway", time.perf_counter() - started)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+gateway = PaymentGatewayClient()
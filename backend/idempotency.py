@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import HTTPException, Response
+from db import store
+from models import IdempotencyRecord
+from serialization import json_response
+
+logger = logging.getLogger(__name__)
+
+# How long a replayed response is remembered, and how many at most: a client sending a
+# new key with every request would otherwise grow the store for a whole TTL
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+# How long a duplicate waits for the original request to finish; a claim older than
+# this whose request never completed (a crashed worker) is taken over
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+MAX_KEY_LENGTH = 255
+
+# Executions running in this process, so identical concurrent requests share one.
+# Only touched from the event loop, so it needs no lock.
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def fingerprint(route: str, body: str) -> str:
+    """Identify a request, to refuse reusing a key for a different one"""
+    return hashlib.sha256(f"{route}\n{body}".encode()).hexdigest()
+
+
+async def run_once(
+    key: Optional[str], request_fingerprint: str, execute: Callable[[], Awaitable[Response]]
+) -> Response:
+    """Run execute() once per Idempotency-Key and replay its response to every retry.
+
+    Without a key this is just execute(). Successful and 4xx responses are recorded;
+    5xx errors and crashes release the key so a retry runs the request again.
+    """
+    if key is None:
+        return await execute()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+
+    future = _inflight.get(key)
+    if future is not None:
+        # Coalesce onto the execution already running in this process
+        try:
+            record = await asyncio.wait_for(asyncio.shield(future), IDEMPOTENCY_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        return _replay(record, request_fingerprint)
+
+    future = _inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        record, response = await _execute_once(key, request_fingerprint, execute)
+        future.set_result(record)
+    except BaseException as exc:
+        future.set_exception(exc)
+        # Don't warn about an unretrieved exception when nobody was waiting
+        future.exception()
+        raise
+    finally:
+        del _inflight[key]
+    return response if response is not None else _replay(record, request_fingerprint)
+
+
+async def _execute_once(key: str, request_fingerprint: str, execute: Callable[[], Awaitable[Response]]):
+    """Claim the key in the store and run the request, or return whoever holds the key"""
+    now = time.time()
+    existing = await asyncio.to_thread(
+        store.claim_idempotency_key,
+        IdempotencyRecord(key=key, fingerprint=request_fingerprint, created_at=now),
+        expired_before=now - IDEMPOTENCY_TTL_SECONDS,
+        stale_before=now - IDEMPOTENCY_WAIT_SECONDS
+    )
+    if existing is not None:
+        if existing.status_code is None and existing.fingerprint == request_fingerprint:
+            # Claimed by another worker process; there is no future to wait on there
+            existing = await _wait_for_completion(key)
+        return existing, None
+
+    try:
+        response = await execute()
+    except HTTPException as exc:
+        if exc.status_code >= 500:
+            await asyncio.to_thread(store.release_idempotency_key, key)
+            raise
+        response = json_response({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+    except BaseException:
+        await asyncio.to_thread(store.release_idempotency_key, key)
+        raise
+
+    record = IdempotencyRecord(
+        key=key,
+        fingerprint=request_fingerprint,
+        created_at=now,
+        status_code=response.status_code,
+        body=bytes(response.body).decode()
+    )
+    await asyncio.to_thread(_save, record)
+    return record, response
+
+
+def _save(record: IdempotencyRecord):
+    store.save_idempotency_record(record)
+    store.prune_idempotency_records(record.created_at - IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS)
+
+
+async def _wait_for_completion(key: str) -> IdempotencyRecord:
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        record = await asyncio.to_thread(store.get_idempotency_record, key)
+        if record is None:
+            raise HTTPException(
+                status_code=409, detail="The original request with this Idempotency-Key failed; retry it"
+            )
+        if record.status_code is not None:
+            return record
+    raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+
+def _replay(record: IdempotencyRecord, request_fingerprint: str) -> Response:
+    if record.fingerprint != request_fingerprint:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    logger.info("Replaying response for Idempotency-Key %s", record.key)
+    return Response(
+        record.body,
+        status_code=record.status_code,
+        headers={"Idempotent-Replayed": "true"},
+        media_type="application/json"
+    )
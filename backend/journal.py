@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+from typing import Any, Iterator, Optional, Tuple
+
+
+class Journal:
+    """Append-only log of single-entry changes, folded back into data.json by db.py"""
+
+    def __init__(self, path: str, fsync: str = "interval"):
+        # fsync: "always" syncs on every append, "interval" leaves it to sync()
+        # (group fsync from a background thread), "off" relies on the OS
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+        self._dirty = False
+        self.size = self._file.tell()
+
+    def append(self, collection: str, key: str, value: Optional[dict[str, Any]]):
+        """Append one upsert (or delete, when value is None) record"""
+        line = json.dumps({"c": collection, "k": key, "v": value}, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.size += len(line)
+            if self.fsync == "always":
+                os.fsync(self._file.fileno())
+            else:
+                self._dirty = True
+
+    def sync(self):
+        """fsync everything appended since the last sync"""
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._dirty and self.fsync != "off":
+                os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def rotate(self) -> str:
+        """Move the current log aside and start a fresh one, returning the old path"""
+        rotated = self.path + ".1"
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self.path, rotated)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._dirty = False
+            self.size = 0
+        return rotated
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._file.close()
+
+
+def replay(path: str) -> Iterator[Tuple[str, str, Optional[dict[str, Any]]]]:
+    """Yield (collection, key, value) records from a journal file, oldest first"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from a crash mid-append; everything before it is intact
+                break
+            yield record["c"], record["k"], record["v"]
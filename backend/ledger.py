@@ -0,0 +1,459 @@
+import bisect
+import fcntl
+import heapq
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional: replays decode events with struct without it
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Where the usage ledger lives (empty disables it)
+LEDGER_DIR = os.getenv("LEDGER_DIR", os.path.join(os.getenv("DATA_DIR", "."), "ledger"))
+# Events per segment file (16 bytes each) before a new one is started
+LEDGER_SEGMENT_EVENTS = int(os.getenv("LEDGER_SEGMENT_EVENTS", str(1 << 20)))
+# A checkpoint of every membership's totals is written after this many events, so a
+# replay reads one checkpoint entry plus at most this many events
+LEDGER_CHECKPOINT_EVENTS = int(os.getenv("LEDGER_CHECKPOINT_EVENTS", "100000"))
+# Newest checkpoints kept per stream; the first one (the baseline) is always kept
+LEDGER_CHECKPOINTS_KEPT = int(os.getenv("LEDGER_CHECKPOINTS_KEPT", "48"))
+
+FEATURES = ("conversation", "analysis")
+FEATURE_CODES = {feature: code for code, feature in enumerate(FEATURES)}
+# Usage charged to a company quota on behalf of a seat is kept under the seat's id with
+# this prefix, apart from the seat's own counters (which pooled usage doesn't touch)
+POOLED_PREFIX = "pooled:"
+
+# One event: timestamp, membership number (its line in the stream's ids file), delta, feature
+EVENT = struct.Struct("<dIhBx")
+TIMESTAMP = struct.Struct("<d")
+# Checkpoint header: events before it, timestamp, memberships it counts; then the
+# conversation and analysis totals as two int32 arrays indexed by membership number
+CHECKPOINT = struct.Struct("<QdQ")
+MAX_DELTA = 32767
+SCAN_CHUNK_EVENTS = 65536
+
+if np is not None:
+    EVENT_DTYPE = np.dtype([("ts", "<f8"), ("member", "<u4"), ("delta", "<i2"), ("feature", "u1"), ("pad", "u1")])
+
+
+def _timestamp_at(mm: mmap.mmap, index: int) -> float:
+    return TIMESTAMP.unpack_from(mm, index * EVENT.size)[0]
+
+
+class Stream:
+    """The events one process wrote: an ids file, segment files and checkpoints in one directory.
+
+    Segment files are named after the position (events before them in the stream) of
+    their first event and hold fixed-size records, so an event's position says which
+    file and offset it is at. Timestamps never go backwards within a stream, which lets
+    a time range be found by bisecting the mapped segments.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.number = int(os.path.basename(path).rsplit("-", 1)[1])
+        self._ids: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._ids_read = 0
+
+    @property
+    def ids_path(self) -> str:
+        return os.path.join(self.path, "ids")
+
+    def ids(self) -> Tuple[List[str], Dict[str, int]]:
+        """Membership ids by number, read incrementally as the ids file grows"""
+        try:
+            with open(self.ids_path, "rb") as f:
+                f.seek(self._ids_read)
+                data = f.read()
+        except FileNotFoundError:
+            return self._ids, self._index
+        # Only whole lines: the writer may be part-way through the last one
+        data = data[:data.rfind(b"\n") + 1]
+        for line in data.decode().splitlines():
+            self._index[line] = len(self._ids)
+            self._ids.append(line)
+        self._ids_read += len(data)
+        return self._ids, self._index
+
+    def segments(self) -> List[Tuple[int, str, int]]:
+        """(first position, path, events) per segment, oldest first"""
+        segments = []
+        for name in os.listdir(self.path):
+            if name.startswith("segment-") and name.endswith(".log"):
+                path = os.path.join(self.path, name)
+                segments.append((int(name[8:-4]), path, os.path.getsize(path) // EVENT.size))
+        return sorted(segments)
+
+    def checkpoints(self) -> List[Tuple[int, float, str]]:
+        """(position, timestamp, path) per checkpoint, oldest first"""
+        checkpoints = []
+        for name in os.listdir(self.path):
+            if name.startswith("checkpoint-") and name.endswith(".bin"):
+                path = os.path.join(self.path, name)
+                with open(path, "rb") as f:
+                    position, timestamp, _ = CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+                checkpoints.append((position, timestamp, path))
+        return sorted(checkpoints)
+
+    def end(self) -> int:
+        segments = self.segments()
+        return segments[-1][0] + segments[-1][2] if segments else 0
+
+    def position_at(self, at: Optional[float]) -> int:
+        """Position of the first event at or after `at` (the stream's end when None or past it)"""
+        segments = self.segments()
+        if at is None or not segments:
+            return self.end()
+        for first, path, count in segments:
+            if not count:
+                continue
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if _timestamp_at(mm, count - 1) < at:
+                    continue
+                return first + bisect.bisect_left(range(count), at, key=lambda i: _timestamp_at(mm, i))
+        return segments[-1][0] + segments[-1][2]
+
+    def chunks(self, start: int, end: int) -> Iterator[bytes]:
+        """Raw events for positions start..end-1, a chunk at a time, out of the mapped segments"""
+        for first, path, count in self.segments():
+            low, high = max(start, first), min(end, first + count)
+            if low >= high:
+                continue
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for chunk_start in range(low, high, SCAN_CHUNK_EVENTS):
+                    chunk_end = min(high, chunk_start + SCAN_CHUNK_EVENTS)
+                    yield mm[(chunk_start - first) * EVENT.size:(chunk_end - first) * EVENT.size]
+
+    def checkpoint_before(self, position: int) -> Optional[Tuple[int, float, str]]:
+        checkpoints = self.checkpoints()
+        index = bisect.bisect_right([checkpoint[0] for checkpoint in checkpoints], position)
+        return checkpoints[index - 1] if index else None
+
+    def usage(self, member: int, end: int) -> Tuple[int, int, int]:
+        """One membership's (conversation, analysis) totals before position `end`, and the events scanned"""
+        conversation = analysis = 0
+        start = 0
+        checkpoint = self.checkpoint_before(end)
+        if checkpoint is not None:
+            start = checkpoint[0]
+            with open(checkpoint[2], "rb") as f:
+                _, _, count = CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+                if member < count:
+                    conversation = struct.unpack("<i", os.pread(f.fileno(), 4, CHECKPOINT.size + member * 4))[0]
+                    analysis = struct.unpack(
+                        "<i", os.pread(f.fileno(), 4, CHECKPOINT.size + (count + member) * 4)
+                    )[0]
+        for chunk in self.chunks(start, end):
+            if np is not None:
+                events = np.frombuffer(chunk, EVENT_DTYPE)
+                events = events[events["member"] == member]
+                conversation += int(events["delta"][events["feature"] == 0].sum())
+                analysis += int(events["delta"][events["feature"] == 1].sum())
+            else:
+                for _, event_member, delta, feature in EVENT.iter_unpack(chunk):
+                    if event_member == member:
+                        if feature:
+                            analysis += delta
+                        else:
+                            conversation += delta
+        return conversation, analysis, end - start
+
+    def totals(self, end: int) -> Tuple[array, array]:
+        """Every membership's conversation and analysis totals before position `end`"""
+        conversation, analysis, start = array("i"), array("i"), 0
+        checkpoint = self.checkpoint_before(end)
+        if checkpoint is not None:
+            start = checkpoint[0]
+            with open(checkpoint[2], "rb") as f:
+                _, _, count = CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+                conversation.frombytes(f.read(count * 4))
+                analysis.frombytes(f.read(count * 4))
+        for chunk in self.chunks(start, end):
+            if np is not None:
+                events = np.frombuffer(chunk, EVENT_DTYPE)
+                for code, totals in enumerate((conversation, analysis)):
+                    selected = events[events["feature"] == code]
+                    added = np.bincount(selected["member"], weights=selected["delta"]).astype(np.int32)
+                    _grow(totals, len(added))
+                    np.frombuffer(totals, dtype=np.int32)[:len(added)] += added
+            else:
+                for _, member, delta, feature in EVENT.iter_unpack(chunk):
+                    _grow(conversation, member + 1)
+                    _grow(analysis, member + 1)
+                    if feature:
+                        analysis[member] += delta
+                    else:
+                        conversation[member] += delta
+        return conversation, analysis
+
+    def events(self, start: int, end: int, members: Optional[Set[int]], feature: Optional[int]) -> Iterator[tuple]:
+        """(timestamp, member, delta, feature) for positions start..end-1, optionally filtered"""
+        for chunk in self.chunks(start, end):
+            for event in EVENT.iter_unpack(chunk):
+                if (members is None or event[1] in members) and (feature is None or event[3] == feature):
+                    yield event
+
+
+def _grow(totals: array, size: int):
+    if len(totals) < size:
+        totals.frombytes(bytes(totals.itemsize * (size - len(totals))))
+
+
+class UsageLedger:
+    """Append-only record of every change to a membership's usage counters.
+
+    Each process appends to a stream of its own, claimed with a file lock, so several
+    workers sharing a data directory never interleave writes; reads merge all streams.
+    Appends are one 16-byte write to the current segment. A checkpoint of all totals is
+    written (in the background) every LEDGER_CHECKPOINT_EVENTS events, so replaying a
+    membership to any point in time reads one checkpoint entry and a bounded run of
+    events instead of its whole history.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._streams: Dict[str, Stream] = {}
+        self._stream: Optional[Stream] = None
+        self._lock_fd: Optional[int] = None
+        self._fd: Optional[int] = None
+        self._ids_file = None
+        self._index: Dict[str, int] = {}
+        self._segment_first = 0
+        self._last_ts = 0.0
+        self._conversation = array("i")
+        self._analysis = array("i")
+        self.position = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._fd is not None
+
+    def open(self, baseline: Callable[[], Iterable[Tuple[str, int, int]]]):
+        """Claim a stream and pick up where it left off.
+
+        A brand-new ledger starts from `baseline`, the (membership id, conversation,
+        analysis) counters already in the store, so replays add up to the stored usage.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        number = 0
+        while True:
+            path = os.path.join(self.directory, f"stream-{number}")
+            os.makedirs(path, exist_ok=True)
+            lock_fd = os.open(os.path.join(path, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                os.close(lock_fd)
+                number += 1
+        stream = self._stream_for(path)
+        _, index = stream.ids()
+        segments = stream.segments()
+        if segments:
+            # A crash may have left half an event at the end; drop it
+            first, segment_path, count = segments[-1]
+            if os.path.getsize(segment_path) != count * EVENT.size:
+                os.truncate(segment_path, count * EVENT.size)
+            self.position = first + count
+            self._segment_first = first
+            if count:
+                with open(segment_path, "rb") as f:
+                    self._last_ts = TIMESTAMP.unpack(os.pread(f.fileno(), TIMESTAMP.size, (count - 1) * EVENT.size))[0]
+        with self._lock:
+            self._stream = stream
+            self._lock_fd = lock_fd
+            self._index = dict(index)
+            self._ids_file = open(stream.ids_path, "a", encoding="utf-8")
+            if number == 0 and not segments and not stream.checkpoints():
+                for membership_id, conversation, analysis in baseline():
+                    member = self._member(membership_id)
+                    self._conversation[member] = conversation
+                    self._analysis[member] = analysis
+                self._write_checkpoint(0, time.time(), self._conversation, self._analysis)
+                logger.info("Usage ledger started from %d memberships' counters", len(self._index))
+            else:
+                self._conversation, self._analysis = stream.totals(self.position)
+                _grow(self._conversation, len(self._index))
+                _grow(self._analysis, len(self._index))
+            self._fd = os.open(
+                os.path.join(path, f"segment-{self._segment_first:012d}.log"),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        logger.info("Usage ledger stream %d open at %d events", number, self.position)
+
+    def _stream_for(self, path: str) -> Stream:
+        stream = self._streams.get(path)
+        if stream is None:
+            stream = self._streams.setdefault(path, Stream(path))
+        return stream
+
+    def streams(self) -> List[Stream]:
+        if not os.path.isdir(self.directory):
+            return []
+        return [
+            self._stream_for(os.path.join(self.directory, name))
+            for name in sorted(os.listdir(self.directory)) if name.startswith("stream-")
+        ]
+
+    def _member(self, membership_id: str) -> int:
+        member = self._index.get(membership_id)
+        if member is None:
+            member = self._index[membership_id] = len(self._index)
+            # The id is on disk before any event refers to its number
+            self._ids_file.write(membership_id + "\n")
+            self._ids_file.flush()
+            self._conversation.append(0)
+            self._analysis.append(0)
+        return member
+
+    def record(self, membership_id: str, feature_type: str, delta: int = 1):
+        """Append a change of `delta` to a membership's usage of a feature"""
+        checkpoint = None
+        with self._lock:
+            if self._fd is None:
+                return
+            member = self._member(membership_id)
+            code = FEATURE_CODES[feature_type]
+            totals = self._analysis if code else self._conversation
+            self._last_ts = max(time.time(), self._last_ts)
+            while delta:
+                step = max(-MAX_DELTA, min(MAX_DELTA, delta))
+                os.write(self._fd, EVENT.pack(self._last_ts, member, step, code))
+                totals[member] += step
+                delta -= step
+                self.position += 1
+                if self.position - self._segment_first >= LEDGER_SEGMENT_EVENTS:
+                    self._roll()
+                if self.position % LEDGER_CHECKPOINT_EVENTS == 0:
+                    checkpoint = (self.position, self._last_ts, array("i", self._conversation), array("i", self._analysis))
+        if checkpoint is not None:
+            threading.Thread(target=self._write_checkpoint, args=checkpoint, daemon=True).start()
+
+    def _roll(self):
+        os.close(self._fd)
+        self._segment_first = self.position
+        self._fd = os.open(
+            os.path.join(self._stream.path, f"segment-{self.position:012d}.log"),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+
+    def _write_checkpoint(self, position: int, timestamp: float, conversation: array, analysis: array):
+        stream = self._stream
+        path = os.path.join(stream.path, f"checkpoint-{position:012d}.bin")
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(CHECKPOINT.pack(position, timestamp, len(conversation)))
+                f.write(conversation.tobytes())
+                f.write(analysis.tobytes())
+            os.replace(path + ".tmp", path)
+            checkpoints = stream.checkpoints()
+            for _, _, old in checkpoints[1:-LEDGER_CHECKPOINTS_KEPT]:
+                os.remove(old)
+        except OSError:
+            logger.exception("Writing usage ledger checkpoint %s failed", path)
+
+    def usage_at(self, membership_id: str, at: Optional[float] = None) -> Optional[dict]:
+        """A membership's usage as of `at` (now when None), replayed from the nearest checkpoints"""
+        found = False
+        conversation = analysis = scanned = 0
+        for stream in self.streams():
+            member = stream.ids()[1].get(membership_id)
+            if member is None:
+                continue
+            found = True
+            stream_conversation, stream_analysis, stream_scanned = stream.usage(member, stream.position_at(at))
+            conversation += stream_conversation
+            analysis += stream_analysis
+            scanned += stream_scanned
+        if not found:
+            return None
+        return {"conversation": conversation, "analysis": analysis, "events_scanned": scanned}
+
+    def totals_at(self, at: Optional[float] = None) -> Dict[str, Tuple[int, int]]:
+        """(conversation, analysis) as of `at` for every membership the ledger knows"""
+        totals: Dict[str, Tuple[int, int]] = {}
+        for stream in self.streams():
+            ids = stream.ids()[0]
+            conversation, analysis = stream.totals(stream.position_at(at))
+            _grow(conversation, len(ids))
+            _grow(analysis, len(ids))
+            for member, membership_id in enumerate(ids):
+                previous = totals.get(membership_id, (0, 0))
+                totals[membership_id] = (previous[0] + conversation[member], previous[1] + analysis[member])
+        return totals
+
+    def events(
+        self, start: Optional[float], end: Optional[float], membership_id: Optional[str] = None,
+        feature_type: Optional[str] = None
+    ) -> Iterator[dict]:
+        """Events with start <= timestamp < end across all streams, oldest first.
+
+        A membership's events include the pooled usage charged on its behalf.
+        """
+        feature = None if feature_type is None else FEATURE_CODES[feature_type]
+        readers = []
+        for stream in self.streams():
+            ids, index = stream.ids()
+            members = None
+            if membership_id is not None:
+                members = {index[key] for key in (membership_id, POOLED_PREFIX + membership_id) if key in index}
+                if not members:
+                    continue
+            first = 0 if start is None else stream.position_at(start)
+            readers.append(((*event, ids) for event in stream.events(first, stream.position_at(end), members, feature)))
+        for timestamp, member, delta, code, ids in heapq.merge(*readers, key=lambda event: event[0]):
+            key = ids[member]
+            pooled = key.startswith(POOLED_PREFIX)
+            yield {
+                "membership_id": key[len(POOLED_PREFIX):] if pooled else key,
+                "feature_type": FEATURES[code],
+                "delta": delta,
+                "pooled": pooled,
+                "at": datetime.fromtimestamp(timestamp, timezone.utc).isoformat(),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            os.close(self._fd)
+            self._fd = None
+            self._ids_file.close()
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+ledger = UsageLedger(LEDGER_DIR)
+
+
+def open_ledger(store):
+    """Open the ledger for this process, seeded from the store's counters if it is new"""
+    if not LEDGER_DIR:
+        return
+
+    def baseline():
+        for membership in store.iter_memberships():
+            yield membership.id, membership.usage.conversation, membership.usage.analysis
+
+    ledger.open(baseline)
+
+
+def record(membership_id: str, feature_type: str, delta: int = 1, pooled: bool = False):
+    """Add one usage change to the ledger (a no-op when it is disabled or not open).
+
+    pooled marks usage charged to the company quota for the seat membership_id.
+    """
+    ledger.record(POOLED_PREFIX + membership_id if pooled else membership_id, feature_type, delta)
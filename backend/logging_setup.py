@@ -0,0 +1,197 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from metrics import current_route
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")   # text or json
+# "true" hands records to a background thread through a queue, so request threads
+# never wait on console or disk writes; "false" writes inline as before
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_FILE = os.getenv("LOG_FILE", "app.log")    # empty disables the file
+LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", "0"))       # 0: never rotate by size
+LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")                   # e.g. "midnight"; overrides size
+LOG_FLUSH_INTERVAL_MS = int(os.getenv("LOG_FLUSH_INTERVAL_MS", "0"))  # 0: flush every record
+# Keep only this fraction of INFO-and-below lines logged while handling a route, e.g.
+# "/api/v1/usage/check=0.01,/api/v1/usage/start-conversation=0.1"; warnings always pass
+LOG_SAMPLE_ROUTES = os.getenv("LOG_SAMPLE_ROUTES", "")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        route = getattr(record, "route", None)
+        if route:
+            entry["route"] = route
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RouteSampler(logging.Filter):
+    """Drops a share of low-level records from noisy routes, and tags records with their route"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = current_route.get()
+        record.route = route
+        if record.levelno > logging.INFO or route is None:
+            return True
+        rate = self.rates.get(route)
+        return rate is None or random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge msg % args now, as the base class does, so mutable args are logged as they
+        # are at the call rather than when the listener gets to them. Unlike the base
+        # class, the line itself is still formatted on the listener thread, and the
+        # traceback is kept apart for the JSON formatter.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Under a burst, lose log lines rather than block the request
+            pass
+
+
+class _Listener(logging.handlers.QueueListener):
+    """QueueListener that also flushes its handlers whenever the queue goes idle"""
+
+    def __init__(self, log_queue, *handlers, idle_flush: float):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.idle_flush = idle_flush
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(timeout=self.idle_flush)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+
+def _periodic_flush(handler_class):
+    """A stream handler subclass that flushes at most every LOG_FLUSH_INTERVAL_MS"""
+
+    class Handler(handler_class):
+        _last_flush = 0.0
+
+        def flush(self):
+            now = time.monotonic()
+            if now - self._last_flush >= LOG_FLUSH_INTERVAL_MS / 1000:
+                self._last_flush = now
+                super().flush()
+
+        def emit(self, record):
+            super().emit(record)
+            if record.levelno >= logging.ERROR:
+                self._last_flush = 0.0
+                self.flush()
+
+        def close(self):
+            self._last_flush = 0.0
+            super().close()
+
+    return Handler
+
+
+def _file_handler() -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        handler_class, kwargs = logging.handlers.TimedRotatingFileHandler, {
+            "when": LOG_ROTATE_WHEN, "backupCount": LOG_FILE_BACKUPS
+        }
+    elif LOG_FILE_MAX_BYTES > 0:
+        handler_class, kwargs = logging.handlers.RotatingFileHandler, {
+            "maxBytes": LOG_FILE_MAX_BYTES, "backupCount": LOG_FILE_BACKUPS
+        }
+    else:
+        handler_class, kwargs = logging.FileHandler, {}
+    if LOG_FLUSH_INTERVAL_MS > 0:
+        handler_class = _periodic_flush(handler_class)
+    return handler_class(LOG_FILE, encoding="utf-8", **kwargs)
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        route, _, rate = item.rpartition("=")
+        rates[route] = float(rate)
+    return rates
+
+
+def configure_logging():
+    """Set up the root logger from the LOG_* environment variables"""
+    global _listener
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(_file_handler())
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    sampler = RouteSampler(_parse_rates(LOG_SAMPLE_ROUTES))
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if not LOG_ASYNC:
+        for handler in handlers:
+            handler.addFilter(sampler)
+            root.addHandler(handler)
+        return
+
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _QueueHandler(log_queue)
+    # Sample before enqueueing, on the calling thread, where the route is known
+    queue_handler.addFilter(sampler)
+    root.addHandler(queue_handler)
+    idle_flush = LOG_FLUSH_INTERVAL_MS / 1000 if LOG_FLUSH_INTERVAL_MS > 0 else 1.0
+    _listener = _Listener(log_queue, *handlers, idle_flush=idle_flush)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Drain the queue and flush the handlers"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -1,24 +1,95 @@
+import asyncio
 import logging
-from fastapi import FastAPI
-from routes import membership, templates, users, payments, admin, chat
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+import analytics
+import db
+import ledger
+import metrics
+from db import store
+from expiry import run_expiry_scheduler
+from gateway import gateway
+from logging_setup import configure_logging
+from ratelimit import RateLimitMiddleware
+from providers import get_provider, get_speech_provider, get_transcriber
+from routes import membership, templates, users, payments, admin, chat, transcribe
+
+# Configure logging (queue-backed by default; see logging_setup for the LOG_* options)
+configure_logging()
 
 logger = logging.getLogger(__name__)
 
+# Served while the data is still loading (LOAD_MODE=background); everything else waits
+UNGATED_PATHS = {"/", "/health", "/metrics", "/docs", "/redoc", "/openapi.json"}
+
+async def finish_startup(app: FastAPI):
+    """Once the data is loaded, start what needs it and let requests through"""
+    db.start_loading()
+    while not db.is_loaded():
+        await asyncio.sleep(0.05)
+    await asyncio.to_thread(ledger.open_ledger, store)
+    app.state.expiry_task = asyncio.create_task(run_expiry_scheduler(store))
+    app.state.ready.set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = asyncio.Event()
+    app.state.expiry_task = None
+    startup_task = asyncio.create_task(finish_startup(app))
+    analytics_task = asyncio.create_task(analytics.run_analytics_saver())
+    yield
+    startup_task.cancel()
+    if app.state.expiry_task is not None:
+        app.state.expiry_task.cancel()
+    analytics_task.cancel()
+    analytics.save()
+    ledger.ledger.close()
+    await gateway.close()
+    await get_provider().close()
+    await get_speech_provider().close()
+    await get_transcriber().close()
+    # Force out anything the debounced flusher or the journal still holds
+    db.close()
+
 app = FastAPI(
     title="Ringle AI Tutor Backend",
     description="Backend API for Ringle AI Tutor membership management",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
+# Routes declared on the app itself are tagged and counted in flight like the routers' ones
+app.router.route_class = metrics.ProfiledRoute
+
+@app.middleware("http")
+async def wait_for_durable_write(request: Request, call_next):
+    """With an `X-Durable: true` header, respond only once the request's changes are on disk"""
+    response = await call_next(request)
+    if request.headers.get("x-durable", "").lower() == "true":
+        await asyncio.to_thread(db.wait_for_flush)
+    return response
+
+# Rejects over-limit callers before any route work; see ratelimit for the RATE_LIMIT_* options
+app.add_middleware(RateLimitMiddleware)
+
+@app.middleware("http")
+async def wait_for_startup(request: Request, call_next):
+    """Hold requests until the data is loaded, or answer 503 after LOAD_WAIT_SECONDS"""
+    ready = getattr(request.app.state, "ready", None)
+    if ready is not None and not ready.is_set() and request.url.path not in UNGATED_PATHS:
+        try:
+            await asyncio.wait_for(ready.wait(), db.LOAD_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            progress = db.load_progress()
+            detail = "Data failed to load" if progress["state"] == "failed" else "Data is still loading"
+            return JSONResponse(
+                {"detail": detail, "loading": progress}, status_code=503, headers={"Retry-After": "5"}
+            )
+    return await call_next(request)
+
+# Registered last so it wraps everything above, durable waits and 429s included
+app.middleware("http")(metrics.track_request)
 
 app.include_router(membership.router, prefix="/api/v1", tags=["memberships"])
 app.include_router(templates.router, prefix="/api/v1", tags=["templates"])
@@ -26,6 +97,7 @@ app.include_router(users.router, prefix="/api/v1", tags=["users"])
 app.include_router(payments.router, prefix="/api/v1", tags=["payments"])
 app.include_router(admin.router, prefix="/api/v1", tags=["admin"])
 app.include_router(chat.router, prefix="/api/v1", tags=["chat"])
+app.include_router(transcribe.router, prefix="/api/v1", tags=["transcribe"])
 
 @app.get("/")
 def read_root():
@@ -36,7 +108,21 @@ def read_root():
         "docs": "/docs"
     }
 
+@app.get("/metrics")
+def get_metrics():
+    """Request and hot-path timings in Prometheus text format"""
+    return metrics.metrics_response()
+
 @app.get("/health")
-def health_check():
-    """Health check endpoint for Fly.io monitoring"""
-    return {"status": "healthy", "timestamp": "2025-01-17T06:59:32Z"}
\ No newline at end of file
+def health_check(response: Response):
+    """Health check endpoint for Fly.io monitoring; up (200) while data is still loading"""
+    progress = db.load_progress()
+    ready = getattr(app.state, "ready", None)
+    if progress["state"] == "failed":
+        status = "failed"
+        response.status_code = 503
+    elif (ready is not None and not ready.is_set()) or progress["state"] != "ready":
+        status = "loading"
+    else:
+        status = "healthy"
+    return {"status": status, "timestamp": datetime.now(timezone.utc).isoformat(), "loading": progress}
\ No newline at end of file
@@ -0,0 +1,289 @@
+import asyncio
+import cProfile
+import functools
+import inspect
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+# Seconds; roughly log-spaced from sub-millisecond dict lookups to multi-second snapshot writes
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Profile this fraction of requests (0 disables sampling); with PROFILE_ALLOW_HEADER=true an
+# `X-Profile: true` header also profiles one request. Dumps go to PROFILE_DIR as .pstats.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ALLOW_HEADER = os.getenv("PROFILE_ALLOW_HEADER", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense, one per label set"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += seconds
+
+
+_lock = threading.Lock()
+_request_latency: Dict[Tuple[str, str], Histogram] = {}   # (method, route)
+_request_count: Dict[Tuple[str, str, int], int] = {}      # (method, route, status)
+_in_flight: Dict[Tuple[str, str], int] = {}               # (method, route)
+_operation_latency: Dict[str, Histogram] = {}             # operation
+_cache_lookups: Dict[Tuple[str, str], int] = {}           # (cache, hit | miss)
+_cache_size: Dict[str, Tuple[int, int]] = {}              # cache -> (entries, bytes)
+
+# Route template of the request being handled, for log sampling and tagging
+current_route: ContextVar[Optional[str]] = ContextVar("current_route", default=None)
+
+# Profile of the current request, picked up by ProfiledRoute in whichever thread runs the endpoint
+_active_profile: ContextVar[Optional[cProfile.Profile]] = ContextVar("active_profile", default=None)
+
+
+def observe(operation: str, seconds: float):
+    """Record one timing of an internal operation (snapshot write, scan, serialization...)"""
+    with _lock:
+        histogram = _operation_latency.get(operation)
+        if histogram is None:
+            histogram = _operation_latency[operation] = Histogram()
+        histogram.observe(seconds)
+
+
+def count_cache(cache: str, hit: bool):
+    """Record one lookup in a response cache"""
+    key = (cache, "hit" if hit else "miss")
+    with _lock:
+        _cache_lookups[key] = _cache_lookups.get(key, 0) + 1
+
+
+def set_cache_size(cache: str, entries: int, size: int):
+    with _lock:
+        _cache_size[cache] = (entries, size)
+
+
+def cache_stats() -> Dict[str, dict]:
+    """Lookups and current size per cache, for the JSON stats endpoint"""
+    with _lock:
+        stats = {}
+        for cache in {cache for cache, _ in _cache_lookups} | set(_cache_size):
+            hits = _cache_lookups.get((cache, "hit"), 0)
+            misses = _cache_lookups.get((cache, "miss"), 0)
+            entries, size = _cache_size.get(cache, (0, 0))
+            stats[cache] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+                "entries": entries,
+                "bytes": size,
+            }
+        return stats
+
+
+@contextmanager
+def timer(operation: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(operation, time.perf_counter() - started)
+
+
+def timed(operation: str) -> Callable:
+    """Decorator form of timer()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(operation, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def _route_label(request: Request) -> str:
+    # The route template, not the raw path, so ids don't explode the label space; the
+    # router leaves the matched route in the scope
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+def _should_profile(request: Request) -> bool:
+    if PROFILE_ALLOW_HEADER and request.headers.get("x-profile", "").lower() == "true":
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _dump_profile(profile: cProfile.Profile, request: Request) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", request.url.path).strip("-") or "root"
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{slug}-{os.getpid()}-{random.randrange(1 << 32):08x}"
+    path = os.path.join(PROFILE_DIR, name + ".pstats")
+    profile.dump_stats(path)
+    return path
+
+
+async def track_request(request: Request, call_next):
+    """Per-route latency histogram and status counts, plus sampled profiling"""
+    profile = cProfile.Profile() if _should_profile(request) else None
+    token = _active_profile.set(profile) if profile is not None else None
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - started
+        if token is not None:
+            _active_profile.reset(token)
+        # Routing has run by now, whether the request succeeded or not
+        key = (request.method, _route_label(request))
+        with _lock:
+            histogram = _request_latency.get(key)
+            if histogram is None:
+                histogram = _request_latency[key] = Histogram()
+            histogram.observe(elapsed)
+            count_key = key + (status,)
+            _request_count[count_key] = _request_count.get(count_key, 0) + 1
+
+    if profile is not None:
+        response.headers["X-Profile-File"] = await asyncio.to_thread(_dump_profile, profile, request)
+    return response
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute that tags the request with its route and counts it in flight, and runs
+    the endpoint under the request's sampled profiler, if any.
+
+    cProfile only sees the thread it is enabled in, and sync endpoints run in the
+    threadpool, so the profiler has to be switched on inside the endpoint call itself.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        # include_router re-creates each route from the already wrapped endpoint
+        if not getattr(endpoint, "_profiled", False):
+            endpoint = _profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        label = self.path
+
+        async def tracked_handler(request: Request) -> Response:
+            key = (request.method, label)
+            current_route.set(label)
+            with _lock:
+                _in_flight[key] = _in_flight.get(key, 0) + 1
+            try:
+                return await handler(request)
+            finally:
+                with _lock:
+                    _in_flight[key] -= 1
+        return tracked_handler
+
+
+def _profiled(endpoint: Callable) -> Callable:
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            profile = _active_profile.get()
+            if profile is None:
+                return await endpoint(*args, **kwargs)
+            profile.enable()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                profile.disable()
+        async_wrapper._profiled = True
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        profile = _active_profile.get()
+        if profile is None:
+            return endpoint(*args, **kwargs)
+        profile.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            profile.disable()
+    wrapper._profiled = True
+    return wrapper
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def _histogram_lines(name: str, histogram: Histogram, labels: str) -> list:
+    prefix = labels + "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    cumulative += histogram.counts[-1]
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+    lines.append(f"{name}_count{{{labels}}} {cumulative}")
+    return lines
+
+
+def render() -> str:
+    """Everything recorded so far in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        lines.append("# HELP http_request_duration_seconds Request latency by route")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for (method, route), histogram in sorted(_request_latency.items()):
+            lines.extend(_histogram_lines("http_request_duration_seconds", histogram, _labels(method=method, route=route)))
+
+        lines.append("# HELP http_requests_total Requests by route and status code")
+        lines.append("# TYPE http_requests_total counter")
+        for (method, route, status), count in sorted(_request_count.items()):
+            lines.append(f"http_requests_total{{{_labels(method=method, route=route, status=status)}}} {count}")
+
+        lines.append("# HELP http_requests_in_flight Requests currently being handled")
+        lines.append("# TYPE http_requests_in_flight gauge")
+        for (method, route), count in sorted(_in_flight.items()):
+            lines.append(f"http_requests_in_flight{{{_labels(method=method, route=route)}}} {count}")
+
+        lines.append("# HELP operation_duration_seconds Latency of internal hot paths")
+        lines.append("# TYPE operation_duration_seconds histogram")
+        for operation, histogram in sorted(_operation_latency.items()):
+            lines.extend(_histogram_lines("operation_duration_seconds", histogram, _labels(operation=operation)))
+
+        lines.append("# HELP cache_lookups_total Response cache lookups by result")
+        lines.append("# TYPE cache_lookups_total counter")
+        for (cache, result), count in sorted(_cache_lookups.items()):
+            lines.append(f"cache_lookups_total{{{_labels(cache=cache, result=result)}}} {count}")
+
+        lines.append("# HELP cache_entries Entries currently held by a response cache")
+        lines.append("# TYPE cache_entries gauge")
+        for cache, (entries, _) in sorted(_cache_size.items()):
+            lines.append(f"cache_entries{{{_labels(cache=cache)}}} {entries}")
+        lines.append("# HELP cache_bytes Bytes currently held by a response cache")
+        lines.append("# TYPE cache_bytes gauge")
+        for cache, (_, size) in sorted(_cache_size.items()):
+            lines.append(f"cache_bytes{{{_labels(cache=cache)}}} {size}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_response() -> Response:
+    return Response(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import random
+from collections import OrderedDict
+from typing import Optional
+from uuid import uuid4
+from fastapi import FastAPI, Header, HTTPException
+from pydantic import BaseModel
+
+# Stand-in for the real payment gateway. gateway.py talks to it in-process when
+# PAYMENT_GATEWAY_URL is unset; it can also run on its own:
+#   MOCK_GATEWAY_LATENCY_MS=200 uvicorn mock_gateway:app --port 9000
+MOCK_GATEWAY_LATENCY_MS = float(os.getenv("MOCK_GATEWAY_LATENCY_MS", "0"))
+MOCK_GATEWAY_JITTER_MS = float(os.getenv("MOCK_GATEWAY_JITTER_MS", "0"))
+MOCK_GATEWAY_FAILURE_RATE = float(os.getenv("MOCK_GATEWAY_FAILURE_RATE", "0"))
+
+app = FastAPI(title="Mock Payment Gateway")
+
+# Idempotency-Key -> response, so a retried charge isn't charged twice
+_charges: "OrderedDict[str, dict]" = OrderedDict()
+_MAX_REMEMBERED_CHARGES = 10000
+
+
+class ChargeRequest(BaseModel):
+    payment_method: str
+    amount: float
+    currency: str = "USD"
+
+
+def configure(latency_ms: Optional[float] = None, jitter_ms: Optional[float] = None,
+              failure_rate: Optional[float] = None):
+    """Change the simulated behaviour at runtime (benchmarks)"""
+    global MOCK_GATEWAY_LATENCY_MS, MOCK_GATEWAY_JITTER_MS, MOCK_GATEWAY_FAILURE_RATE
+    if latency_ms is not None:
+        MOCK_GATEWAY_LATENCY_MS = latency_ms
+    if jitter_ms is not None:
+        MOCK_GATEWAY_JITTER_MS = jitter_ms
+    if failure_rate is not None:
+        MOCK_GATEWAY_FAILURE_RATE = failure_rate
+
+
+@app.post("/charges")
+async def create_charge(charge: ChargeRequest, idempotency_key: Optional[str] = Header(None)):
+    delay = MOCK_GATEWAY_LATENCY_MS + random.uniform(0, MOCK_GATEWAY_JITTER_MS)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if random.random() < MOCK_GATEWAY_FAILURE_RATE:
+        raise HTTPException(status_code=503, detail="Gateway temporarily unavailable")
+
+    if idempotency_key is not None and idempotency_key in _charges:
+        return _charges[idempotency_key]
+    result = {
+        "success": True,
+        "transaction_id": f"txn_{uuid4()}",
+        "message": "Payment processed successfully"
+    }
+    if idempotency_key is not None:
+        _charges[idempotency_key] = result
+        if len(_charges) > _MAX_REMEMBERED_CHARGES:
+            _charges.popitem(last=False)
+    return result
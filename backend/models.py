@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Literal, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
@@ -78,12 +78,54 @@ class MembershipAssignment(BaseModel):
     template_id: str
     assigned_by: str  # Admin ID
 
+class BulkMembershipAssignment(BaseModel):
+    template_id: str
+    assigned_by: str  # Admin ID
+    # Exactly one of: every user of a B2B company, or these users
+    company_id: Optional[str] = None
+    user_ids: Optional[list[str]] = Field(None, max_length=100000)
+    # Leave out users who already hold an active membership of this template
+    skip_existing: bool = True
+
+class CompanyQuota(BaseModel):
+    company_id: str
+    limits: FeatureLimit  # pool shared by every user of the company; None = unlimited
+    usage: FeatureUsage = FeatureUsage()
+
+class CompanyQuotaUpdate(BaseModel):
+    limits: FeatureLimit
+    reset_usage: bool = False
+
+class QuotaAllocation(BaseModel):
+    company_id: str
+    user_id: str
+    # This user's cap within the pool; None = limited by the pool alone
+    limits: FeatureLimit = FeatureLimit(conversation=None, analysis=None)
+    usage: FeatureUsage = FeatureUsage()
+
+class QuotaAllocationUpdate(BaseModel):
+    limits: FeatureLimit
+
+class LedgerRestore(BaseModel):
+    at: datetime  # reset usage counters to what the ledger says they were at this time
+    dry_run: bool = True
+
 class PaymentRequest(BaseModel):
     user_id: str
     template_id: str
     payment_method: str
     amount: float
 
+class IdempotencyRecord(BaseModel):
+    key: str
+    fingerprint: str  # hash of the request the key was first used with
+    created_at: float  # unix timestamp
+    status_code: Optional[int] = None  # None while the first request is still running
+    body: Optional[str] = None
+
 class UsageUpdate(BaseModel):
     feature_type: str
     user_id: str
+
+class UsageBatch(BaseModel):
+    updates: list[UsageUpdate] = Field(max_length=5000)
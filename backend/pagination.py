@@ -0,0 +1,56 @@
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from pydantic_core import to_json
+from metrics import observe
+
+NDJSON = "application/x-ndjson"
+MAX_PAGE_SIZE = 1000
+
+T = TypeVar("T", bound=BaseModel)
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get("accept", "")
+
+
+def ndjson_response(rows: Iterator[BaseModel], batch_size: int = 200) -> StreamingResponse:
+    """Stream rows as newline-delimited JSON, serializing a batch at a time"""
+    def generate():
+        batch = []
+        started = time.perf_counter()
+        for row in rows:
+            # Exports touch every row once; keep them out of the serialization cache
+            batch.append(to_json(row))
+            if len(batch) == batch_size:
+                chunk = b"\n".join(batch) + b"\n"
+                observe("serialize_ndjson_batch", time.perf_counter() - started)
+                yield chunk
+                batch = []
+                started = time.perf_counter()
+        if batch:
+            chunk = b"\n".join(batch) + b"\n"
+            observe("serialize_ndjson_batch", time.perf_counter() - started)
+            yield chunk
+
+    return StreamingResponse(generate(), media_type=NDJSON)
+
+
+def paginate(
+    scan: Callable[[int, int], Tuple[List[T], Optional[int]]],
+    limit: int,
+    cursor: Optional[str]
+) -> Tuple[List[T], Dict[str, str]]:
+    """Fetch one page via a Store.scan_* call, plus the X-Next-Cursor header for the next"""
+    try:
+        after = int(cursor) if cursor else 0
+    except ValueError:
+        after = -1
+    if after < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    items, next_position = scan(after, limit)
+    headers = {} if next_position is None else {"X-Next-Cursor": str(next_position)}
+    return items, headers
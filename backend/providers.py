@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import struct
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional
+import httpx
+
+# "local" answers deterministically without any network access (tests, benchmarks,
+# offline development); "openai" streams from the OpenAI chat completions API
+CHAT_PROVIDER = os.getenv("CHAT_PROVIDER", "local")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o")
+CHAT_LOCAL_TOKEN_DELAY_MS = float(os.getenv("CHAT_LOCAL_TOKEN_DELAY_MS", "0"))
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+# Text-to-speech: "local" returns silent WAV audio of a plausible length, offline
+TTS_PROVIDER = os.getenv("TTS_PROVIDER", "local")
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+# Speech-to-text: "local" returns canned sentences, optionally after a simulated delay
+# of this many seconds per second of audio; "openai" uses Whisper
+TRANSCRIBER = os.getenv("TRANSCRIBER", "local")
+TRANSCRIBE_MODEL = os.getenv("TRANSCRIBE_MODEL", "whisper-1")
+TRANSCRIBE_LOCAL_REALTIME_FACTOR = float(os.getenv("TRANSCRIBE_LOCAL_REALTIME_FACTOR", "0"))
+
+# Same tutor persona as the frontend's app/api/chat/route.ts
+SYSTEM_PROMPT = """You are an expert English tutor and conversation practice helper. Your role is to help students improve their English speaking skills through guided conversation practice.
+
+IMPORTANT GUIDELINES:
+1. **Engage in natural conversation** - Ask follow-up questions, show interest, and keep the conversation flowing naturally
+2. **Provide gentle corrections** - When you notice grammar, pronunciation, or vocabulary issues, politely correct them with explanations
+3. **Give constructive feedback** - Praise good usage and suggest improvements for areas that need work
+4. **Adapt to skill level** - Match your language complexity to the student's proficiency level
+5. **Encourage practice** - Suggest topics, ask for elaboration, and create opportunities for the student to speak more
+6. **Be encouraging** - Always be supportive and positive, even when correcting mistakes
+
+Keep responses conversational (2-3 sentences) and focus on creating a supportive learning environment."""
+
+Message = Dict[str, str]  # {"role": ..., "content": ...}
+
+
+class ChatProvider(ABC):
+    """A model that streams a reply to a conversation, a text fragment at a time"""
+
+    name: str
+
+    @abstractmethod
+    def stream(self, messages: List[Message], system: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+        """Yield reply fragments as the model produces them; the stream is closed early on disconnect"""
+
+    async def close(self):
+        """Release pooled connections; called on app shutdown"""
+
+
+class LocalProvider(ChatProvider):
+    """Deterministic offline tutor: the same conversation always streams the same tokens"""
+
+    name = "local"
+
+    def __init__(self, token_delay_ms: float = CHAT_LOCAL_TOKEN_DELAY_MS):
+        self.token_delay = token_delay_ms / 1000
+
+    def reply(self, messages: List[Message]) -> str:
+        last_message = messages[-1]["content"] if messages else ""
+        return f"You said: \"{last_message}\". This is a placeholder AI response. I am still under development."
+
+    async def stream(self, messages: List[Message], system: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+        # Word-sized fragments, whitespace attached, like a real token stream
+        for token in re.findall(r"\S+\s*", self.reply(messages)):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield token
+
+
+class OpenAIProvider(ChatProvider):
+    """Streams from the OpenAI chat completions API over a shared connection pool"""
+
+    name = "openai"
+
+    def __init__(self, model: str = CHAT_MODEL):
+        self.model = model
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=OPENAI_BASE_URL,
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                timeout=httpx.Timeout(60, connect=5)
+            )
+        return self._client
+
+    async def stream(self, messages: List[Message], system: str = SYSTEM_PROMPT) -> AsyncIterator[str]:
+        body = {
+            "model": self.model,
+            "stream": True,
+            "messages": [{"role": "system", "content": system}] + messages,
+        }
+        async with self._http().stream("POST", "/chat/completions", json=body) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0]["delta"].get("content")
+                if delta:
+                    yield delta
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class SpeechProvider(ABC):
+    """Turns tutor text into audio"""
+
+    name: str
+    model: str
+    media_type: str
+
+    @abstractmethod
+    async def synthesize(self, text: str, voice: str) -> bytes:
+        """Complete audio file for text"""
+
+    async def close(self):
+        """Release pooled connections; called on app shutdown"""
+
+
+class LocalSpeechProvider(SpeechProvider):
+    """Silent 16 kHz mono WAV, about as long as reading the text aloud would take"""
+
+    name = "local"
+    model = "silence"
+    media_type = "audio/wav"
+    SAMPLE_RATE = 16000
+    SECONDS_PER_CHARACTER = 0.06
+
+    async def synthesize(self, text: str, voice: str) -> bytes:
+        samples = int(len(text) * self.SECONDS_PER_CHARACTER * self.SAMPLE_RATE)
+        data_size = samples * 2
+        header = struct.pack(
+            "<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, 1,
+            self.SAMPLE_RATE, self.SAMPLE_RATE * 2, 2, 16, b"data", data_size
+        )
+        return header + bytes(data_size)
+
+
+class OpenAISpeechProvider(SpeechProvider):
+    """The OpenAI speech API, as the frontend's /api/tts route calls it"""
+
+    name = "openai"
+    media_type = "audio/mpeg"
+
+    def __init__(self, model: str = TTS_MODEL):
+        self.model = model
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def synthesize(self, text: str, voice: str) -> bytes:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=OPENAI_BASE_URL,
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                timeout=httpx.Timeout(60, connect=5)
+            )
+        response = await self._client.post("/audio/speech", json={"model": self.model, "input": text, "voice": voice})
+        response.raise_for_status()
+        return response.content
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class Transcriber(ABC):
+    """Turns a clip of the learner's speech into text"""
+
+    name: str
+    model: str
+
+    @abstractmethod
+    async def transcribe(self, audio: bytes, media_type: str) -> str:
+        """Text of one complete audio file (a WAV segment, or a whole recording)"""
+
+    async def close(self):
+        """Release pooled connections; called on app shutdown"""
+
+
+class LocalTranscriber(Transcriber):
+    """Offline stub: the same audio always yields the same sentence from the frontend's mock list"""
+
+    name = "local"
+    model = "stub"
+    PHRASES = (
+        "Hello, this is a test transcription.",
+        "I am practicing my English speaking skills.",
+        "This is a mock response for development purposes.",
+        "The weather is nice today.",
+        "I would like to improve my conversation skills.",
+        "Thank you for helping me practice English.",
+    )
+    BYTES_PER_SECOND = 32000  # 16 kHz, 16-bit mono
+
+    def __init__(self, realtime_factor: float = TRANSCRIBE_LOCAL_REALTIME_FACTOR):
+        self.realtime_factor = realtime_factor
+
+    async def transcribe(self, audio: bytes, media_type: str) -> str:
+        if self.realtime_factor:
+            await asyncio.sleep(len(audio) / self.BYTES_PER_SECOND * self.realtime_factor)
+        return self.PHRASES[hashlib.sha256(audio).digest()[0] % len(self.PHRASES)]
+
+
+class OpenAITranscriber(Transcriber):
+    """Whisper through the OpenAI transcriptions API, with the frontend's English-only hints"""
+
+    name = "openai"
+    EXTENSIONS = {"audio/wav": "wav", "audio/webm": "webm", "audio/ogg": "ogg", "audio/mpeg": "mp3", "audio/mp4": "m4a"}
+
+    def __init__(self, model: str = TRANSCRIBE_MODEL):
+        self.model = model
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def transcribe(self, audio: bytes, media_type: str) -> str:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=OPENAI_BASE_URL,
+                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                timeout=httpx.Timeout(60, connect=5)
+            )
+        filename = f"audio.{self.EXTENSIONS.get(media_type, 'webm')}"
+        response = await self._client.post(
+            "/audio/transcriptions",
+            files={"file": (filename, audio, media_type)},
+            data={
+                "model": self.model,
+                "language": "en",
+                "prompt": "This is an English conversation for language learning.",
+            }
+        )
+        response.raise_for_status()
+        return response.json()["text"]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_PROVIDERS = {"local": LocalProvider, "openai": OpenAIProvider}
+_SPEECH_PROVIDERS = {"local": LocalSpeechProvider, "openai": OpenAISpeechProvider}
+_TRANSCRIBERS = {"local": LocalTranscriber, "openai": OpenAITranscriber}
+_provider: Optional[ChatProvider] = None
+_speech_provider: Optional[SpeechProvider] = None
+_transcriber: Optional[Transcriber] = None
+
+
+def get_provider() -> ChatProvider:
+    """The process-wide provider chosen by CHAT_PROVIDER"""
+    global _provider
+    if _provider is None:
+        _provider = _PROVIDERS[CHAT_PROVIDER]()
+    return _provider
+
+
+def set_provider(provider: ChatProvider):
+    """Swap in another provider (tests, benchmarks, custom integrations)"""
+    global _provider
+    _provider = provider
+
+
+def get_speech_provider() -> SpeechProvider:
+    """The process-wide text-to-speech provider chosen by TTS_PROVIDER"""
+    global _speech_provider
+    if _speech_provider is None:
+        _speech_provider = _SPEECH_PROVIDERS[TTS_PROVIDER]()
+    return _speech_provider
+
+
+def get_transcriber() -> Transcriber:
+    """The process-wide speech-to-text provider chosen by TRANSCRIBER"""
+    global _transcriber
+    if _transcriber is None:
+        _transcriber = _TRANSCRIBERS[TRANSCRIBER]()
+    return _transcriber
+
+
+def set_transcriber(transcriber: Transcriber):
+    """Swap in another transcriber (tests, benchmarks, custom integrations)"""
+    global _transcriber
+    _transcriber = transcriber
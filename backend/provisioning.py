@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+import analytics
+from models import CustomerType, FeatureUsage, Membership, MembershipStatus, MembershipTemplate, User
+from storage import Store
+
+logger = logging.getLogger(__name__)
+
+# Bulk assignments to more users than this run as a background job instead of in the request
+BULK_ASSIGN_BACKGROUND_THRESHOLD = int(os.getenv("BULK_ASSIGN_BACKGROUND_THRESHOLD", "1000"))
+# Users per progress line / status update
+BULK_ASSIGN_PROGRESS_EVERY = int(os.getenv("BULK_ASSIGN_PROGRESS_EVERY", "500"))
+# How long a finished job stays visible to the status endpoint
+BULK_ASSIGN_JOB_TTL_SECONDS = float(os.getenv("BULK_ASSIGN_JOB_TTL_SECONDS", "3600"))
+
+# Skipped users listed by id in a job's status; beyond this only the counts are kept
+MAX_LISTED_SKIPS = 100
+
+
+def resolve_users(
+    store: Store, company_id: Optional[str], user_ids: Optional[List[str]]
+) -> Tuple[List[User], List[str]]:
+    """The users to provision, in order, plus requested ids that don't exist"""
+    if company_id is not None:
+        return store.users_for_company(company_id), []
+    users, missing = [], []
+    for user_id in dict.fromkeys(user_ids):
+        user = store.get_user(user_id)
+        if user is None:
+            missing.append(user_id)
+        else:
+            users.append(user)
+    return users, missing
+
+
+class BulkAssignmentJob:
+    """One template assigned to many users.
+
+    run() builds every membership in a single pass, yielding progress as it goes, then
+    saves them all with one save_memberships call, so the store persists once and a
+    failure part-way leaves nothing half-assigned.
+    """
+
+    def __init__(self, store: Store, template: MembershipTemplate, users: List[User],
+                 missing: List[str], assigned_by: str, skip_existing: bool = True):
+        self.id = str(uuid4())
+        self.store = store
+        self.template = template
+        self.users = users
+        self.missing = missing
+        self.assigned_by = assigned_by
+        self.skip_existing = skip_existing
+        self.status = "pending"
+        self.total = len(users) + len(missing)
+        self.processed = 0
+        self.assigned = 0
+        self.skip_reasons: Dict[str, int] = {}
+        self.skipped_users: List[dict] = []
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def skipped(self) -> int:
+        return sum(self.skip_reasons.values())
+
+    def _skip(self, user_id: str, reason: str):
+        self.skip_reasons[reason] = self.skip_reasons.get(reason, 0) + 1
+        if len(self.skipped_users) < MAX_LISTED_SKIPS:
+            self.skipped_users.append({"user_id": user_id, "reason": reason})
+
+    def _ineligible(self, user: User) -> Optional[str]:
+        # Same rule as the single assign-membership route
+        if user.customer_type == CustomerType.B2C and self.template.customer_type != CustomerType.B2C:
+            return "B2B template on a B2C customer"
+        if self.skip_existing and any(
+            membership.template_id == self.template.id and membership.status == MembershipStatus.ACTIVE
+            for membership in self.store.memberships_for_user(user.id)
+        ):
+            return "already has an active membership of this template"
+        return None
+
+    def progress(self) -> dict:
+        return {
+            "type": "progress", "job_id": self.id, "processed": self.processed, "total": self.total,
+            "assigned": self.assigned, "skipped": self.skipped
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "template_id": self.template.id,
+            "assigned_by": self.assigned_by,
+            "total": self.total,
+            "processed": self.processed,
+            "assigned": self.assigned,
+            "skipped": self.skipped,
+            "skip_reasons": dict(self.skip_reasons),
+            "skipped_users": list(self.skipped_users),
+            "error": self.error,
+            "submitted_at": datetime.fromtimestamp(self.submitted_at, timezone.utc).isoformat(),
+            "finished_at": None if self.finished_at is None
+            else datetime.fromtimestamp(self.finished_at, timezone.utc).isoformat(),
+        }
+
+    def run(self) -> Iterator[dict]:
+        """Progress dicts every BULK_ASSIGN_PROGRESS_EVERY users, then the final status"""
+        self.status = "running"
+        started = time.perf_counter()
+        try:
+            for user_id in self.missing:
+                self._skip(user_id, "user not found")
+                self.processed += 1
+
+            now = datetime.now(timezone.utc)
+            expires_at = now + timedelta(days=self.template.duration_days)
+            memberships = []
+            companies = {user.id: user.company_id for user in self.users}
+            for user in self.users:
+                reason = self._ineligible(user)
+                if reason is None:
+                    memberships.append(Membership(
+                        id=str(uuid4()),
+                        user_id=user.id,
+                        name=self.template.name,
+                        expires_at=expires_at,
+                        limits=self.template.limits,
+                        customer_type=user.customer_type,
+                        template_id=self.template.id,
+                        status=MembershipStatus.ACTIVE,
+                        usage=FeatureUsage(),
+                        created_at=now
+                    ))
+                    self.assigned += 1
+                else:
+                    self._skip(user.id, reason)
+                self.processed += 1
+                if self.processed % BULK_ASSIGN_PROGRESS_EVERY == 0:
+                    yield self.progress()
+
+            self.status = "saving"
+            self.store.save_memberships(memberships)
+            self.status = "completed"
+            created = Counter((membership.customer_type, companies[membership.user_id]) for membership in memberships)
+            for (customer_type, company_id), count in created.items():
+                analytics.record_created(self.template.id, customer_type, company_id, count=count)
+            logger.info(
+                "Bulk-assigned %s to %d users (%d skipped) in %.2fs",
+                self.template.id, self.assigned, self.skipped, time.perf_counter() - started
+            )
+        except Exception as exc:
+            logger.exception("Bulk assignment %s failed", self.id)
+            self.status = "failed"
+            self.assigned = 0
+            self.error = repr(exc)
+        finally:
+            self.finished_at = time.time()
+            # Only the counts are needed from here on
+            self.users = []
+        yield {"type": "done", **self.to_dict()}
+
+
+_jobs: Dict[str, BulkAssignmentJob] = {}
+_jobs_lock = threading.Lock()
+# One job at a time: each ends in a write of the whole batch
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk-assign")
+
+
+def _drain(job: BulkAssignmentJob):
+    for _ in job.run():
+        pass
+
+
+def submit(job: BulkAssignmentJob):
+    """Run job in the background; its progress is read back with get_job"""
+    cutoff = time.time() - BULK_ASSIGN_JOB_TTL_SECONDS
+    with _jobs_lock:
+        for job_id in [
+            job_id for job_id, old in _jobs.items() if old.finished_at is not None and old.finished_at < cutoff
+        ]:
+            del _jobs[job_id]
+        _jobs[job.id] = job
+    _executor.submit(_drain, job)
+
+
+def get_job(job_id: str) -> Optional[BulkAssignmentJob]:
+    with _jobs_lock:
+        return _jobs.get(job_id)
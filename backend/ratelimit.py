@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import logging
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from itertools import islice
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated `path-prefix=key:limit/seconds[:algorithm]` policies, longest prefix wins.
+# key is `user` (the RATE_LIMIT_USER_HEADER user id, else the caller's IP) or `ip`;
+# algorithm is `sliding` (sliding window, the default) or `bucket` (token bucket).
+# Empty disables limiting.
+RATE_LIMITS = os.getenv(
+    "RATE_LIMITS",
+    "/api/v1/usage/=user:120/60,"
+    "/api/v1/payments/process=user:10/60,"
+    "/api/v1/chat=user:30/60,"
+    "/api/v1/tts=user:60/60,"
+    "/api/v1/transcribe=ip:15/60"
+)
+# memory: this process only; sqlite / shm: shared by every worker on the machine
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", os.path.join(os.getenv("DATA_DIR", "."), "rate_limits.sqlite3"))
+RATE_LIMIT_SHM_PATH = os.getenv(
+    "RATE_LIMIT_SHM_PATH", "/dev/shm/ringle-rate-limits" if os.path.isdir("/dev/shm") else "rate_limits.shm"
+)
+RATE_LIMIT_SHM_SLOTS = int(os.getenv("RATE_LIMIT_SHM_SLOTS", "65536"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Proxies in front of the app that append the caller's address to X-Forwarded-For; the
+# caller is that many entries from the right. 0 keys on the connecting address, which is
+# the proxy itself when there is one, so every caller behind it would share one limit.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# Header carrying the authenticated user id, set by a trusted proxy that also drops any
+# copy the client sent (e.g. X-User-Id). Empty: `user` policies count by IP, since a
+# header the client controls could be rotated to dodge the limit.
+RATE_LIMIT_USER_HEADER = os.getenv("RATE_LIMIT_USER_HEADER", "").lower().encode("latin-1")
+
+State = Tuple[float, float, float]
+EMPTY: State = (0.0, 0.0, 0.0)
+Apply = Callable[[State], Tuple[bool, float, State]]
+
+
+def sliding_window(state: State, now: float, limit: int, window: float) -> Tuple[bool, float, State]:
+    """Sliding window counter: this window's count plus the previous one's, weighted by overlap.
+
+    state is (current window start, its count, the previous window's count).
+    """
+    start, count, previous = state
+    current = now - now % window
+    if current != start:
+        previous = count if current - start == window else 0.0
+        count = 0.0
+        start = current
+    elapsed = now - current
+    if previous * (1 - elapsed / window) + count + 1 <= limit:
+        return True, 0.0, (start, count + 1, previous)
+    if previous and count + 1 <= limit:
+        # Wait until enough of the previous window has slid out
+        retry_after = window * (1 - (limit - count - 1) / previous) - elapsed
+    else:
+        retry_after = window - elapsed
+    return False, max(retry_after, 0.0), (start, count, previous)
+
+
+def token_bucket(state: State, now: float, limit: int, window: float) -> Tuple[bool, float, State]:
+    """Token bucket of `limit` tokens refilled over `window`; state is (tokens, updated at, unused)"""
+    tokens, updated, _ = state
+    rate = limit / window
+    tokens = limit if not updated else min(limit, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return True, 0.0, (tokens - 1, now, 0.0)
+    return False, (1 - tokens) / rate, (tokens, now, 0.0)
+
+
+ALGORITHMS = {"sliding": sliding_window, "bucket": token_bucket}
+
+
+class Policy(NamedTuple):
+    prefix: str
+    key: str          # "user" or "ip"
+    limit: int
+    window: float
+    algorithm: Callable
+
+
+def parse_policies(spec: str) -> List[Policy]:
+    policies = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        prefix, _, rule = item.partition("=")
+        key, _, rest = rule.partition(":")
+        rate, _, algorithm = rest.partition(":")
+        limit, _, window = rate.partition("/")
+        if key not in ("user", "ip") or (algorithm or "sliding") not in ALGORITHMS:
+            raise ValueError(f"Invalid rate limit policy: {item}")
+        policies.append(Policy(prefix, key, int(limit), float(window), ALGORITHMS[algorithm or "sliding"]))
+    # Longest prefix first, so the most specific policy matches
+    return sorted(policies, key=lambda policy: len(policy.prefix), reverse=True)
+
+
+class RateLimitStore(ABC):
+    """Holds each key's limiter state and applies updates to it atomically"""
+
+    # Whether update() can wait on disk or other processes, so callers keep it off the event loop
+    blocking = True
+
+    @abstractmethod
+    def update(self, key: str, apply: Apply) -> Tuple[bool, float]:
+        """Run apply on key's state and save the new state; returns (allowed, retry after)"""
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Dict of states in this process; the least recently used keys go past max_keys"""
+
+    # A dict update under a lock; a thread hop would cost far more
+    blocking = False
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._states: Dict[str, State] = {}
+        self._lock = threading.Lock()
+
+    def update(self, key: str, apply: Apply) -> Tuple[bool, float]:
+        with self._lock:
+            # Re-inserting keeps the dict in least-recently-used order
+            allowed, retry_after, self._states[key] = apply(self._states.pop(key, EMPTY))
+            if len(self._states) > self.max_keys:
+                for old_key in list(islice(self._states, len(self._states) // 10)):
+                    del self._states[old_key]
+        return allowed, retry_after
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """States in a small SQLite database, so every worker process shares the limits"""
+
+    def __init__(self, path: str = RATE_LIMIT_SQLITE_PATH, idle_seconds: float = 3600):
+        self.idle_seconds = idle_seconds
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Limits are not worth an fsync per request
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, a REAL, b REAL, c REAL, touched REAL)"
+        )
+        self._lock = threading.Lock()
+        self._updates = 0
+
+    def update(self, key: str, apply: Apply) -> Tuple[bool, float]:
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT a, b, c FROM rate_limits WHERE key = ?", (key,)).fetchone()
+                allowed, retry_after, state = apply(row or EMPTY)
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limits (key, a, b, c, touched) VALUES (?, ?, ?, ?, ?)",
+                    (key, *state, time.time())
+                )
+                self._updates += 1
+                if self._updates % 10000 == 0:
+                    conn.execute("DELETE FROM rate_limits WHERE touched < ?", (time.time() - self.idle_seconds,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return allowed, retry_after
+
+
+class SharedMemoryRateLimitStore(RateLimitStore):
+    """Fixed-size hash table in a memory-mapped file, shared by the workers on one machine.
+
+    Each slot holds a key hash, the state and when it was last touched. A key probes a
+    few slots from its hash; when all are taken the least recently touched is reused,
+    so a full table forgets idle keys rather than failing. Access is serialized with
+    flock across processes and a lock within this one.
+    """
+
+    SLOT = struct.Struct("<Q4d")
+    PROBES = 8
+    # The flock is held for a few slot reads and one write, microseconds even when contended
+    blocking = False
+
+    def __init__(self, path: str = RATE_LIMIT_SHM_PATH, slots: int = RATE_LIMIT_SHM_SLOTS):
+        import fcntl
+        self._fcntl = fcntl
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _hash(self, key: str) -> int:
+        # Stable across processes, unlike hash(); 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def update(self, key: str, apply: Apply) -> Tuple[bool, float]:
+        key_hash = self._hash(key)
+        first = key_hash % self.slots
+        with self._lock:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+            try:
+                target, state, oldest = None, EMPTY, None
+                for probe in range(self.PROBES):
+                    offset = (first + probe) % self.slots * self.SLOT.size
+                    slot_hash, a, b, c, touched = self.SLOT.unpack_from(self._map, offset)
+                    if slot_hash == key_hash:
+                        target, state = offset, (a, b, c)
+                        break
+                    if slot_hash == 0:
+                        target = offset
+                        break
+                    if oldest is None or touched < oldest[1]:
+                        oldest = (offset, touched)
+                if target is None:
+                    target = oldest[0]
+                allowed, retry_after, state = apply(state)
+                self.SLOT.pack_into(self._map, target, key_hash, *state, time.time())
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+        return allowed, retry_after
+
+
+class RateLimiter:
+    """Per-route policies over one store"""
+
+    def __init__(self, policies: List[Policy], store: RateLimitStore):
+        self.policies = policies
+        self.store = store
+
+    def match(self, path: str) -> Optional[Policy]:
+        for policy in self.policies:
+            if path.startswith(policy.prefix):
+                return policy
+        return None
+
+    def hit(self, policy: Policy, identity: str, now: Optional[float] = None) -> Tuple[bool, float]:
+        """Count one request by identity against policy"""
+        now = time.time() if now is None else now
+        return self.store.update(
+            f"{policy.prefix}|{identity}",
+            lambda state: policy.algorithm(state, now, policy.limit, policy.window)
+        )
+
+
+def _open_store(policies: List[Policy]) -> RateLimitStore:
+    if RATE_LIMIT_STORE == "sqlite":
+        longest_window = max((policy.window for policy in policies), default=60)
+        return SQLiteRateLimitStore(idle_seconds=2 * longest_window)
+    if RATE_LIMIT_STORE == "shm":
+        return SharedMemoryRateLimitStore()
+    return MemoryRateLimitStore()
+
+
+def _identity(scope, policy: Policy) -> str:
+    if policy.key == "user" and RATE_LIMIT_USER_HEADER:
+        for name, value in scope["headers"]:
+            if name == RATE_LIMIT_USER_HEADER and value:
+                return "user:" + value.decode("latin-1")
+    if RATE_LIMIT_TRUSTED_PROXIES:
+        forwarded = []
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                forwarded += [address.strip() for address in value.decode("latin-1").split(",")]
+        # Entries left of the ones our proxies appended were sent by the caller and prove nothing
+        if len(forwarded) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return "ip:" + forwarded[-RATE_LIMIT_TRUSTED_PROXIES]
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class RateLimitMiddleware:
+    """Answers 429 with Retry-After once a caller exceeds its route's policy.
+
+    Plain ASGI rather than an http middleware function, to keep the per-request cost to
+    a prefix match and one store update. Updates to the sqlite store run in a worker
+    thread, since they can wait on its file lock and disk.
+    """
+
+    def __init__(self, app, limiter: Optional["RateLimiter"] = None):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        limiter = self.limiter or get_limiter()
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or not limiter.policies:
+            return await self.app(scope, receive, send)
+        policy = limiter.match(scope["path"])
+        if policy is None:
+            return await self.app(scope, receive, send)
+        if limiter.store.blocking:
+            allowed, retry_after = await asyncio.to_thread(limiter.hit, policy, _identity(scope, policy))
+        else:
+            allowed, retry_after = limiter.hit(policy, _identity(scope, policy))
+        if allowed:
+            return await self.app(scope, receive, send)
+        response = JSONResponse(
+            {"detail": "Rate limit exceeded"}, status_code=429, headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+        await response(scope, receive, send)
+
+
+_limiter: Optional[RateLimiter] = None
+
+
+def get_limiter() -> RateLimiter:
+    """The process-wide limiter configured by RATE_LIMITS and RATE_LIMIT_STORE"""
+    global _limiter
+    if _limiter is None:
+        policies = parse_policies(RATE_LIMITS)
+        _limiter = RateLimiter(policies, _open_store(policies))
+    return _limiter
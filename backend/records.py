@@ -0,0 +1,184 @@
+import sys
+from datetime import datetime, tzinfo
+from typing import Dict, Optional, Tuple
+from models import (
+    CustomerType, FeatureLimit, FeatureUsage, Membership, MembershipStatus, PaymentInfo
+)
+
+# Compact in-memory layout of the json backend's memberships. A pydantic Membership with
+# its nested models and datetimes costs well over a kilobyte; a MembershipRecord keeps
+# counters and timestamps in slots, shares everything copied from the template through
+# one interned MembershipShape, and interns user ids. Pydantic models are built only
+# when a membership leaves the store (to_model) and turned back into records on save.
+
+FEATURES = ("conversation", "analysis")
+
+
+class MembershipShape:
+    """What memberships of one template have in common, shared rather than copied per row"""
+
+    __slots__ = ("template_id", "name", "customer_type", "conversation_limit", "analysis_limit")
+
+    def __init__(self, template_id: Optional[str], name: str, customer_type: CustomerType,
+                 conversation_limit: Optional[int], analysis_limit: Optional[int]):
+        self.template_id = template_id
+        self.name = name
+        self.customer_type = customer_type
+        self.conversation_limit = conversation_limit
+        self.analysis_limit = analysis_limit
+
+
+_shapes: Dict[tuple, MembershipShape] = {}
+_timezones: Dict[tzinfo, tzinfo] = {}
+
+
+def intern_shape(template_id: Optional[str], name: str, customer_type: CustomerType,
+                 conversation_limit: Optional[int], analysis_limit: Optional[int]) -> MembershipShape:
+    key = (template_id, name, customer_type, conversation_limit, analysis_limit)
+    shape = _shapes.get(key)
+    if shape is None:
+        shape = _shapes.setdefault(key, MembershipShape(*key))
+    return shape
+
+
+def _split(value: datetime) -> Tuple[float, Optional[tzinfo]]:
+    # A float timestamp round-trips to the microsecond; the tzinfo (None for naive,
+    # local-time values, which older rows still have) is kept so it reads back the same
+    tz = value.tzinfo
+    if tz is not None:
+        tz = _timezones.setdefault(tz, tz)
+    return value.timestamp(), tz
+
+
+def _join(timestamp: float, tz: Optional[tzinfo]) -> datetime:
+    return datetime.fromtimestamp(timestamp, tz)
+
+
+class MembershipRecord:
+    """One membership of the json backend, in about a fifth of the memory of the model"""
+
+    __slots__ = (
+        "id", "user_id", "shape", "status", "conversation", "analysis",
+        "created_ts", "expires_ts", "created_tz", "expires_tz", "payment"
+    )
+
+    def __init__(self, id: str, user_id: str, shape: MembershipShape, status: MembershipStatus,
+                 conversation: int, analysis: int, created_at: datetime, expires_at: datetime,
+                 payment: Optional[tuple] = None):
+        self.id = id
+        self.user_id = sys.intern(user_id)
+        self.shape = shape
+        self.status = status
+        self.conversation = conversation
+        self.analysis = analysis
+        self.created_ts, self.created_tz = _split(created_at)
+        self.expires_ts, self.expires_tz = _split(expires_at)
+        self.payment = payment  # (payment_method, amount, currency, transaction_id)
+
+    @classmethod
+    def from_model(cls, membership: Membership) -> "MembershipRecord":
+        payment = membership.payment_info
+        return cls(
+            membership.id,
+            membership.user_id,
+            intern_shape(
+                membership.template_id, membership.name, CustomerType(membership.customer_type),
+                membership.limits.conversation, membership.limits.analysis
+            ),
+            MembershipStatus(membership.status),
+            membership.usage.conversation,
+            membership.usage.analysis,
+            membership.created_at,
+            membership.expires_at,
+            None if payment is None else (
+                payment.payment_method, payment.amount, payment.currency, payment.transaction_id
+            )
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MembershipRecord":
+        """Read a membership as stored in data.json or the journal, without pydantic"""
+        limits = data["limits"]
+        usage = data.get("usage") or {}
+        payment = data.get("payment_info")
+        return cls(
+            data["id"],
+            data["user_id"],
+            intern_shape(
+                data.get("template_id"), data["name"], CustomerType(data["customer_type"]),
+                limits.get("conversation"), limits.get("analysis")
+            ),
+            MembershipStatus(data.get("status", MembershipStatus.ACTIVE)),
+            usage.get("conversation", 0),
+            usage.get("analysis", 0),
+            datetime.fromisoformat(data["created_at"]),
+            datetime.fromisoformat(data["expires_at"]),
+            None if payment is None else (
+                payment["payment_method"], float(payment["amount"]),
+                payment.get("currency", "USD"), payment["transaction_id"]
+            )
+        )
+
+    @property
+    def customer_type(self) -> CustomerType:
+        return self.shape.customer_type
+
+    @property
+    def expires_at(self) -> datetime:
+        return _join(self.expires_ts, self.expires_tz)
+
+    def has_remaining(self, feature_type: str, now_ts: float) -> bool:
+        """storage.has_remaining_usage on the record itself, without building a model"""
+        if feature_type not in FEATURES or self.status != MembershipStatus.ACTIVE or now_ts > self.expires_ts:
+            return False
+        if feature_type == "conversation":
+            limit, used = self.shape.conversation_limit, self.conversation
+        else:
+            limit, used = self.shape.analysis_limit, self.analysis
+        return limit is None or used < limit
+
+    def limit(self, feature_type: str) -> Optional[int]:
+        return self.shape.conversation_limit if feature_type == "conversation" else self.shape.analysis_limit
+
+    def to_model(self) -> Membership:
+        """The API's Membership, built without re-validating what the record already holds"""
+        shape = self.shape
+        payment = self.payment
+        return Membership.model_construct(
+            name=shape.name,
+            expires_at=_join(self.expires_ts, self.expires_tz),
+            limits=FeatureLimit.model_construct(
+                conversation=shape.conversation_limit, analysis=shape.analysis_limit
+            ),
+            customer_type=shape.customer_type,
+            template_id=shape.template_id,
+            id=self.id,
+            user_id=self.user_id,
+            status=self.status,
+            usage=FeatureUsage.model_construct(conversation=self.conversation, analysis=self.analysis),
+            created_at=_join(self.created_ts, self.created_tz),
+            payment_info=None if payment is None else PaymentInfo.model_construct(
+                payment_method=payment[0], amount=payment[1], currency=payment[2], transaction_id=payment[3]
+            )
+        )
+
+    def to_dict(self) -> dict:
+        """JSON-ready dict in the field order of Membership, for data.json and the journal"""
+        shape = self.shape
+        payment = self.payment
+        return {
+            "name": shape.name,
+            "expires_at": _join(self.expires_ts, self.expires_tz).isoformat(),
+            "limits": {"conversation": shape.conversation_limit, "analysis": shape.analysis_limit},
+            "customer_type": shape.customer_type.value,
+            "template_id": shape.template_id,
+            "id": self.id,
+            "user_id": self.user_id,
+            "status": self.status.value,
+            "usage": {"conversation": self.conversation, "analysis": self.analysis},
+            "created_at": _join(self.created_ts, self.created_tz).isoformat(),
+            "payment_info": None if payment is None else {
+                "payment_method": payment[0], "amount": payment[1],
+                "currency": payment[2], "transaction_id": payment[3]
+            },
+        }
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Iterator, Optional, Tuple
+from metrics import count_cache, set_cache_size
+
+logger = logging.getLogger(__name__)
+
+# In-memory tier for tutor replies, by size of the cached text (0 disables it)
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Only conversations this short are cached: openers repeat across learners, long ones don't
+CHAT_CACHE_MAX_MESSAGES = int(os.getenv("CHAT_CACHE_MAX_MESSAGES", "2"))
+# Transcripts of audio segments, keyed by the audio's hash (0 disables it)
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+# On-disk tier for synthesized audio (0 disables it)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Bookkeeping per cached reply fragment, on top of its text
+_FRAGMENT_OVERHEAD = 64
+_READ_CHUNK = 64 * 1024
+
+
+def normalize_text(text: str) -> str:
+    """Same key for prompts that differ only in Unicode form or whitespace"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def cache_key(kind: str, **parts) -> str:
+    """Content address of a request: sha256 over its kind, model and parameters"""
+    canonical = json.dumps({"kind": kind, **parts}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by total size in bytes rather than entry count"""
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[object, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        count_cache(self.name, entry is not None)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: str, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+            set_cache_size(self.name, len(self._entries), self._size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            set_cache_size(self.name, 0, 0)
+
+
+class BlobCache:
+    """Content-addressed files under one directory, LRU-evicted past max_bytes.
+
+    Blobs are written atomically (temp file + rename) and read through mmap, so a hot
+    blob is served from the page cache without being copied into the Python heap first.
+    """
+
+    def __init__(self, name: str, directory: str, max_bytes: int):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: Optional["OrderedDict[str, int]"] = None  # key -> size, least recent first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        # Blobs left by a previous run, oldest first by modification time
+        if self._index is None:
+            found = []
+            if os.path.isdir(self.directory):
+                for root, _, files in os.walk(self.directory):
+                    for file in files:
+                        if file.endswith(".tmp"):
+                            continue
+                        stat = os.stat(os.path.join(root, file))
+                        found.append((stat.st_mtime, file, stat.st_size))
+            found.sort()
+            self._index = OrderedDict((file, size) for _, file, size in found)
+            self._size = sum(self._index.values())
+            set_cache_size(self.name, len(self._index), self._size)
+        return self._index
+
+    def open(self, key: str) -> Optional[mmap.mmap]:
+        """Read-only map of a cached blob, or None on a miss; the caller closes it"""
+        with self._lock:
+            index = self._load_index()
+            hit = key in index
+            if hit:
+                index.move_to_end(key)
+        count_cache(self.name, hit)
+        if not hit:
+            return None
+        try:
+            with open(self._path(key), "rb") as file:
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Deleted behind our back, or empty (which mmap refuses)
+            self._forget(key)
+            return None
+
+    def put(self, key: str, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+        evicted = []
+        with self._lock:
+            index = self._load_index()
+            self._size -= index.pop(key, 0)
+            index[key] = len(data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                old_key, old_size = index.popitem(last=False)
+                self._size -= old_size
+                evicted.append(old_key)
+            set_cache_size(self.name, len(index), self._size)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError as exc:
+                logger.warning("Could not evict cached blob %s: %r", old_key, exc)
+
+    def _forget(self, key: str):
+        with self._lock:
+            index = self._load_index()
+            self._size -= index.pop(key, 0)
+            set_cache_size(self.name, len(index), self._size)
+
+
+def iter_blob(blob: mmap.mmap) -> Iterator[bytes]:
+    """Stream a mapped blob in chunks and unmap it once sent (or the client left)"""
+    try:
+        for offset in range(0, len(blob), _READ_CHUNK):
+            yield blob[offset:offset + _READ_CHUNK]
+    finally:
+        blob.close()
+
+
+# Tutor replies, stored as the fragments they streamed in so a replay streams identically
+reply_cache = LRUCache("chat_reply", CHAT_CACHE_MAX_BYTES)
+transcript_cache = LRUCache("transcript", TRANSCRIPT_CACHE_MAX_BYTES)
+audio_cache = BlobCache("tts_audio", AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+
+
+def fragments_size(fragments: Tuple[str, ...]) -> int:
+    return sum(len(fragment.encode()) + _FRAGMENT_OVERHEAD for fragment in fragments)
@@ -1,28 +1,37 @@
-from fastapi import APIRouter, HTTPException
+import json
+from typing import Literal, Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from models import (
-    MembershipAssignment, Membership, MembershipStatus, 
-    FeatureUsage, CustomerType
+    MembershipAssignment, BulkMembershipAssignment, Membership, MembershipStatus, 
+    FeatureUsage, CustomerType, CompanyQuota, CompanyQuotaUpdate, QuotaAllocation, QuotaAllocationUpdate,
+    LedgerRestore
 )
-from db import USERS, MEMBERSHIP_TEMPLATES, MEMBERSHIPS
+import analytics
+import ledger
+from db import store
+from pagination import MAX_PAGE_SIZE, NDJSON, ndjson_response, paginate, wants_ndjson
+from provisioning import BULK_ASSIGN_BACKGROUND_THRESHOLD, BulkAssignmentJob, get_job, resolve_users, submit
+from serialization import forget, json_response
+from metrics import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
 @router.post("/admin/assign-membership")
 def assign_membership(assignment: MembershipAssignment):
     """Admin assigns membership to user"""
     # Validate user exists
-    if assignment.user_id not in USERS:
+    user = store.get_user(assignment.user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Validate template exists
-    if assignment.template_id not in MEMBERSHIP_TEMPLATES:
+    template = store.get_template(assignment.template_id)
+    if template is None:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    user = USERS[assignment.user_id]
-    template = MEMBERSHIP_TEMPLATES[assignment.template_id]
-    
     # For B2B customers, admin can assign any template
     # For B2C customers, validate customer type matches
     if user.customer_type == CustomerType.B2C and template.customer_type != CustomerType.B2C:
@@ -33,7 +42,8 @@ def assign_membership(assignment: MembershipAssignment):
     
     # Create membership
     membership_id = str(uuid4())
-    expires_at = datetime.now() + timedelta(days=template.duration_days)
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(days=template.duration_days)
     
     membership = Membership(
         id=membership_id,
@@ -45,25 +55,75 @@ def assign_membership(assignment: MembershipAssignment):
         template_id=assignment.template_id,
         status=MembershipStatus.ACTIVE,
         usage=FeatureUsage(),
-        created_at=datetime.now()
+        created_at=now
     )
     
-    MEMBERSHIPS[membership_id] = membership
+    store.save_membership(membership)
+    analytics.record_created(template.id, user.customer_type, user.company_id)
     
-    return {
+    return json_response({
         "message": "Membership assigned successfully",
         "membership": membership,
         "assigned_by": assignment.assigned_by
-    }
+    })
+
+@router.post("/admin/assign-memberships")
+def bulk_assign_memberships(
+    request: Request, assignment: BulkMembershipAssignment, background: Optional[bool] = None
+):
+    """Admin assigns one template to every user of a company, or to a list of users.
+
+    All memberships are built in one pass and saved with a single write. Up to
+    BULK_ASSIGN_BACKGROUND_THRESHOLD users this runs in the request and returns the
+    job's final status (or, with `Accept: application/x-ndjson`, streams progress lines
+    and then the status); larger assignments, or `?background=true`, run as a background
+    job: 202 with the job to poll at /admin/assign-memberships/jobs/{job_id}.
+    """
+    if (assignment.company_id is None) == (assignment.user_ids is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of company_id or user_ids")
+
+    template = store.get_template(assignment.template_id)
+    if template is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+
+    users, missing = resolve_users(store, assignment.company_id, assignment.user_ids)
+    if assignment.company_id is not None and not users:
+        raise HTTPException(status_code=404, detail="Company has no users")
+
+    job = BulkAssignmentJob(store, template, users, missing, assignment.assigned_by, assignment.skip_existing)
+    if background or (background is None and job.total > BULK_ASSIGN_BACKGROUND_THRESHOLD):
+        submit(job)
+        return JSONResponse(
+            job.to_dict(), status_code=202,
+            headers={"Location": f"{request.url.path}/jobs/{job.id}"}
+        )
+
+    if wants_ndjson(request):
+        # A client that disconnects before the end aborts the job before anything is saved
+        return StreamingResponse(
+            ((json.dumps(event) + "\n").encode() for event in job.run()), media_type=NDJSON
+        )
+
+    for event in job.run():
+        pass
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail="Bulk assignment failed")
+    return job.to_dict()
+
+@router.get("/admin/assign-memberships/jobs/{job_id}")
+def get_bulk_assignment(job_id: str):
+    """Progress of a background bulk assignment"""
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 @router.delete("/admin/memberships/{membership_id}")
 def revoke_membership(membership_id: str, admin_id: str):
     """Admin revokes/deletes membership"""
-    if membership_id not in MEMBERSHIPS:
+    if not store.delete_membership(membership_id):
         raise HTTPException(status_code=404, detail="Membership not found")
-    
-    membership = MEMBERSHIPS[membership_id]
-    del MEMBERSHIPS[membership_id]
+    forget(membership_id)
     
     return {
         "message": "Membership revoked successfully",
@@ -74,52 +134,245 @@ def revoke_membership(membership_id: str, admin_id: str):
 @router.patch("/admin/memberships/{membership_id}/suspend")
 def suspend_membership(membership_id: str, admin_id: str):
     """Admin suspends membership"""
-    if membership_id not in MEMBERSHIPS:
+    membership = store.get_membership(membership_id)
+    if membership is None:
         raise HTTPException(status_code=404, detail="Membership not found")
     
-    membership = MEMBERSHIPS[membership_id]
     membership.status = MembershipStatus.SUSPENDED
+    store.save_membership(membership)
     
-    return {
+    return json_response({
         "message": "Membership suspended successfully",
         "suspended_by": admin_id,
         "membership": membership
-    }
+    })
 
 @router.patch("/admin/memberships/{membership_id}/activate")
 def activate_membership(membership_id: str, admin_id: str):
     """Admin activates suspended membership"""
-    if membership_id not in MEMBERSHIPS:
+    membership = store.get_membership(membership_id)
+    if membership is None:
         raise HTTPException(status_code=404, detail="Membership not found")
     
-    membership = MEMBERSHIPS[membership_id]
-    
-    # Check if membership is expired
-    if datetime.now() > membership.expires_at:
+    # Check if membership is expired; compare timestamps, since data written before
+    # memberships were created in UTC still holds naive local times
+    if datetime.now(timezone.utc).timestamp() > membership.expires_at.timestamp():
         raise HTTPException(status_code=400, detail="Cannot activate expired membership")
     
     membership.status = MembershipStatus.ACTIVE
+    store.save_membership(membership)
     
-    return {
+    return json_response({
         "message": "Membership activated successfully",
         "activated_by": admin_id,
         "membership": membership
-    }
+    })
 
 @router.get("/admin/memberships")
-def list_all_memberships():
-    """Admin lists all memberships"""
-    return list(MEMBERSHIPS.values())
+def list_all_memberships(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    status: Optional[MembershipStatus] = None,
+    customer_type: Optional[CustomerType] = None
+):
+    """Admin lists all memberships, optionally paginated or streamed as NDJSON for exports"""
+    if wants_ndjson(request):
+        return ndjson_response(store.iter_memberships(status, customer_type))
+    if limit is None and cursor is None:
+        return json_response(list(store.iter_memberships(status, customer_type)))
+    page, headers = paginate(
+        lambda after, size: store.scan_memberships(after, size, status, customer_type),
+        limit or MAX_PAGE_SIZE,
+        cursor
+    )
+    return json_response(page, headers=headers)
 
 @router.get("/admin/users/{user_id}/memberships")
 def get_user_memberships(user_id: str):
     """Admin gets all memberships for a specific user"""
-    if user_id not in USERS:
+    if store.get_user(user_id) is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_memberships = [
-        membership for membership in MEMBERSHIPS.values()
-        if membership.user_id == user_id
-    ]
+    user_memberships = store.memberships_for_user(user_id)
     
-    return user_memberships
\ No newline at end of file
+    return json_response(user_memberships)
+
+@router.put("/admin/companies/{company_id}/quota")
+def set_company_quota(company_id: str, update: CompanyQuotaUpdate):
+    """Admin sets a B2B company's pooled usage quota.
+
+    While a company has a quota, its users' usage is charged to the pool (and their
+    allocation, if any) instead of their own membership's counters; a membership is
+    still needed for access. Usage so far is kept unless reset_usage is set.
+    """
+    quota = store.get_company_quota(company_id)
+    if quota is None or update.reset_usage:
+        usage = FeatureUsage()
+    else:
+        usage = quota.usage
+    quota = CompanyQuota(company_id=company_id, limits=update.limits, usage=usage)
+    store.save_company_quota(quota)
+    return json_response(quota)
+
+@router.get("/admin/companies/{company_id}/quota")
+def get_company_quota(company_id: str):
+    """Admin gets a company's quota with every user allocation in it"""
+    quota = store.get_company_quota(company_id)
+    if quota is None:
+        raise HTTPException(status_code=404, detail="Company has no quota")
+    return json_response({"quota": quota, "allocations": store.quota_allocations(company_id)})
+
+@router.delete("/admin/companies/{company_id}/quota")
+def delete_company_quota(company_id: str):
+    """Admin removes a company's quota; its users go back to their memberships' own limits"""
+    if not store.delete_company_quota(company_id):
+        raise HTTPException(status_code=404, detail="Company has no quota")
+    return {"message": "Company quota removed", "company_id": company_id}
+
+@router.put("/admin/companies/{company_id}/quota/allocations/{user_id}")
+def set_quota_allocation(company_id: str, user_id: str, update: QuotaAllocationUpdate):
+    """Admin caps one user's share of the company pool"""
+    if store.get_company_quota(company_id) is None:
+        raise HTTPException(status_code=404, detail="Company has no quota")
+    user = store.get_user(user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if user.company_id != company_id:
+        raise HTTPException(status_code=400, detail="User does not belong to this company")
+    existing = store.get_quota_allocation(company_id, user_id)
+    allocation = QuotaAllocation(
+        company_id=company_id, user_id=user_id, limits=update.limits,
+        usage=existing.usage if existing is not None else FeatureUsage()
+    )
+    store.save_quota_allocation(allocation)
+    return json_response(allocation)
+
+@router.delete("/admin/companies/{company_id}/quota/allocations/{user_id}")
+def delete_quota_allocation(company_id: str, user_id: str):
+    """Admin drops a user's allocation: they draw on the pool uncapped, their usage count restarts"""
+    if not store.delete_quota_allocation(company_id, user_id):
+        raise HTTPException(status_code=404, detail="Allocation not found")
+    return {"message": "Allocation removed", "company_id": company_id, "user_id": user_id}
+
+@router.get("/admin/analytics")
+def get_analytics(
+    metric: str = "usage.conversation",
+    group_by: Literal["all", "template", "customer_type", "company"] = "all",
+    granularity: Literal["day", "hour"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(20, ge=1, le=1000)
+):
+    """Admin dashboard rollups: a metric per day or hour, overall or per group.
+
+    Metrics are usage.conversation, usage.analysis, memberships_created and
+    revenue_cents. Counters are kept up to date as usage and memberships happen, so this
+    reads precomputed buckets rather than scanning memberships. Other workers' counts are
+    included up to their last flush. Defaults to the last 30 days (or 48 hours); groups
+    come largest total first.
+    """
+    if metric not in analytics.METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown metric, expected one of {', '.join(analytics.METRICS)}")
+    end = end or datetime.now(timezone.utc)
+    start = start or end - (timedelta(days=30) if granularity == "day" else timedelta(hours=48))
+    first, last = analytics.periods(granularity, start, end)
+    if last <= first:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if last - first > analytics.rollups.sizes[granularity]:
+        raise HTTPException(
+            status_code=400, detail=f"{granularity}ly buckets only go back {analytics.rollups.sizes[granularity]} {granularity}s"
+        )
+    # Pick up what other workers have flushed since the last sync
+    analytics.refresh()
+    return analytics.rollups.query(metric, group_by, granularity, first, last, limit)
+
+def _ledger():
+    if not ledger.ledger.is_open:
+        raise HTTPException(status_code=503, detail="Usage ledger is disabled")
+    return ledger.ledger
+
+@router.get("/admin/ledger/events")
+def get_ledger_events(
+    request: Request,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    membership_id: Optional[str] = None,
+    feature_type: Optional[Literal["conversation", "analysis"]] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Usage events with start <= time < end, oldest first, optionally for one membership.
+
+    The JSON reply stops at `limit` events (`truncated` says whether more matched); with
+    `Accept: application/x-ndjson` every matching event is streamed.
+    """
+    events = _ledger().events(
+        start.timestamp() if start else None, end.timestamp() if end else None, membership_id, feature_type
+    )
+    if wants_ndjson(request):
+        return ndjson_response(events)
+    page = [event for _, event in zip(range(limit + 1), events)]
+    return {"events": page[:limit], "truncated": len(page) > limit}
+
+@router.get("/admin/memberships/{membership_id}/usage-history")
+def get_usage_history(membership_id: str, at: Optional[datetime] = None):
+    """A membership's usage replayed from the ledger as of `at` (default now), next to its current counters.
+
+    `pooled` is the company-quota usage charged on the membership's behalf, if any.
+    """
+    usage_ledger = _ledger()
+    timestamp = at.timestamp() if at else None
+    replayed = usage_ledger.usage_at(membership_id, timestamp)
+    pooled = usage_ledger.usage_at(ledger.POOLED_PREFIX + membership_id, timestamp)
+    membership = store.get_membership(membership_id)
+    if replayed is None and pooled is None and membership is None:
+        raise HTTPException(status_code=404, detail="Membership not found")
+    return {
+        "membership_id": membership_id,
+        "at": (at or datetime.now(timezone.utc)).isoformat(),
+        "replayed": replayed,
+        "pooled": pooled,
+        "current": None if membership is None else membership.usage,
+    }
+
+@router.post("/admin/ledger/restore")
+def restore_usage(restore: LedgerRestore):
+    """Reset usage counters to what they were at a point in time, as replayed from the ledger.
+
+    Dry runs (the default) only report what would change. Applying writes the counters
+    in one save_memberships call and appends compensating events, so the ledger still
+    adds up to the stored usage afterwards. Memberships deleted since are skipped, and
+    so is pooled usage: it lives in the company quotas, which this leaves alone.
+    """
+    usage_ledger = _ledger()
+    changes, updated = [], []
+    for membership_id, (conversation, analysis) in usage_ledger.totals_at(restore.at.timestamp()).items():
+        if membership_id.startswith(ledger.POOLED_PREFIX):
+            continue
+        membership = store.get_membership(membership_id)
+        if membership is None:
+            continue
+        usage = membership.usage
+        if (usage.conversation, usage.analysis) == (conversation, analysis):
+            continue
+        changes.append({
+            "membership_id": membership_id,
+            "from": {"conversation": usage.conversation, "analysis": usage.analysis},
+            "to": {"conversation": conversation, "analysis": analysis},
+        })
+        updated.append(membership.model_copy(
+            update={"usage": FeatureUsage(conversation=conversation, analysis=analysis)}
+        ))
+    if not restore.dry_run and updated:
+        store.save_memberships(updated)
+        for change in changes:
+            for feature_type in ledger.FEATURES:
+                delta = change["to"][feature_type] - change["from"][feature_type]
+                if delta:
+                    usage_ledger.record(change["membership_id"], feature_type, delta)
+    return {
+        "at": restore.at.isoformat(),
+        "dry_run": restore.dry_run,
+        "changed": len(changes),
+        "changes": changes[:MAX_PAGE_SIZE],
+    }
@@ -1,7 +1,26 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Callable, Optional, Sequence
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from metrics import ProfiledRoute, cache_stats, observe
+from providers import SYSTEM_PROMPT, ChatProvider, Message, get_provider, get_speech_provider
+from response_cache import (
+    CHAT_CACHE_MAX_MESSAGES, audio_cache, cache_key, fragments_size, iter_blob, normalize_text, reply_cache
+)
+from sessions import Session, build_context, create_session, delete_session, get_session
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
+logger = logging.getLogger(__name__)
+
+# Fragments read ahead of a slow client; past this the provider is paused until it catches up
+CHAT_STREAM_BUFFER = int(os.getenv("CHAT_STREAM_BUFFER", "64"))
+
+SSE = "text/event-stream"
 
 class ChatMessage(BaseModel):
     role: str
@@ -10,16 +29,225 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     messages: list[ChatMessage]
 
+class SessionCreate(BaseModel):
+    system: Optional[str] = None  # defaults to the tutor persona
+
+class SpeechRequest(BaseModel):
+    text: str
+    voice: str = "alloy"
+
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+async def _read_ahead(provider_stream: AsyncIterator[str], buffer: asyncio.Queue):
+    """Pump provider fragments into the bounded buffer; put() blocks while it is full"""
+    try:
+        async for fragment in provider_stream:
+            await buffer.put(fragment)
+        await buffer.put(None)
+    except Exception as exc:
+        await buffer.put(exc)
+    finally:
+        aclose = getattr(provider_stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+async def stream_reply(
+    provider: ChatProvider,
+    messages: list[Message],
+    started: float,
+    system: str = SYSTEM_PROMPT,
+    on_done: Optional[Callable[[str], None]] = None,
+    key: Optional[str] = None
+) -> AsyncIterator[bytes]:
+    """SSE events for one reply: a `token` event per fragment, then `done` (or `error`).
+
+    A completed reply is stored in the reply cache under key, if one is given.
+    """
+    buffer: asyncio.Queue = asyncio.Queue(CHAT_STREAM_BUFFER)
+    reader = asyncio.create_task(_read_ahead(provider.stream(messages, system), buffer))
+    parts = []
+    try:
+        while True:
+            item = await buffer.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                logger.error("Chat provider %s failed: %r", provider.name, item)
+                yield _sse("error", {"detail": "The tutor model failed to respond"})
+                return
+            if not parts:
+                observe("chat_ttfb", time.perf_counter() - started)
+            parts.append(item)
+            yield _sse("token", {"content": item})
+        content = "".join(parts)
+        if key is not None:
+            reply_cache.put(key, tuple(parts), fragments_size(parts))
+        if on_done is not None:
+            on_done(content)
+        yield _sse("done", {"role": "assistant", "content": content})
+        observe("chat_stream", time.perf_counter() - started)
+    finally:
+        # Runs on client disconnect too (the response task is cancelled): stop the model
+        if not reader.done():
+            logger.info("Chat stream cancelled after %d fragments", len(parts))
+            reader.cancel()
+
+async def replay_reply(fragments: Sequence[str], on_done: Optional[Callable[[str], None]] = None
+                       ) -> AsyncIterator[bytes]:
+    """A cached reply, framed exactly as stream_reply frames a live one"""
+    for fragment in fragments:
+        yield _sse("token", {"content": fragment})
+    content = "".join(fragments)
+    if on_done is not None:
+        on_done(content)
+    yield _sse("done", {"role": "assistant", "content": content})
+
+def _reply_key(provider: ChatProvider, system: str, messages: list[Message]) -> Optional[str]:
+    if len(messages) > CHAT_CACHE_MAX_MESSAGES:
+        return None
+    return cache_key(
+        "chat",
+        provider=provider.name,
+        model=getattr(provider, "model", provider.name),
+        system=normalize_text(system),
+        messages=[[message["role"], normalize_text(message["content"])] for message in messages]
+    )
+
+def reply_events(
+    provider: ChatProvider,
+    messages: list[Message],
+    started: float,
+    system: str = SYSTEM_PROMPT,
+    on_done: Optional[Callable[[str], None]] = None
+) -> AsyncIterator[bytes]:
+    """The reply's SSE events, replayed from the cache when the same prompt was answered before"""
+    key = _reply_key(provider, system, messages)
+    fragments = reply_cache.get(key) if key is not None else None
+    if fragments is not None:
+        return replay_reply(fragments, on_done)
+    return stream_reply(provider, messages, started, system, on_done, key)
+
+def _sse_response(events: AsyncIterator[bytes]) -> StreamingResponse:
+    # no-cache / X-Accel-Buffering keep proxies from buffering the stream
+    return StreamingResponse(events, media_type=SSE, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _complete_reply(provider: ChatProvider, messages: list[Message], started: float,
+                          system: str = SYSTEM_PROMPT) -> str:
+    key = _reply_key(provider, system, messages)
+    fragments = reply_cache.get(key) if key is not None else None
+    if fragments is not None:
+        return "".join(fragments)
+    try:
+        fragments = [fragment async for fragment in provider.stream(messages, system)]
+    except Exception as exc:
+        logger.error("Chat provider %s failed: %r", provider.name, exc)
+        raise HTTPException(status_code=502, detail="The tutor model failed to respond")
+    # The client sees nothing until the whole reply is in, so this is not a time to first byte
+    observe("chat_total", time.perf_counter() - started)
+    if key is not None:
+        reply_cache.put(key, tuple(fragments), fragments_size(fragments))
+    return "".join(fragments)
+
 @router.post("/chat")
-async def chat_endpoint(request: ChatRequest):
-    # This is a placeholder for AI integration
-    # In a real application, you would send the messages to an AI model (e.g., OpenAI, Gemini)
-    # and get a response.
-    
-    # For now, let's just echo the last message and add a simple AI response.
-    last_message = request.messages[-1].content if request.messages else ""
-    
-    ai_response_content = f"You said: \"{last_message}\". This is a placeholder AI response. I am still under development."
-    
+async def chat_endpoint(request: ChatRequest, http_request: Request):
+    """Tutor reply to a conversation.
+
+    With `Accept: text/event-stream` the reply streams as Server-Sent Events while the
+    model produces it; otherwise it is returned whole as {"role", "content"}.
+    """
+    started = time.perf_counter()
+    provider = get_provider()
+    messages = [message.model_dump() for message in request.messages]
+
+    if SSE in http_request.headers.get("accept", ""):
+        return _sse_response(reply_events(provider, messages, started))
+
+    ai_response_content = await _complete_reply(provider, messages, started)
+    return {"role": "assistant", "content": ai_response_content}
+
+@router.post("/chat/sessions", status_code=201)
+def create_chat_session(data: SessionCreate):
+    """Start a conversation whose history is kept server-side"""
+    session = create_session(data.system)
+    logger.info("Created chat session %s", session.id)
+    return {"session_id": session.id}
+
+def _require_session(session_id: str) -> Session:
+    session = get_session(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Chat session not found or expired")
+    return session
+
+@router.get("/chat/sessions/{session_id}")
+def get_chat_session(session_id: str):
+    """Full history of a session, plus the rolling summary of turns outside the context window"""
+    return _require_session(session_id).to_dict()
+
+@router.delete("/chat/sessions/{session_id}")
+def delete_chat_session(session_id: str):
+    if not delete_session(session_id):
+        raise HTTPException(status_code=404, detail="Chat session not found or expired")
+    return {"message": "Chat session deleted successfully"}
+
+@router.post("/chat/sessions/{session_id}/messages")
+async def send_chat_message(session_id: str, request: ChatRequest, http_request: Request):
+    """Add only the new message(s) to a session and get the tutor's reply, as /chat does.
+
+    The model sees the system prompt, a summary of older turns and as many recent turns
+    as fit CHAT_CONTEXT_TOKENS; the reply is appended to the history once complete.
+    """
+    started = time.perf_counter()
+    session = _require_session(session_id)
+    provider = get_provider()
+
+    if SSE in http_request.headers.get("accept", ""):
+        async def events() -> AsyncIterator[bytes]:
+            # The lock spans the whole turn, so the next message sees this reply
+            async with session.lock:
+                for message in request.messages:
+                    session.append(message.role, message.content)
+                system, messages = await build_context(session, provider)
+                def on_done(content: str):
+                    session.append("assistant", content)
+                async for event in reply_events(provider, messages, started, system, on_done):
+                    yield event
+        return _sse_response(events())
+
+    async with session.lock:
+        for message in request.messages:
+            session.append(message.role, message.content)
+        system, messages = await build_context(session, provider)
+        ai_response_content = await _complete_reply(provider, messages, started, system)
+        session.append("assistant", ai_response_content)
     return {"role": "assistant", "content": ai_response_content}
 
+
+@router.get("/chat/cache/stats")
+def get_cache_stats():
+    """Hits, misses and size of the reply and audio caches (also on /metrics)"""
+    return cache_stats()
+
+@router.post("/tts")
+async def text_to_speech(request: SpeechRequest):
+    """Audio for a tutor sentence; each distinct text and voice is synthesized only once"""
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="Text is required")
+    provider = get_speech_provider()
+    key = cache_key(
+        "tts", provider=provider.name, model=provider.model, voice=request.voice, text=normalize_text(request.text)
+    )
+    headers = {"Cache-Control": "public, max-age=3600"}
+
+    blob = await asyncio.to_thread(audio_cache.open, key)
+    if blob is not None:
+        headers["Content-Length"] = str(len(blob))
+        return StreamingResponse(iter_blob(blob), media_type=provider.media_type, headers=headers)
+
+    try:
+        audio = await provider.synthesize(request.text, request.voice)
+    except Exception as exc:
+        logger.error("Speech provider %s failed: %r", provider.name, exc)
+        raise HTTPException(status_code=502, detail="Speech synthesis failed")
+    await asyncio.to_thread(audio_cache.put, key, audio)
+    return Response(audio, media_type=provider.media_type, headers=headers)
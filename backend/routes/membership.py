@@ -1,31 +1,31 @@
 import logging
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request
 from uuid import uuid4
 from datetime import datetime, timezone
 from models import (
     MembershipCreate, Membership, MembershipStatus, 
-    UsageUpdate, FeatureUsage
+    UsageUpdate, UsageBatch, FeatureUsage, CustomerType, CompanyQuota, User
 )
-from db import MEMBERSHIPS, USERS, _save_data
+import analytics
+import ledger
+from db import store
+from storage import quota_has_room
+from pagination import MAX_PAGE_SIZE, ndjson_response, paginate, wants_ndjson
+from serialization import forget, json_response
+from metrics import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 logger = logging.getLogger(__name__)
 
-def check_membership_expiry(membership: Membership) -> Membership:
-    """Check if membership is expired and update status"""
-    if datetime.now(timezone.utc) > membership.expires_at and membership.status == MembershipStatus.ACTIVE:
-        membership.status = MembershipStatus.EXPIRED
-    return membership
+# Expiry is handled by the scheduler in expiry.py, which flips ACTIVE memberships to
+# EXPIRED as their deadlines pass, so reads here trust membership.status as stored.
 
 def validate_usage(membership: Membership, feature_type: str) -> bool:
     """Validate if user can use a feature based on limits and usage"""
     if membership.status != MembershipStatus.ACTIVE:
         return False
     
-    if datetime.now(timezone.utc) > membership.expires_at:
-        membership.status = MembershipStatus.EXPIRED
-        return False
-    
     if feature_type == "conversation":
         limit = membership.limits.conversation
         usage = membership.usage.conversation
@@ -41,10 +41,54 @@ def validate_usage(membership: Membership, feature_type: str) -> bool:
     
     return usage < limit
 
+def company_quota(user: User) -> Optional[CompanyQuota]:
+    """The pooled quota that meters a B2B user instead of their membership's own counters"""
+    return store.get_company_quota(user.company_id) if user.company_id else None
+
+def active_seat(user_id: str) -> Optional[Membership]:
+    """A pooled user's active, unexpired membership: it grants access, the pool meters usage"""
+    now = datetime.now(timezone.utc).timestamp()
+    for membership in store.memberships_for_user(user_id):
+        if membership.status == MembershipStatus.ACTIVE and membership.expires_at.timestamp() > now:
+            return membership
+    return None
+
+def check_pooled_usage(user: User, quota: CompanyQuota, feature_type: str) -> dict:
+    seat = active_seat(user.id)
+    if seat is None:
+        return {"can_use": False, "reason": "No valid active membership for this feature"}
+    if not quota_has_room(quota.limits, quota.usage, feature_type):
+        return {"can_use": False, "reason": "Company quota reached"}
+    allocation = store.get_quota_allocation(quota.company_id, user.id)
+    if allocation is not None and not quota_has_room(allocation.limits, allocation.usage, feature_type):
+        return {"can_use": False, "reason": "User allocation of the company quota reached"}
+    return json_response({"can_use": True, "membership": seat, "company_quota": quota, "allocation": allocation})
+
+def consume_pooled_usage(user: User, feature_type: str, seat: Optional[Membership] = None) -> dict:
+    """Charge one use to the user's company pool; 400 if they have no seat or no quota left"""
+    seat = seat or active_seat(user.id)
+    if seat is None:
+        raise HTTPException(status_code=400, detail="No active membership with remaining usage for this feature")
+    spent = store.consume_company_quota(user.company_id, user.id, feature_type)
+    if spent is None:
+        logger.warning("Company %s quota exhausted for user %s, feature %s", user.company_id, user.id, feature_type)
+        raise HTTPException(status_code=400, detail="Company quota for this feature is used up")
+    quota, allocation = spent
+    ledger.record(seat.id, feature_type, pooled=True)
+    analytics.record_usage(feature_type, seat.template_id, seat.customer_type, user.company_id)
+    # Copies: the JSON store hands back its live entries, which later charges keep changing
+    return {
+        "membership_id": seat.id,
+        "current_usage": quota.usage.model_copy(),
+        "limits": quota.limits,
+        "user_usage": allocation.usage.model_copy(),
+        "user_limits": allocation.limits
+    }
+
 @router.post("/memberships", response_model=Membership)
 def create_membership(data: MembershipCreate):
     """Create a new membership"""
-    logger.info(f"Creating new membership for user: {data.user_id}")
+    logger.info("Creating new membership for user: %s", data.user_id)
     new_id = str(uuid4())
     membership = Membership(
         id=new_id, 
@@ -52,73 +96,78 @@ def create_membership(data: MembershipCreate):
         usage=FeatureUsage(),
         **data.dict()
     )
-    MEMBERSHIPS[new_id] = membership
-    _save_data()
-    logger.info(f"Membership created successfully with ID: {new_id}")
-    return membership
+    store.save_membership(membership)
+    user = store.get_user(data.user_id)
+    analytics.record_created(membership.template_id, membership.customer_type, user.company_id if user else None)
+    logger.info("Membership created successfully with ID: %s", new_id)
+    return json_response(membership)
 
 @router.get("/memberships", response_model=list[Membership])
-def list_memberships():
-    """List all memberships"""
-    memberships = []
-    for membership in MEMBERSHIPS.values():
-        memberships.append(check_membership_expiry(membership))
-    return memberships
+def list_memberships(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    status: Optional[MembershipStatus] = None,
+    customer_type: Optional[CustomerType] = None
+):
+    """List memberships: all of them, a page at a time (limit/cursor), or as an NDJSON stream"""
+    if wants_ndjson(request):
+        return ndjson_response(store.iter_memberships(status, customer_type))
+    if limit is None and cursor is None:
+        return json_response(list(store.iter_memberships(status, customer_type)))
+    page, headers = paginate(
+        lambda after, size: store.scan_memberships(after, size, status, customer_type),
+        limit or MAX_PAGE_SIZE,
+        cursor
+    )
+    return json_response(page, headers=headers)
 
 @router.get("/memberships/{membership_id}", response_model=Membership)
 def get_membership(membership_id: str):
     """Get a specific membership"""
-    if membership_id not in MEMBERSHIPS:
+    membership = store.get_membership(membership_id)
+    if membership is None:
         raise HTTPException(status_code=404, detail="Membership not found")
     
-    membership = MEMBERSHIPS[membership_id]
-    return check_membership_expiry(membership)
+    return json_response(membership)
 
 @router.delete("/memberships/{membership_id}")
 def delete_membership(membership_id: str):
     """Delete a membership"""
-    if membership_id not in MEMBERSHIPS:
+    if not store.delete_membership(membership_id):
         raise HTTPException(status_code=404, detail="Membership not found")
-    del MEMBERSHIPS[membership_id]
-    _save_data()
+    forget(membership_id)
     return {"message": "Membership deleted"}
 
 @router.get("/users/{user_id}/memberships", response_model=list[Membership])
 def get_user_memberships(user_id: str):
     """Get all memberships for a specific user"""
-    if user_id not in USERS:
+    if store.get_user(user_id) is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user_memberships = []
-    for membership in MEMBERSHIPS.values():
-        if membership.user_id == user_id:
-            user_memberships.append(check_membership_expiry(membership))
-    
-    return user_memberships
+    return json_response(store.memberships_for_user(user_id))
 
 @router.get("/users/{user_id}/active-memberships", response_model=list[Membership])
 def get_user_active_memberships(user_id: str):
     """Get user's active memberships"""
-    logger.info(f"Looking for active memberships for user: {user_id}")
+    logger.info("Looking for active memberships for user: %s", user_id)
     
-    if user_id not in USERS:
-        logger.warning(f"User not found: {user_id}")
+    if store.get_user(user_id) is None:
+        logger.warning("User not found: %s", user_id)
         raise HTTPException(status_code=404, detail="User not found")
     
     active_memberships = []
-    for membership in MEMBERSHIPS.values():
-        if membership.user_id == user_id:
-            membership = check_membership_expiry(membership)
-            if membership.status == MembershipStatus.ACTIVE:
-                active_memberships.append(membership)
+    for membership in store.memberships_for_user(user_id):
+        if membership.status == MembershipStatus.ACTIVE:
+            active_memberships.append(membership)
     
     if not active_memberships:
-        logger.warning(f"No active memberships found for user: {user_id}")
+        logger.warning("No active memberships found for user: %s", user_id)
         # Return an empty list instead of 404 if no active memberships
         return []
     
-    logger.info(f"Found {len(active_memberships)} active memberships for user {user_id}")
-    return active_memberships
+    logger.info("Found %s active memberships for user %s", len(active_memberships), user_id)
+    return json_response(active_memberships)
 
 @router.post("/usage/check")
 def check_feature_usage(usage_check: UsageUpdate):
@@ -126,23 +175,26 @@ def check_feature_usage(usage_check: UsageUpdate):
     user_id = usage_check.user_id
     feature_type = usage_check.feature_type
     
-    logger.info(f"Checking feature usage for user: {user_id}, feature: {feature_type}")
+    logger.info("Checking feature usage for user: %s, feature: %s", user_id, feature_type)
     
-    if user_id not in USERS:
-        logger.warning(f"User not found: {user_id}")
+    user = store.get_user(user_id)
+    if user is None:
+        logger.warning("User not found: %s", user_id)
         raise HTTPException(status_code=404, detail="User not found")
     
+    quota = company_quota(user)
+    if quota is not None:
+        return check_pooled_usage(user, quota, feature_type)
+    
     # Find an active membership that can be used for the feature
     valid_membership = None
-    for membership in MEMBERSHIPS.values():
-        if membership.user_id == user_id:
-            membership = check_membership_expiry(membership)
-            if membership.status == MembershipStatus.ACTIVE and validate_usage(membership, feature_type):
-                valid_membership = membership
-                break # Found a valid one, can stop searching
+    for membership in store.memberships_for_user(user_id):
+        if membership.status == MembershipStatus.ACTIVE and validate_usage(membership, feature_type):
+            valid_membership = membership
+            break # Found a valid one, can stop searching
     
     if not valid_membership:
-        logger.warning(f"No valid active membership found for user: {user_id}, feature: {feature_type}")
+        logger.warning("No valid active membership found for user: %s, feature: %s", user_id, feature_type)
         return {"can_use": False, "reason": "No valid active membership for this feature"}
     
     can_use = validate_usage(valid_membership, feature_type)
@@ -156,39 +208,49 @@ def check_feature_usage(usage_check: UsageUpdate):
             usage = valid_membership.usage.analysis
         
         reason = f"Usage limit reached ({usage}/{limit})" if limit else "Feature not available"
-        logger.warning(f"Usage limit exceeded for user {user_id}, feature {feature_type}: {reason}")
+        logger.warning("Usage limit exceeded for user %s, feature %s: %s", user_id, feature_type, reason)
         return {"can_use": False, "reason": reason}
     
-    logger.info(f"Feature usage check passed for user {user_id}, feature {feature_type}")
-    return {"can_use": True, "membership": valid_membership}
+    logger.info("Feature usage check passed for user %s, feature %s", user_id, feature_type)
+    return json_response({"can_use": True, "membership": valid_membership})
 
 @router.post("/memberships/{membership_id}/deduct-coupon")
 def deduct_coupon(membership_id: str):
     """Deduct a coupon from a count-based membership"""
-    logger.info(f"Attempting to deduct coupon for membership ID: {membership_id}")
+    logger.info("Attempting to deduct coupon for membership ID: %s", membership_id)
 
-    if membership_id not in MEMBERSHIPS:
-        logger.warning(f"Membership not found: {membership_id}")
+    membership = store.get_membership(membership_id)
+    if membership is None:
+        logger.warning("Membership not found: %s", membership_id)
         raise HTTPException(status_code=404, detail="Membership not found")
 
-    membership = MEMBERSHIPS[membership_id]
-    membership = check_membership_expiry(membership)
-
     if membership.status != MembershipStatus.ACTIVE:
-        logger.warning(f"Membership {membership_id} is not active. Status: {membership.status}")
+        logger.warning("Membership %s is not active. Status: %s", membership_id, membership.status)
         raise HTTPException(status_code=400, detail="Membership is not active")
 
+    user = store.get_user(membership.user_id)
+    if user is not None and company_quota(user) is not None:
+        # The company pool meters pooled users, not the membership's own coupons
+        consume_pooled_usage(user, "conversation", seat=membership)
+        logger.info("Coupon charged to company %s's quota for membership %s", user.company_id, membership_id)
+        return {"success": True, "message": "Coupon deducted successfully"}
+
     if membership.limits.conversation is None:
-        logger.warning(f"Membership {membership_id} is not count-based (conversation limit is None).")
+        logger.warning("Membership %s is not count-based (conversation limit is None).", membership_id)
         raise HTTPException(status_code=400, detail="This membership is not count-based for conversations.")
 
     if membership.usage.conversation >= membership.limits.conversation:
-        logger.warning(f"Membership {membership_id} has no remaining conversation coupons. Usage: {membership.usage.conversation}, Limit: {membership.limits.conversation}")
+        logger.warning("Membership %s has no remaining conversation coupons. Usage: %s, Limit: %s", membership_id, membership.usage.conversation, membership.limits.conversation)
         raise HTTPException(status_code=400, detail="No remaining conversation coupons for this membership.")
 
-    membership.usage.conversation += 1
-    _save_data()
-    logger.info(f"Coupon deducted successfully for membership {membership_id}. New usage: {membership.usage.conversation}")
+    # Re-checked and incremented atomically: another request may have spent the last coupon
+    membership = store.consume_membership(membership_id, "conversation")
+    if membership is None:
+        logger.warning("Membership %s ran out of conversation coupons concurrently.", membership_id)
+        raise HTTPException(status_code=400, detail="No remaining conversation coupons for this membership.")
+    ledger.record(membership.id, "conversation")
+    analytics.record_usage("conversation", membership.template_id, membership.customer_type, user.company_id if user else None)
+    logger.info("Coupon deducted successfully for membership %s. New usage: %s", membership_id, membership.usage.conversation)
     return {"success": True, "message": "Coupon deducted successfully"}
 
 @router.post("/usage/start-conversation")
@@ -196,39 +258,38 @@ def start_conversation(usage_update: UsageUpdate):
     """Start a conversation and deduct usage upfront"""
     user_id = usage_update.user_id
     
-    logger.info(f"Starting conversation for user: {user_id}")
+    logger.info("Starting conversation for user: %s", user_id)
     
-    if user_id not in USERS:
-        logger.warning(f"User not found: {user_id}")
+    user = store.get_user(user_id)
+    if user is None:
+        logger.warning("User not found: %s", user_id)
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Find an active membership that can be used for conversation
-    valid_membership = None
-    for membership in MEMBERSHIPS.values():
-        if membership.user_id == user_id:
-            membership = check_membership_expiry(membership)
-            if membership.status == MembershipStatus.ACTIVE and validate_usage(membership, "conversation"):
-                valid_membership = membership
-                break
+    if company_quota(user) is not None:
+        return json_response({"message": "Conversation started successfully", **consume_pooled_usage(user, "conversation")})
+    
+    # Find an active membership that can be used for conversation and deduct usage
+    # in one atomic step (unlimited memberships are not counted)
+    valid_membership = store.consume_usage(user_id, "conversation", count_unlimited=False)
     
     if not valid_membership:
-        logger.warning(f"No valid active membership found for user: {user_id}")
+        logger.warning("No valid active membership found for user: %s", user_id)
         raise HTTPException(status_code=400, detail="No active membership with remaining conversation usage")
+    if valid_membership.limits.conversation is not None:
+        ledger.record(valid_membership.id, "conversation")
+    analytics.record_usage("conversation", valid_membership.template_id, valid_membership.customer_type, user.company_id)
     
-    # Deduct conversation usage
     if valid_membership.limits.conversation is not None:
-        valid_membership.usage.conversation += 1
-        logger.info(f"Conversation usage deducted for user {user_id}. New usage: {valid_membership.usage.conversation}/{valid_membership.limits.conversation}")
+        logger.info("Conversation usage deducted for user %s. New usage: %s/%s", user_id, valid_membership.usage.conversation, valid_membership.limits.conversation)
     else:
-        logger.info(f"Unlimited conversation membership for user {user_id}")
+        logger.info("Unlimited conversation membership for user %s", user_id)
     
-    _save_data()
-    return {
+    return json_response({
         "message": "Conversation started successfully",
         "membership_id": valid_membership.id,
         "current_usage": valid_membership.usage,
         "limits": valid_membership.limits
-    }
+    })
 
 @router.post("/usage/update")
 def update_feature_usage(usage_update: UsageUpdate):
@@ -236,29 +297,78 @@ def update_feature_usage(usage_update: UsageUpdate):
     user_id = usage_update.user_id
     feature_type = usage_update.feature_type
     
-    if user_id not in USERS:
+    user = store.get_user(user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Find an active membership that can be used for the feature and has remaining usage
-    updatable_membership = None
-    for membership in MEMBERSHIPS.values():
-        if membership.user_id == user_id:
-            membership = check_membership_expiry(membership)
-            if membership.status == MembershipStatus.ACTIVE and validate_usage(membership, feature_type):
-                updatable_membership = membership
-                break # Found a valid one, can stop searching
+    if company_quota(user) is not None:
+        return json_response({"message": "Usage updated successfully", **consume_pooled_usage(user, feature_type)})
+    
+    # Find an active membership with remaining usage and increment it atomically
+    updatable_membership = store.consume_usage(user_id, feature_type)
     
     if not updatable_membership:
         raise HTTPException(status_code=400, detail="No active membership with remaining usage for this feature")
+    ledger.record(updatable_membership.id, feature_type)
+    analytics.record_usage(feature_type, updatable_membership.template_id, updatable_membership.customer_type, user.company_id)
     
-    # Increment usage
-    if feature_type == "conversation":
-        updatable_membership.usage.conversation += 1
-    elif feature_type == "analysis":
-        updatable_membership.usage.analysis += 1
-    _save_data()
-    return {
+    return json_response({
         "message": "Usage updated successfully",
         "current_usage": updatable_membership.usage,
         "limits": updatable_membership.limits
+    })
+
+@router.post("/usage/batch")
+def update_feature_usage_batch(batch: UsageBatch):
+    """Apply many usage events at once, grouped by user and persisted once per batch.
+
+    Events of users whose company has a quota are charged to the pool one by one, as
+    /usage/update would.
+    """
+    logger.info("Applying usage batch of %s events", len(batch.updates))
+    
+    # One user and quota lookup per distinct user and company rather than per event
+    known_users = {
+        user.id: user for user in map(store.get_user, {u.user_id for u in batch.updates})
+        if user is not None
     }
+    pooled_companies = {
+        company_id for company_id in {user.company_id for user in known_users.values() if user.company_id}
+        if store.get_company_quota(company_id) is not None
+    }
+    pooled = {user_id for user_id, user in known_users.items() if user.company_id in pooled_companies}
+    chargeable = [u for u in batch.updates if u.user_id in known_users and u.user_id not in pooled]
+    charged = iter(store.consume_usage_batch([(u.user_id, u.feature_type) for u in chargeable]))
+    
+    results = []
+    for update in batch.updates:
+        item = {"user_id": update.user_id, "feature_type": update.feature_type}
+        if update.user_id not in known_users:
+            item.update(success=False, reason="User not found")
+        elif update.user_id in pooled:
+            try:
+                item.update(success=True, **consume_pooled_usage(known_users[update.user_id], update.feature_type))
+            except HTTPException as exc:
+                item.update(success=False, reason=exc.detail)
+        else:
+            result = next(charged)
+            if result is None:
+                item.update(success=False, reason="No active membership with remaining usage for this feature")
+            else:
+                membership, usage = result
+                ledger.record(membership.id, update.feature_type)
+                analytics.record_usage(
+                    update.feature_type, membership.template_id, membership.customer_type,
+                    known_users[update.user_id].company_id
+                )
+                item.update(
+                    success=True,
+                    membership_id=membership.id,
+                    current_usage=usage,
+                    limits=membership.limits
+                )
+        results.append(item)
+    
+    applied = sum(1 for item in results if item["success"])
+    logger.info("Usage batch applied %s/%s events", applied, len(results))
+    return json_response({"applied": applied, "rejected": len(results) - applied, "results": results})
@@ -1,36 +1,70 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
 from uuid import uuid4
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from models import (
     PaymentRequest, PaymentInfo, Membership, MembershipStatus, 
     FeatureUsage, CustomerType
 )
-from db import USERS, MEMBERSHIP_TEMPLATES, MEMBERSHIPS
+import analytics
+from db import store
+from gateway import GatewayUnavailable, gateway
+from idempotency import fingerprint, run_once
+from serialization import json_response
+from metrics import ProfiledRoute
 
-router = APIRouter()
-
-def mock_payment_gateway(payment_method: str, amount: float) -> dict:
-    """Mock payment gateway integration"""
-    return {
-        "success": True,
-        "transaction_id": f"txn_{uuid4()}",
-        "message": "Payment processed successfully"
-    }
+router = APIRouter(route_class=ProfiledRoute)
 
 @router.post("/payments/process")
-def process_payment(payment_request: PaymentRequest):
-    """Process user payment for membership"""
+async def process_payment(payment_request: PaymentRequest, idempotency_key: Optional[str] = Header(None)):
+    """Process user payment for membership.
+
+    Retries sent with the same Idempotency-Key header get the first response back
+    instead of a second charge and membership.
+    """
+    return await run_once(
+        idempotency_key,
+        fingerprint("/payments/process", payment_request.model_dump_json()),
+        lambda: _process_payment(payment_request, idempotency_key)
+    )
+
+async def _process_payment(payment_request: PaymentRequest, idempotency_key: Optional[str]):
+    # Store reads and writes can touch disk, so they run off the event loop
+    user, template = await asyncio.to_thread(_validate_purchase, payment_request)
+
+    # Retries inside the client reuse one gateway idempotency key, so they can't double-charge
+    try:
+        payment_result = await gateway.charge(
+            payment_request.payment_method,
+            payment_request.amount,
+            "USD",
+            idempotency_key or str(uuid4())
+        )
+    except GatewayUnavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+
+    if not payment_result["success"]:
+        raise HTTPException(status_code=400, detail="Payment failed")
+
+    membership = await asyncio.to_thread(_create_membership, payment_request, user, template, payment_result)
+    return json_response({
+        "message": "Payment processed successfully",
+        "membership": membership,
+        "transaction_id": payment_result["transaction_id"]
+    })
+
+def _validate_purchase(payment_request: PaymentRequest):
     # Validate user exists
-    if payment_request.user_id not in USERS:
+    user = store.get_user(payment_request.user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Validate template exists
-    if payment_request.template_id not in MEMBERSHIP_TEMPLATES:
+    template = store.get_template(payment_request.template_id)
+    if template is None:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    user = USERS[payment_request.user_id]
-    template = MEMBERSHIP_TEMPLATES[payment_request.template_id]
-    
     # Validate customer type matches template
     if user.customer_type != template.customer_type:
         raise HTTPException(
@@ -48,19 +82,14 @@ def process_payment(payment_request: PaymentRequest):
             raise HTTPException(status_code=400, detail="Template price not set")
         if payment_request.amount != template.price:
             raise HTTPException(status_code=400, detail="Invalid payment amount")
-    
-    # Process payment through mock gateway
-    payment_result = mock_payment_gateway(
-        payment_request.payment_method, 
-        payment_request.amount
-    )
-    
-    if not payment_result["success"]:
-        raise HTTPException(status_code=400, detail="Payment failed")
-    
+
+    return user, template
+
+def _create_membership(payment_request: PaymentRequest, user, template, payment_result: dict) -> Membership:
     # Create membership
     membership_id = str(uuid4())
-    expires_at = datetime.now() + timedelta(days=template.duration_days)
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(days=template.duration_days)
     
     payment_info = PaymentInfo(
         payment_method=payment_request.payment_method,
@@ -79,14 +108,10 @@ def process_payment(payment_request: PaymentRequest):
         template_id=payment_request.template_id,
         status=MembershipStatus.ACTIVE,
         usage=FeatureUsage(),
-        created_at=datetime.now(),
+        created_at=now,
         payment_info=payment_info
     )
     
-    MEMBERSHIPS[membership_id] = membership
-    
-    return {
-        "message": "Payment processed successfully",
-        "membership": membership,
-        "transaction_id": payment_result["transaction_id"]
-    }
\ No newline at end of file
+    store.save_membership(membership)
+    analytics.record_created(template.id, user.customer_type, user.company_id, revenue=payment_request.amount)
+    return membership
\ No newline at end of file
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import logging
+from typing import AsyncIterator
+from fastapi import APIRouter, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import UploadFile
+from metrics import ProfiledRoute
+from pagination import NDJSON, wants_ndjson
+from providers import get_transcriber
+from transcription import TRANSCRIBE_MAX_BYTES, TRANSCRIBE_SAMPLE_RATE, AudioTooLarge, TranscriptionJob
+
+router = APIRouter(route_class=ProfiledRoute)
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK = 64 * 1024
+
+async def _ndjson_events(job: TranscriptionJob) -> AsyncIterator[bytes]:
+    async for event in job.events():
+        yield (json.dumps(event, ensure_ascii=False) + "\n").encode()
+
+@router.post("/transcribe")
+async def transcribe(request: Request, sample_rate: int = Query(TRANSCRIBE_SAMPLE_RATE, ge=8000, le=48000)):
+    """Transcribe a recording, segmenting and transcribing it while the upload is still arriving.
+
+    The body is raw audio, sent chunked or whole: `audio/pcm` (16-bit mono at sample_rate)
+    or `audio/wav` are split on pauses; other formats (e.g. `audio/webm`) are transcribed
+    whole. A `multipart/form-data` upload with an `audio` file field is accepted too.
+    With `Accept: application/x-ndjson` a `partial` line streams per segment, then `final`;
+    otherwise the reply is {"text", "segments"}.
+    """
+    content_type = request.headers.get("content-type", "")
+    job = None
+    try:
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form(max_part_size=TRANSCRIBE_MAX_BYTES)
+            audio = form.get("audio")
+            if not isinstance(audio, UploadFile):
+                raise HTTPException(status_code=400, detail="Audio file is required")
+            job = TranscriptionJob(get_transcriber(), audio.content_type or "", sample_rate)
+            while chunk := await audio.read(UPLOAD_CHUNK):
+                await job.feed(chunk)
+        else:
+            job = TranscriptionJob(get_transcriber(), content_type, sample_rate)
+            async for chunk in request.stream():
+                await job.feed(chunk)
+    except BaseException as exc:
+        if job is not None:
+            job.close()
+        if isinstance(exc, AudioTooLarge):
+            raise HTTPException(status_code=413, detail=f"Audio is larger than {TRANSCRIBE_MAX_BYTES} bytes")
+        raise
+    if not job.received:
+        job.close()
+        raise HTTPException(status_code=400, detail="Audio file is required")
+    job.finish()
+
+    if wants_ndjson(request):
+        return StreamingResponse(_ndjson_events(job), media_type=NDJSON)
+
+    segments = []
+    events = job.events()
+    try:
+        async for event in events:
+            if event["type"] == "error":
+                raise HTTPException(status_code=502, detail="Transcription failed")
+            if event["type"] == "partial":
+                segments.append(event)
+            else:
+                segments.sort(key=lambda segment: segment["segment"])
+                return {"text": event["text"], "segments": segments}
+    finally:
+        # Returning from inside the loop leaves the generator suspended; close it now
+        # rather than whenever it is garbage collected
+        await events.aclose()
+
+@router.websocket("/transcribe/ws")
+async def transcribe_websocket(
+    websocket: WebSocket, sample_rate: int = TRANSCRIBE_SAMPLE_RATE, media_type: str = "audio/pcm"
+):
+    """Live transcription: send audio as binary messages, then the text message `end`.
+
+    Each segment's transcript is sent as soon as it is ready, {"type": "partial", ...},
+    followed by {"type": "final", "text": ...} once the audio has ended.
+    """
+    await websocket.accept()
+    job = TranscriptionJob(get_transcriber(), media_type, sample_rate)
+
+    async def send_events():
+        async for event in job.events():
+            await websocket.send_json(event)
+
+    sender = asyncio.create_task(send_events())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes"):
+                await job.feed(message["bytes"])
+            elif (message.get("text") or "").strip() == "end":
+                break
+        job.finish()
+        await sender
+        await websocket.close()
+    except AudioTooLarge:
+        await websocket.close(code=1009, reason=f"Audio is larger than {TRANSCRIBE_MAX_BYTES} bytes")
+    except WebSocketDisconnect:
+        logger.info("Transcription socket closed after %d bytes", job.received)
+    finally:
+        sender.cancel()
+        job.close()
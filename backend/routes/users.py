@@ -1,47 +1,62 @@
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request
 from uuid import uuid4
-from models import User, UserCreate
-from db import USERS, _save_data
+from models import User, UserCreate, CustomerType
+from db import store
+from pagination import MAX_PAGE_SIZE, ndjson_response, paginate, wants_ndjson
+from serialization import json_response
+from metrics import ProfiledRoute
 
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
 
 @router.post("/users", response_model=User)
 def create_user(data: UserCreate):
     """Create a new user"""
     user_id = str(uuid4())
     user = User(id=user_id, **data.dict())
-    USERS[user_id] = user
-    _save_data()
-    return user
+    store.save_user(user)
+    return json_response(user)
 
 @router.get("/users", response_model=list[User])
-def list_users():
-    """List all users"""
-    return list(USERS.values())
+def list_users(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    customer_type: Optional[CustomerType] = None
+):
+    """List users: all of them, a page at a time (limit/cursor), or as an NDJSON stream"""
+    if wants_ndjson(request):
+        return ndjson_response(store.iter_users(customer_type))
+    if limit is None and cursor is None:
+        return json_response(list(store.iter_users(customer_type)))
+    page, headers = paginate(
+        lambda after, size: store.scan_users(after, size, customer_type),
+        limit or MAX_PAGE_SIZE,
+        cursor
+    )
+    return json_response(page, headers=headers)
 
 @router.get("/users/{user_id}", response_model=User)
 def get_user(user_id: str):
     """Get a specific user"""
-    if user_id not in USERS:
+    user = store.get_user(user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return USERS[user_id]
+    return json_response(user)
 
 @router.put("/users/{user_id}", response_model=User)
 def update_user(user_id: str, data: UserCreate):
     """Update a user"""
-    if user_id not in USERS:
+    if store.get_user(user_id) is None:
         raise HTTPException(status_code=404, detail="User not found")
     
     updated_user = User(id=user_id, **data.dict())
-    USERS[user_id] = updated_user
-    _save_data()
-    return updated_user
+    store.save_user(updated_user)
+    return json_response(updated_user)
 
 @router.delete("/users/{user_id}")
 def delete_user(user_id: str):
     """Delete a user"""
-    if user_id not in USERS:
+    if not store.delete_user(user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    del USERS[user_id]
-    _save_data()
     return {"message": "User deleted"}
\ No newline at end of file
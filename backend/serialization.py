@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from fastapi import Response
+from pydantic import TypeAdapter
+from pydantic_core import to_json
+from metrics import observe
+from models import Membership
+
+# Serialized bytes of recently served memberships, keyed by id
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "100000"))
+
+# Built once at import: dumping through an adapter skips FastAPI's response_model
+# re-validation and jsonable_encoder walk of objects we already validated
+_membership_adapter = TypeAdapter(Membership)
+
+_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _fingerprint(membership: Membership) -> tuple:
+    # Every field the app changes after creation; a cached entry whose fingerprint no
+    # longer matches is stale. id, created_at and payment_info never change.
+    return (
+        membership.status, membership.usage.conversation, membership.usage.analysis,
+        membership.expires_at, membership.name, membership.limits.conversation,
+        membership.limits.analysis, membership.customer_type, membership.template_id,
+        membership.user_id
+    )
+
+
+def membership_json(membership: Membership) -> bytes:
+    """JSON bytes for a membership, reusing the cached bytes while it is unchanged"""
+    fingerprint = _fingerprint(membership)
+    with _cache_lock:
+        entry = _cache.get(membership.id)
+        if entry is not None and entry[0] == fingerprint:
+            _cache.move_to_end(membership.id)
+            return entry[1]
+
+    data = _membership_adapter.dump_json(membership)
+    with _cache_lock:
+        _cache[membership.id] = (fingerprint, data)
+        _cache.move_to_end(membership.id)
+        if len(_cache) > MEMBERSHIP_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return data
+
+
+def forget(membership_id: str):
+    """Drop a deleted membership's cached bytes"""
+    with _cache_lock:
+        _cache.pop(membership_id, None)
+
+
+def encode(content: Any) -> bytes:
+    """Serialize a response body: memberships come from the cache, anything else
+    (other models, enums, datetimes, plain values) goes straight to pydantic-core"""
+    if isinstance(content, Membership):
+        return membership_json(content)
+    if isinstance(content, dict):
+        return b"{" + b",".join(to_json(str(key)) + b":" + encode(value) for key, value in content.items()) + b"}"
+    if isinstance(content, (list, tuple)):
+        return b"[" + b",".join(encode(item) for item in content) + b"]"
+    return to_json(content)
+
+
+def json_response(content: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Return content as ready-made JSON bytes, bypassing response_model validation"""
+    started = time.perf_counter()
+    body = encode(content)
+    observe("serialize", time.perf_counter() - started)
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
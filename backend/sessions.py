@@ -0,0 +1,176 @@
+import asyncio
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from uuid import uuid4
+from providers import SYSTEM_PROMPT, ChatProvider, Message
+
+# Conversation sessions live in this process only (like the json backend's data):
+# with several workers, route a session's requests to one worker or keep one worker.
+CHAT_SESSION_TTL_SECONDS = int(os.getenv("CHAT_SESSION_TTL_SECONDS", "3600"))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "10000"))
+# Token budget for what is sent to the model: system prompt + summary + recent turns
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "3000"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "300"))
+# "local" summarizes extractively (offline, deterministic); "provider" asks the chat model
+CHAT_SUMMARIZER = os.getenv("CHAT_SUMMARIZER", "local")
+
+SUMMARY_PROMPT = (
+    "Summarize this English tutoring conversation for the tutor's own notes in at most "
+    "{words} words: topics covered, the student's recurring mistakes, and open questions."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English), no tokenizer needed"""
+    return math.ceil(len(text) / 4) + 1
+
+
+class Turn:
+    """One message of a session, with its token estimate computed once"""
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        self.tokens = estimate_tokens(content)
+
+    def message(self) -> Message:
+        return {"role": self.role, "content": self.content}
+
+
+class Session:
+    """History of one conversation plus the memoized summary of turns that left the window.
+
+    turns[:summarized] are folded into summary; the window only moves forward, so each
+    turn is summarized at most once.
+    """
+
+    def __init__(self, system: str):
+        self.id = str(uuid4())
+        self.system = system
+        self.system_tokens = estimate_tokens(system)
+        self.turns: List[Turn] = []
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized = 0
+        self.last_used = time.monotonic()
+        # One turn at a time: a reply must be appended before the next context is built
+        self.lock = asyncio.Lock()
+
+    def append(self, role: str, content: str):
+        self.turns.append(Turn(role, content))
+
+    def window_start(self) -> int:
+        """First turn that still fits the budget next to the system prompt and summary"""
+        budget = CHAT_CONTEXT_TOKENS - self.system_tokens - CHAT_SUMMARY_TOKENS
+        start = len(self.turns)
+        used = 0
+        while start > self.summarized and used + self.turns[start - 1].tokens <= budget:
+            start -= 1
+            used += self.turns[start].tokens
+        # Always send the newest turn, even if it alone is over budget
+        return min(start, max(len(self.turns) - 1, self.summarized))
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.id,
+            "messages": [turn.message() for turn in self.turns],
+            "summary": self.summary,
+            "summarized_turns": self.summarized,
+        }
+
+
+class LocalSummarizer:
+    """Extractive summary: the first sentence of each dropped turn, newest kept when over budget"""
+
+    async def summarize(self, previous: str, turns: List[Turn], max_tokens: int) -> str:
+        lines = [previous] if previous else []
+        for turn in turns:
+            first_sentence = re.split(r"(?<=[.!?])\s", turn.content.strip(), maxsplit=1)[0]
+            lines.append(f"{turn.role}: {first_sentence}")
+        while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+            lines.pop(0)
+        summary = "\n".join(lines)
+        return summary[:max_tokens * 4]
+
+
+class ProviderSummarizer:
+    """Asks the chat model to fold the dropped turns into the running summary"""
+
+    def __init__(self, provider: ChatProvider):
+        self.provider = provider
+
+    async def summarize(self, previous: str, turns: List[Turn], max_tokens: int) -> str:
+        transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in turns)
+        if previous:
+            transcript = f"Summary so far:\n{previous}\n\nNew turns:\n{transcript}"
+        system = SUMMARY_PROMPT.format(words=max_tokens * 3 // 4)
+        fragments = [f async for f in self.provider.stream([{"role": "user", "content": transcript}], system)]
+        return "".join(fragments).strip()
+
+
+_sessions: "OrderedDict[str, Session]" = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def create_session(system: Optional[str] = None) -> Session:
+    session = Session(system or SYSTEM_PROMPT)
+    with _sessions_lock:
+        _sessions[session.id] = session
+        _evict()
+    return session
+
+
+def get_session(session_id: str) -> Optional[Session]:
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.last_used > CHAT_SESSION_TTL_SECONDS:
+            del _sessions[session_id]
+            return None
+        session.last_used = time.monotonic()
+        _sessions.move_to_end(session_id)
+        return session
+
+
+def delete_session(session_id: str) -> bool:
+    with _sessions_lock:
+        return _sessions.pop(session_id, None) is not None
+
+
+def _evict():
+    # Least recently used first; idle ones past their TTL go regardless of the cap
+    now = time.monotonic()
+    while _sessions:
+        oldest = next(iter(_sessions.values()))
+        if len(_sessions) <= CHAT_MAX_SESSIONS and now - oldest.last_used <= CHAT_SESSION_TTL_SECONDS:
+            break
+        _sessions.popitem(last=False)
+
+
+async def build_context(session: Session, provider: ChatProvider) -> Tuple[str, List[Message]]:
+    """System prompt (with the rolling summary) and the recent turns to send to the model.
+
+    Only turns newly pushed out of the window are summarized; earlier ones are already
+    in session.summary.
+    """
+    start = session.window_start()
+    if start > session.summarized:
+        summarizer = ProviderSummarizer(provider) if CHAT_SUMMARIZER == "provider" else LocalSummarizer()
+        session.summary = await summarizer.summarize(
+            session.summary, session.turns[session.summarized:start], CHAT_SUMMARY_TOKENS
+        )
+        session.summary_tokens = estimate_tokens(session.summary)
+        session.summarized = start
+
+    system = session.system
+    if session.summary:
+        system += f"\n\nSummary of the earlier conversation:\n{session.summary}"
+    return system, [turn.message() for turn in session.turns[start:]]
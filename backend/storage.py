@@ -0,0 +1,816 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from metrics import timed
+from models import (
+    Membership, MembershipTemplate, MembershipStatus, User, CustomerType,
+    FeatureLimit, FeatureUsage, PaymentInfo, IdempotencyRecord, CompanyQuota, QuotaAllocation
+)
+
+FEATURES = ("conversation", "analysis")
+
+
+def has_remaining_usage(membership: Membership, feature_type: str, now: datetime) -> bool:
+    """Whether one more use of feature_type fits in an active, unexpired membership"""
+    if feature_type not in FEATURES or membership.status != MembershipStatus.ACTIVE:
+        return False
+    # Compare timestamps: older rows mix naive (local) and UTC-aware datetimes.
+    # This guards the spend itself; the expiry scheduler flips status separately
+    if now.timestamp() > membership.expires_at.timestamp():
+        return False
+    limit = getattr(membership.limits, feature_type)
+    # None means unlimited
+    return limit is None or getattr(membership.usage, feature_type) < limit
+
+
+def quota_has_room(limits: FeatureLimit, usage: FeatureUsage, feature_type: str) -> bool:
+    """Whether one more use of feature_type fits in a company pool or a user's allocation"""
+    if feature_type not in FEATURES:
+        return False
+    limit = getattr(limits, feature_type)
+    return limit is None or getattr(usage, feature_type) < limit
+
+
+# Outcome of one usage event in a batch: the membership it was charged to and that
+# membership's usage right after the charge, or None if nothing could take it
+UsageResult = Optional[Tuple[Membership, FeatureUsage]]
+
+
+def apply_usage_batch(
+    updates: List[Tuple[str, str]],
+    load_memberships: Callable[[str], List[Membership]],
+    now: datetime
+) -> Tuple[List[UsageResult], Dict[str, Membership]]:
+    """Charge (user_id, feature_type) events in order, loading each user's memberships once.
+
+    Returns the per-event results and the memberships that changed, by id.
+    """
+    results: List[UsageResult] = []
+    changed: Dict[str, Membership] = {}
+    by_user: Dict[str, List[Membership]] = {}
+    for user_id, feature_type in updates:
+        memberships = by_user.get(user_id)
+        if memberships is None:
+            memberships = by_user[user_id] = load_memberships(user_id)
+        result = None
+        for membership in memberships:
+            if has_remaining_usage(membership, feature_type, now):
+                setattr(membership.usage, feature_type, getattr(membership.usage, feature_type) + 1)
+                changed[membership.id] = membership
+                result = (membership, membership.usage.model_copy())
+                break
+        results.append(result)
+    return results, changed
+
+
+class Store(ABC):
+    """Repository interface the routers use instead of touching db.py's dicts.
+
+    Objects handed out may be live (JSON backend) or fresh copies (SQLite backend),
+    so callers always save_* an object after mutating it.
+    """
+
+    # Users
+    @abstractmethod
+    def get_user(self, user_id: str) -> Optional[User]: ...
+
+    @abstractmethod
+    def users_for_company(self, company_id: str) -> List[User]: ...
+
+    @abstractmethod
+    def scan_users(
+        self, after: int, limit: int, customer_type: Optional[CustomerType] = None
+    ) -> Tuple[List[User], Optional[int]]:
+        """Up to limit users past scan position `after` (0 starts from the beginning),
+        plus the position to resume from, or None once the end is reached"""
+
+    def iter_users(self, customer_type: Optional[CustomerType] = None) -> Iterator[User]:
+        """Yield every matching user, fetching them a chunk at a time"""
+        after = 0
+        while after is not None:
+            users, after = self.scan_users(after, 500, customer_type)
+            yield from users
+
+    @abstractmethod
+    def save_user(self, user: User): ...
+
+    @abstractmethod
+    def delete_user(self, user_id: str) -> bool: ...
+
+    # Membership templates
+    @abstractmethod
+    def get_template(self, template_id: str) -> Optional[MembershipTemplate]: ...
+
+    @abstractmethod
+    def list_templates(self) -> List[MembershipTemplate]: ...
+
+    @abstractmethod
+    def save_template(self, template: MembershipTemplate): ...
+
+    @abstractmethod
+    def delete_template(self, template_id: str) -> bool: ...
+
+    # Memberships
+    @abstractmethod
+    def get_membership(self, membership_id: str) -> Optional[Membership]: ...
+
+    @abstractmethod
+    def memberships_for_user(self, user_id: str) -> List[Membership]: ...
+
+    @abstractmethod
+    def scan_memberships(
+        self,
+        after: int,
+        limit: int,
+        status: Optional[MembershipStatus] = None,
+        customer_type: Optional[CustomerType] = None
+    ) -> Tuple[List[Membership], Optional[int]]:
+        """Up to limit memberships past scan position `after`, like scan_users"""
+
+    def iter_memberships(
+        self,
+        status: Optional[MembershipStatus] = None,
+        customer_type: Optional[CustomerType] = None
+    ) -> Iterator[Membership]:
+        """Yield every matching membership, fetching them a chunk at a time"""
+        after = 0
+        while after is not None:
+            memberships, after = self.scan_memberships(after, 500, status, customer_type)
+            yield from memberships
+
+    @abstractmethod
+    def save_membership(self, membership: Membership): ...
+
+    @abstractmethod
+    def save_memberships(self, memberships: List[Membership]):
+        """save_membership for many memberships, persisted once"""
+
+    @abstractmethod
+    def delete_membership(self, membership_id: str) -> bool: ...
+
+    # Usage counters: the limit check and the increment happen as one atomic step,
+    # so concurrent requests (or workers) can never spend past a limit
+    @abstractmethod
+    def consume_usage(self, user_id: str, feature_type: str, count_unlimited: bool = True) -> Optional[Membership]:
+        """Spend one use from the user's first membership with room left for feature_type.
+
+        Returns the updated membership, or None if no membership can take it. With
+        count_unlimited=False an unlimited membership is picked without counting the use.
+        """
+
+    @abstractmethod
+    def consume_membership(self, membership_id: str, feature_type: str) -> Optional[Membership]:
+        """Spend one use of feature_type from a specific membership, None if it has no room left"""
+
+    @abstractmethod
+    def consume_usage_batch(self, updates: List[Tuple[str, str]]) -> List[UsageResult]:
+        """consume_usage for many (user_id, feature_type) events, in order, persisted once"""
+
+    # Company quotas: a B2B company's pooled usage, with optional per-user allocations
+    @abstractmethod
+    def get_company_quota(self, company_id: str) -> Optional[CompanyQuota]: ...
+
+    @abstractmethod
+    def save_company_quota(self, quota: CompanyQuota): ...
+
+    @abstractmethod
+    def delete_company_quota(self, company_id: str) -> bool:
+        """Drop the quota and its allocations"""
+
+    @abstractmethod
+    def get_quota_allocation(self, company_id: str, user_id: str) -> Optional[QuotaAllocation]: ...
+
+    @abstractmethod
+    def quota_allocations(self, company_id: str) -> List[QuotaAllocation]: ...
+
+    @abstractmethod
+    def save_quota_allocation(self, allocation: QuotaAllocation): ...
+
+    @abstractmethod
+    def delete_quota_allocation(self, company_id: str, user_id: str) -> bool: ...
+
+    @abstractmethod
+    def consume_company_quota(
+        self, company_id: str, user_id: str, feature_type: str
+    ) -> Optional[Tuple[CompanyQuota, QuotaAllocation]]:
+        """Spend one use from the company pool and the user's allocation as one atomic step.
+
+        Touches only those two entries, never the company's other users. Returns both
+        after the charge, or None if the company has no quota or either is used up.
+        """
+
+    # Expiry, driven by the scheduler in expiry.py
+    @abstractmethod
+    def expire_due(self, now: datetime) -> int:
+        """Flip every ACTIVE membership whose expires_at has passed to EXPIRED, returning the count"""
+
+    @abstractmethod
+    def next_expiry(self) -> Optional[datetime]:
+        """Earliest expires_at among ACTIVE memberships (may be early, never late)"""
+
+    # Idempotency keys, see idempotency.py
+    @abstractmethod
+    def get_idempotency_record(self, key: str) -> Optional[IdempotencyRecord]: ...
+
+    @abstractmethod
+    def claim_idempotency_key(
+        self, record: IdempotencyRecord, expired_before: float, stale_before: float
+    ) -> Optional[IdempotencyRecord]:
+        """Atomically store a pending record unless its key is taken, returning the taker if so.
+
+        Completed records created before expired_before and pending ones created before
+        stale_before (their request died) don't count and are replaced.
+        """
+
+    @abstractmethod
+    def save_idempotency_record(self, record: IdempotencyRecord): ...
+
+    @abstractmethod
+    def release_idempotency_key(self, key: str):
+        """Drop a pending claim whose request failed, so a retry runs it again"""
+
+    @abstractmethod
+    def prune_idempotency_records(self, expired_before: float, keep: int):
+        """Delete completed records created before expired_before or older than the newest
+        `keep` records; pending claims stay"""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    customer_type TEXT NOT NULL,
+    company_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_company ON users (company_id);
+
+CREATE TABLE IF NOT EXISTS membership_templates (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    customer_type TEXT NOT NULL,
+    duration_days INTEGER NOT NULL,
+    conversation_limit INTEGER,
+    analysis_limit INTEGER,
+    price REAL,
+    is_active INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS memberships (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    template_id TEXT,
+    customer_type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,  -- unix timestamps, so expiry comparisons are numeric
+    expires_at REAL NOT NULL,
+    conversation_limit INTEGER,
+    analysis_limit INTEGER,
+    conversation_usage INTEGER NOT NULL DEFAULT 0,
+    analysis_usage INTEGER NOT NULL DEFAULT 0,
+    payment_info TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_memberships_user ON memberships (user_id);
+CREATE INDEX IF NOT EXISTS idx_memberships_status_expires ON memberships (status, expires_at);
+
+CREATE TABLE IF NOT EXISTS company_quotas (
+    company_id TEXT PRIMARY KEY,
+    conversation_limit INTEGER,
+    analysis_limit INTEGER,
+    conversation_usage INTEGER NOT NULL DEFAULT 0,
+    analysis_usage INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS quota_allocations (
+    company_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    conversation_limit INTEGER,
+    analysis_limit INTEGER,
+    conversation_usage INTEGER NOT NULL DEFAULT 0,
+    analysis_usage INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (company_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    status_code INTEGER,  -- NULL while the first request is still running
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at);
+"""
+
+# Constant statements with ? placeholders: sqlite3 keeps them prepared in each
+# connection's statement cache
+UPSERT_USER = """
+INSERT INTO users (id, name, email, customer_type, company_id) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    name = excluded.name, email = excluded.email,
+    customer_type = excluded.customer_type, company_id = excluded.company_id
+"""
+UPSERT_TEMPLATE = """
+INSERT INTO membership_templates
+    (id, name, customer_type, duration_days, conversation_limit, analysis_limit, price, is_active)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    name = excluded.name, customer_type = excluded.customer_type,
+    duration_days = excluded.duration_days, conversation_limit = excluded.conversation_limit,
+    analysis_limit = excluded.analysis_limit, price = excluded.price, is_active = excluded.is_active
+"""
+UPSERT_MEMBERSHIP = """
+INSERT INTO memberships
+    (id, user_id, name, template_id, customer_type, status, created_at, expires_at,
+     conversation_limit, analysis_limit, conversation_usage, analysis_usage, payment_info)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    user_id = excluded.user_id, name = excluded.name, template_id = excluded.template_id,
+    customer_type = excluded.customer_type, status = excluded.status,
+    created_at = excluded.created_at, expires_at = excluded.expires_at,
+    conversation_limit = excluded.conversation_limit, analysis_limit = excluded.analysis_limit,
+    conversation_usage = excluded.conversation_usage, analysis_usage = excluded.analysis_usage,
+    payment_info = excluded.payment_info
+"""
+UPSERT_COMPANY_QUOTA = """
+INSERT INTO company_quotas
+    (company_id, conversation_limit, analysis_limit, conversation_usage, analysis_usage)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (company_id) DO UPDATE SET
+    conversation_limit = excluded.conversation_limit, analysis_limit = excluded.analysis_limit,
+    conversation_usage = excluded.conversation_usage, analysis_usage = excluded.analysis_usage
+"""
+UPSERT_QUOTA_ALLOCATION = """
+INSERT INTO quota_allocations
+    (company_id, user_id, conversation_limit, analysis_limit, conversation_usage, analysis_usage)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (company_id, user_id) DO UPDATE SET
+    conversation_limit = excluded.conversation_limit, analysis_limit = excluded.analysis_limit,
+    conversation_usage = excluded.conversation_usage, analysis_usage = excluded.analysis_usage
+"""
+UPSERT_IDEMPOTENCY_RECORD = """
+INSERT INTO idempotency_keys (key, fingerprint, created_at, status_code, body) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (key) DO UPDATE SET
+    fingerprint = excluded.fingerprint, created_at = excluded.created_at,
+    status_code = excluded.status_code, body = excluded.body
+"""
+
+
+def _user_row(user: User) -> tuple:
+    return (user.id, user.name, user.email, user.customer_type.value, user.company_id)
+
+
+def _user_from_row(row: sqlite3.Row) -> User:
+    return User(
+        id=row["id"],
+        name=row["name"],
+        email=row["email"],
+        customer_type=row["customer_type"],
+        company_id=row["company_id"]
+    )
+
+
+def _template_row(template: MembershipTemplate) -> tuple:
+    return (
+        template.id, template.name, template.customer_type.value, template.duration_days,
+        template.limits.conversation, template.limits.analysis, template.price, int(template.is_active)
+    )
+
+
+def _template_from_row(row: sqlite3.Row) -> MembershipTemplate:
+    return MembershipTemplate(
+        id=row["id"],
+        name=row["name"],
+        customer_type=row["customer_type"],
+        duration_days=row["duration_days"],
+        limits=FeatureLimit(conversation=row["conversation_limit"], analysis=row["analysis_limit"]),
+        price=row["price"],
+        is_active=bool(row["is_active"])
+    )
+
+
+def _membership_row(membership: Membership) -> tuple:
+    payment_info = membership.payment_info.model_dump_json() if membership.payment_info else None
+    return (
+        membership.id, membership.user_id, membership.name, membership.template_id,
+        membership.customer_type.value, membership.status.value,
+        membership.created_at.timestamp(), membership.expires_at.timestamp(),
+        membership.limits.conversation, membership.limits.analysis,
+        membership.usage.conversation, membership.usage.analysis, payment_info
+    )
+
+
+def _membership_from_row(row: sqlite3.Row) -> Membership:
+    return Membership(
+        id=row["id"],
+        user_id=row["user_id"],
+        name=row["name"],
+        template_id=row["template_id"],
+        customer_type=row["customer_type"],
+        status=row["status"],
+        created_at=datetime.fromtimestamp(row["created_at"], timezone.utc),
+        expires_at=datetime.fromtimestamp(row["expires_at"], timezone.utc),
+        limits=FeatureLimit(conversation=row["conversation_limit"], analysis=row["analysis_limit"]),
+        usage=FeatureUsage(conversation=row["conversation_usage"], analysis=row["analysis_usage"]),
+        payment_info=PaymentInfo(**json.loads(row["payment_info"])) if row["payment_info"] else None
+    )
+
+
+def _quota_row(quota: CompanyQuota) -> tuple:
+    return (
+        quota.company_id, quota.limits.conversation, quota.limits.analysis,
+        quota.usage.conversation, quota.usage.analysis
+    )
+
+
+def _quota_from_row(row: sqlite3.Row) -> CompanyQuota:
+    return CompanyQuota(
+        company_id=row["company_id"],
+        limits=FeatureLimit(conversation=row["conversation_limit"], analysis=row["analysis_limit"]),
+        usage=FeatureUsage(conversation=row["conversation_usage"], analysis=row["analysis_usage"])
+    )
+
+
+def _allocation_row(allocation: QuotaAllocation) -> tuple:
+    return (
+        allocation.company_id, allocation.user_id, allocation.limits.conversation, allocation.limits.analysis,
+        allocation.usage.conversation, allocation.usage.analysis
+    )
+
+
+def _allocation_from_row(row: sqlite3.Row) -> QuotaAllocation:
+    return QuotaAllocation(
+        company_id=row["company_id"],
+        user_id=row["user_id"],
+        limits=FeatureLimit(conversation=row["conversation_limit"], analysis=row["analysis_limit"]),
+        usage=FeatureUsage(conversation=row["conversation_usage"], analysis=row["analysis_usage"])
+    )
+
+
+def _idempotency_row(record: IdempotencyRecord) -> tuple:
+    return (record.key, record.fingerprint, record.created_at, record.status_code, record.body)
+
+
+def _idempotency_from_row(row: sqlite3.Row) -> IdempotencyRecord:
+    return IdempotencyRecord(
+        key=row["key"],
+        fingerprint=row["fingerprint"],
+        created_at=row["created_at"],
+        status_code=row["status_code"],
+        body=row["body"]
+    )
+
+
+def idempotency_key_taken(existing: IdempotencyRecord, expired_before: float, stale_before: float) -> bool:
+    """Whether an existing record still holds its key (see Store.claim_idempotency_key)"""
+    if existing.status_code is None:
+        return existing.created_at >= stale_before
+    return existing.created_at >= expired_before
+
+
+# Per-feature column names for the usage statements; never built from request input
+_USAGE_COLUMNS = {
+    feature: (f"{feature}_limit", f"{feature}_usage") for feature in FEATURES
+}
+_USABLE = "status = 'active' AND expires_at > ? AND ({limit} IS NULL OR {usage} < {limit})"
+
+
+class SQLiteStore(Store):
+    """Store backed by a single SQLite file in WAL mode.
+
+    Each worker process (and each of its threads) gets its own connection, so several
+    uvicorn workers can share one database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def is_empty(self) -> bool:
+        conn = self._conn()
+        return all(
+            conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+            for table in ("users", "membership_templates", "memberships")
+        )
+
+    def import_data(
+        self,
+        users: Iterable[User],
+        templates: Iterable[MembershipTemplate],
+        memberships: Iterable[Membership],
+        idempotency_records: Iterable[IdempotencyRecord] = (),
+        company_quotas: Iterable[CompanyQuota] = (),
+        quota_allocations: Iterable[QuotaAllocation] = ()
+    ):
+        """Bulk-load existing data (e.g. data.json) in a single transaction"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(UPSERT_USER, (_user_row(u) for u in users))
+            conn.executemany(UPSERT_TEMPLATE, (_template_row(t) for t in templates))
+            conn.executemany(UPSERT_MEMBERSHIP, (_membership_row(m) for m in memberships))
+            conn.executemany(UPSERT_IDEMPOTENCY_RECORD, (_idempotency_row(r) for r in idempotency_records))
+            conn.executemany(UPSERT_COMPANY_QUOTA, (_quota_row(q) for q in company_quotas))
+            conn.executemany(UPSERT_QUOTA_ALLOCATION, (_allocation_row(a) for a in quota_allocations))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # Users
+    def get_user(self, user_id: str) -> Optional[User]:
+        row = self._conn().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        return _user_from_row(row) if row else None
+
+    def users_for_company(self, company_id: str) -> List[User]:
+        rows = self._conn().execute("SELECT * FROM users WHERE company_id = ? ORDER BY rowid", (company_id,))
+        return [_user_from_row(row) for row in rows]
+
+    @timed("scan_users")
+    def scan_users(
+        self, after: int, limit: int, customer_type: Optional[CustomerType] = None
+    ) -> Tuple[List[User], Optional[int]]:
+        # Keyset pagination: the scan position is the last rowid handed out
+        rows = self._scan("users", after, limit, customer_type=customer_type)
+        return [_user_from_row(row) for row in rows], self._next_position(rows, limit)
+
+    def save_user(self, user: User):
+        self._conn().execute(UPSERT_USER, _user_row(user))
+
+    def delete_user(self, user_id: str) -> bool:
+        return self._conn().execute("DELETE FROM users WHERE id = ?", (user_id,)).rowcount > 0
+
+    # Membership templates
+    def get_template(self, template_id: str) -> Optional[MembershipTemplate]:
+        row = self._conn().execute("SELECT * FROM membership_templates WHERE id = ?", (template_id,)).fetchone()
+        return _template_from_row(row) if row else None
+
+    def list_templates(self) -> List[MembershipTemplate]:
+        rows = self._conn().execute("SELECT * FROM membership_templates ORDER BY rowid")
+        return [_template_from_row(row) for row in rows]
+
+    def save_template(self, template: MembershipTemplate):
+        self._conn().execute(UPSERT_TEMPLATE, _template_row(template))
+
+    def delete_template(self, template_id: str) -> bool:
+        return self._conn().execute("DELETE FROM membership_templates WHERE id = ?", (template_id,)).rowcount > 0
+
+    # Memberships
+    def get_membership(self, membership_id: str) -> Optional[Membership]:
+        row = self._conn().execute("SELECT * FROM memberships WHERE id = ?", (membership_id,)).fetchone()
+        return _membership_from_row(row) if row else None
+
+    def memberships_for_user(self, user_id: str) -> List[Membership]:
+        rows = self._conn().execute("SELECT * FROM memberships WHERE user_id = ? ORDER BY rowid", (user_id,))
+        return [_membership_from_row(row) for row in rows]
+
+    @timed("scan_memberships")
+    def scan_memberships(
+        self,
+        after: int,
+        limit: int,
+        status: Optional[MembershipStatus] = None,
+        customer_type: Optional[CustomerType] = None
+    ) -> Tuple[List[Membership], Optional[int]]:
+        rows = self._scan("memberships", after, limit, status=status, customer_type=customer_type)
+        return [_membership_from_row(row) for row in rows], self._next_position(rows, limit)
+
+    def _scan(self, table: str, after: int, limit: int, **filters) -> List[sqlite3.Row]:
+        where = ["rowid > ?"]
+        params: list = [after]
+        for column, value in filters.items():
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value.value)
+        params.append(limit)
+        return self._conn().execute(
+            f"SELECT rowid AS position, * FROM {table} WHERE {' AND '.join(where)} ORDER BY rowid LIMIT ?",
+            params
+        ).fetchall()
+
+    @staticmethod
+    def _next_position(rows: List[sqlite3.Row], limit: int) -> Optional[int]:
+        return rows[-1]["position"] if len(rows) == limit else None
+
+    def save_membership(self, membership: Membership):
+        self._conn().execute(UPSERT_MEMBERSHIP, _membership_row(membership))
+
+    def save_memberships(self, memberships: List[Membership]):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(UPSERT_MEMBERSHIP, (_membership_row(m) for m in memberships))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete_membership(self, membership_id: str) -> bool:
+        return self._conn().execute("DELETE FROM memberships WHERE id = ?", (membership_id,)).rowcount > 0
+
+    def consume_usage(self, user_id: str, feature_type: str, count_unlimited: bool = True) -> Optional[Membership]:
+        if feature_type not in FEATURES:
+            return None
+        limit, usage = _USAGE_COLUMNS[feature_type]
+        now = datetime.now(timezone.utc).timestamp()
+        # BEGIN IMMEDIATE takes the write lock up front, so no other connection in any
+        # worker can spend from the same row between our check and our increment
+        return self._spend(
+            f"SELECT id, {limit} IS NULL AS unlimited FROM memberships "
+            f"WHERE user_id = ? AND {_USABLE.format(limit=limit, usage=usage)} ORDER BY rowid LIMIT 1",
+            (user_id, now), usage, count_unlimited
+        )
+
+    def consume_membership(self, membership_id: str, feature_type: str) -> Optional[Membership]:
+        if feature_type not in FEATURES:
+            return None
+        limit, usage = _USAGE_COLUMNS[feature_type]
+        now = datetime.now(timezone.utc).timestamp()
+        return self._spend(
+            f"SELECT id, {limit} IS NULL AS unlimited FROM memberships "
+            f"WHERE id = ? AND {_USABLE.format(limit=limit, usage=usage)}",
+            (membership_id, now), usage, True
+        )
+
+    def consume_usage_batch(self, updates: List[Tuple[str, str]]) -> List[UsageResult]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            results, changed = apply_usage_batch(
+                updates, self.memberships_for_user, datetime.now(timezone.utc)
+            )
+            conn.executemany(
+                "UPDATE memberships SET conversation_usage = ?, analysis_usage = ? WHERE id = ?",
+                ((m.usage.conversation, m.usage.analysis, m.id) for m in changed.values())
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+
+    # Company quotas
+    def get_company_quota(self, company_id: str) -> Optional[CompanyQuota]:
+        row = self._conn().execute("SELECT * FROM company_quotas WHERE company_id = ?", (company_id,)).fetchone()
+        return _quota_from_row(row) if row else None
+
+    def save_company_quota(self, quota: CompanyQuota):
+        self._conn().execute(UPSERT_COMPANY_QUOTA, _quota_row(quota))
+
+    def delete_company_quota(self, company_id: str) -> bool:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = conn.execute("DELETE FROM company_quotas WHERE company_id = ?", (company_id,)).rowcount > 0
+            conn.execute("DELETE FROM quota_allocations WHERE company_id = ?", (company_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return deleted
+
+    def get_quota_allocation(self, company_id: str, user_id: str) -> Optional[QuotaAllocation]:
+        row = self._conn().execute(
+            "SELECT * FROM quota_allocations WHERE company_id = ? AND user_id = ?", (company_id, user_id)
+        ).fetchone()
+        return _allocation_from_row(row) if row else None
+
+    def quota_allocations(self, company_id: str) -> List[QuotaAllocation]:
+        rows = self._conn().execute(
+            "SELECT * FROM quota_allocations WHERE company_id = ? ORDER BY rowid", (company_id,)
+        )
+        return [_allocation_from_row(row) for row in rows]
+
+    def save_quota_allocation(self, allocation: QuotaAllocation):
+        self._conn().execute(UPSERT_QUOTA_ALLOCATION, _allocation_row(allocation))
+
+    def delete_quota_allocation(self, company_id: str, user_id: str) -> bool:
+        return self._conn().execute(
+            "DELETE FROM quota_allocations WHERE company_id = ? AND user_id = ?", (company_id, user_id)
+        ).rowcount > 0
+
+    def consume_company_quota(
+        self, company_id: str, user_id: str, feature_type: str
+    ) -> Optional[Tuple[CompanyQuota, QuotaAllocation]]:
+        if feature_type not in FEATURES:
+            return None
+        limit, usage = _USAGE_COLUMNS[feature_type]
+        room = f"({limit} IS NULL OR {usage} < {limit})"
+        conn = self._conn()
+        # Both conditional increments commit together or not at all
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            spent = conn.execute(
+                f"UPDATE company_quotas SET {usage} = {usage} + 1 WHERE company_id = ? AND {room}", (company_id,)
+            ).rowcount
+            if spent:
+                conn.execute(
+                    "INSERT OR IGNORE INTO quota_allocations (company_id, user_id) VALUES (?, ?)", (company_id, user_id)
+                )
+                spent = conn.execute(
+                    f"UPDATE quota_allocations SET {usage} = {usage} + 1 "
+                    f"WHERE company_id = ? AND user_id = ? AND {room}", (company_id, user_id)
+                ).rowcount
+            if not spent:
+                conn.execute("ROLLBACK")
+                return None
+            quota = conn.execute("SELECT * FROM company_quotas WHERE company_id = ?", (company_id,)).fetchone()
+            allocation = conn.execute(
+                "SELECT * FROM quota_allocations WHERE company_id = ? AND user_id = ?", (company_id, user_id)
+            ).fetchone()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return _quota_from_row(quota), _allocation_from_row(allocation)
+
+    @timed("expire_due")
+    def expire_due(self, now: datetime) -> int:
+        # One batched update, served by the (status, expires_at) index
+        return self._conn().execute(
+            "UPDATE memberships SET status = 'expired' WHERE status = 'active' AND expires_at <= ?",
+            (now.timestamp(),)
+        ).rowcount
+
+    def next_expiry(self) -> Optional[datetime]:
+        row = self._conn().execute(
+            "SELECT MIN(expires_at) AS next_expiry FROM memberships WHERE status = 'active'"
+        ).fetchone()
+        if row["next_expiry"] is None:
+            return None
+        return datetime.fromtimestamp(row["next_expiry"], timezone.utc)
+
+    # Idempotency keys
+    def get_idempotency_record(self, key: str) -> Optional[IdempotencyRecord]:
+        row = self._conn().execute("SELECT * FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        return _idempotency_from_row(row) if row else None
+
+    def claim_idempotency_key(
+        self, record: IdempotencyRecord, expired_before: float, stale_before: float
+    ) -> Optional[IdempotencyRecord]:
+        conn = self._conn()
+        # The write lock makes check-and-insert atomic across worker processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM idempotency_keys WHERE key = ?", (record.key,)).fetchone()
+            existing = _idempotency_from_row(row) if row else None
+            if existing is not None and idempotency_key_taken(existing, expired_before, stale_before):
+                conn.execute("COMMIT")
+                return existing
+            conn.execute(UPSERT_IDEMPOTENCY_RECORD, _idempotency_row(record))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+    def save_idempotency_record(self, record: IdempotencyRecord):
+        self._conn().execute(UPSERT_IDEMPOTENCY_RECORD, _idempotency_row(record))
+
+    def release_idempotency_key(self, key: str):
+        self._conn().execute("DELETE FROM idempotency_keys WHERE key = ? AND status_code IS NULL", (key,))
+
+    def prune_idempotency_records(self, expired_before: float, keep: int):
+        conn = self._conn()
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE status_code IS NOT NULL AND created_at < ?", (expired_before,)
+        )
+        # By created_at, the JSON store's order; pending claims count but never go
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE status_code IS NOT NULL AND key IN ("
+            "SELECT key FROM idempotency_keys ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (keep,)
+        )
+
+    def _spend(self, select: str, params: tuple, usage: str, count_unlimited: bool) -> Optional[Membership]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            candidate = conn.execute(select, params).fetchone()
+            if candidate is None:
+                conn.execute("COMMIT")
+                return None
+            if count_unlimited or not candidate["unlimited"]:
+                conn.execute(f"UPDATE memberships SET {usage} = {usage} + 1 WHERE id = ?", (candidate["id"],))
+            row = conn.execute("SELECT * FROM memberships WHERE id = ?", (candidate["id"],)).fetchone()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return _membership_from_row(row)
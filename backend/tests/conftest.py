@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+from uuid import uuid4
+
+import pytest
+
+# The app reads its configuration at import time, so point it at a throwaway data
+# directory (seeded with the repo's data.json) before anything imports db
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix="ringle-tests-")
+shutil.copy(os.path.join(BACKEND_DIR, "data.json"), DATA_DIR)
+os.environ["DATA_DIR"] = DATA_DIR
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+# Tests hit the same routes far faster than any client would
+os.environ["RATE_LIMITS"] = ""
+sys.path.insert(0, BACKEND_DIR)
+
+from fastapi.testclient import TestClient  # noqa: E402
+import db  # noqa: E402
+import idempotency  # noqa: E402
+import main  # noqa: E402
+from models import CustomerType, User  # noqa: E402
+from routes import admin, membership, payments, templates, users  # noqa: E402
+from storage import SQLiteStore  # noqa: E402
+
+ROUTE_MODULES = (admin, membership, payments, templates, users, idempotency)
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path, monkeypatch):
+    """The store the routes use: the app's json store, or a fresh SQLiteStore patched in"""
+    if request.param == "json":
+        yield db.store
+        return
+    sqlite_store = SQLiteStore(str(tmp_path / "data.sqlite3"))
+    for template in db.store.list_templates():
+        sqlite_store.save_template(template)
+    for module in ROUTE_MODULES:
+        monkeypatch.setattr(module, "store", sqlite_store)
+    yield sqlite_store
+
+
+@pytest.fixture
+def make_user(store):
+    def make(customer_type: CustomerType = CustomerType.B2C, company_id=None) -> User:
+        user = User(
+            id=f"test-user-{uuid4()}", name="Test User", email="test@example.com",
+            customer_type=customer_type, company_id=company_id
+        )
+        store.save_user(user)
+        return user
+    return make
+
+
+@pytest.fixture
+def assign(client, store):
+    def assign(user_id: str, template_id: str = "basic-b2c") -> dict:
+        response = client.post(
+            "/api/v1/admin/assign-membership",
+            json={"user_id": user_id, "template_id": template_id, "assigned_by": "admin-1"}
+        )
+        assert response.status_code == 200, response.text
+        return response.json()["membership"]
+    return assign
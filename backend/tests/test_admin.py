@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from models import CustomerType, MembershipStatus
+
+
+def test_suspend_then_activate(client, store, make_user, assign):
+    user = make_user()
+    membership = assign(user.id)
+
+    response = client.patch(f"/api/v1/admin/memberships/{membership['id']}/suspend", params={"admin_id": "admin-1"})
+    assert response.status_code == 200
+    assert store.get_membership(membership["id"]).status == MembershipStatus.SUSPENDED
+
+    response = client.patch(f"/api/v1/admin/memberships/{membership['id']}/activate", params={"admin_id": "admin-1"})
+    assert response.status_code == 200, response.text
+    assert store.get_membership(membership["id"]).status == MembershipStatus.ACTIVE
+
+
+def test_activate_rejects_expired_membership(client, store, make_user, assign):
+    user = make_user()
+    membership = store.get_membership(assign(user.id)["id"])
+    store.save_membership(membership.model_copy(update={
+        "status": MembershipStatus.SUSPENDED,
+        "expires_at": datetime.now(timezone.utc) - timedelta(days=1),
+    }))
+
+    response = client.patch(f"/api/v1/admin/memberships/{membership.id}/activate", params={"admin_id": "admin-1"})
+    assert response.status_code == 400
+    assert store.get_membership(membership.id).status == MembershipStatus.SUSPENDED
+
+
+def test_b2b_template_rejected_for_b2c_user(client, store, make_user):
+    user = make_user(CustomerType.B2C)
+    response = client.post(
+        "/api/v1/admin/assign-membership",
+        json={"user_id": user.id, "template_id": "basic-b2b", "assigned_by": "admin-1"}
+    )
+    assert response.status_code == 400
+
+
+def test_bulk_assigned_membership_can_be_reactivated(client, store, make_user):
+    company_id = f"company-{uuid4()}"
+    user = make_user(CustomerType.B2B, company_id)
+    response = client.post(
+        "/api/v1/admin/assign-memberships",
+        json={"template_id": "basic-b2b", "assigned_by": "admin-1", "company_id": company_id}
+    )
+    assert response.json()["assigned"] == 1
+    membership = store.memberships_for_user(user.id)[0]
+
+    client.patch(f"/api/v1/admin/memberships/{membership.id}/suspend", params={"admin_id": "admin-1"})
+    response = client.patch(f"/api/v1/admin/memberships/{membership.id}/activate", params={"admin_id": "admin-1"})
+
+    assert response.status_code == 200, response.text
+
+
+def test_every_creation_path_stores_utc(client, store, make_user, assign):
+    user = make_user()
+    assigned = store.get_membership(assign(user.id)["id"])
+    paid = client.post(
+        "/api/v1/payments/process",
+        json={"user_id": user.id, "template_id": "basic-b2c", "payment_method": "card", "amount": 9.99}
+    ).json()["membership"]
+
+    assert assigned.created_at.utcoffset() == timedelta(0)
+    assert assigned.expires_at.utcoffset() == timedelta(0)
+    assert datetime.fromisoformat(paid["expires_at"]).utcoffset() == timedelta(0)
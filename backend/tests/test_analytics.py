@@ -0,0 +1,62 @@
+import sqlite3
+import time
+
+import pytest
+
+import analytics
+from analytics import Rollups, RollupStore
+
+
+def rollups() -> Rollups:
+    hour = 3600
+    rollup = Rollups(hourly_size=24, daily_size=30)
+    for offset, template, amount in [(0, "basic", 1), (1, "basic", 2), (1, "premium", 5), (3, "basic", 1), (30, "premium", 9)]:
+        rollup.add("usage.conversation", [("template", template)], amount, at=(1000 + offset) * hour)
+    return rollup
+
+
+@pytest.mark.skipif(analytics.np is None, reason="NumPy is not installed")
+def test_numpy_and_python_windows_agree(monkeypatch):
+    # Hour 1030 took over hour 1006's slot in the 24-slot ring, so 1006 must read 0
+    vectorized = rollups().query("usage.conversation", "template", "hour", 1000, 1008, limit=10)
+    monkeypatch.setattr(analytics, "np", None)
+    pure = rollups().query("usage.conversation", "template", "hour", 1000, 1008, limit=10)
+
+    assert vectorized == pure
+    assert vectorized["total"] == 9
+    assert [(group["key"], group["counts"]) for group in vectorized["groups"]] == [
+        ("premium", [0, 5, 0, 0, 0, 0, 0, 0]), ("basic", [1, 2, 0, 1, 0, 0, 0, 0])
+    ]
+
+
+def test_workers_share_their_counts(tmp_path):
+    path = str(tmp_path / "analytics.sqlite3")
+    workers = [(Rollups(24, 30, shared=True), RollupStore(path)) for _ in range(2)]
+    hour = int(time.time() // 3600)
+    for amount, (rollup, store) in enumerate(workers, 1):
+        rollup.add("usage.analysis", [("company", "acme")], amount)
+        store.sync(rollup)
+    workers[1][0].add("usage.analysis", [("company", "acme")], 10)  # not flushed yet
+
+    totals = [rollup.query("usage.analysis", "company", "hour", hour, hour + 1, 10)["total"] for rollup, store in workers]
+    workers[0][1].sync(workers[0][0])
+    assert totals == [1, 13]
+    assert workers[0][0].query("usage.analysis", "company", "hour", hour, hour + 1, 10)["total"] == 3
+
+
+def test_failed_flush_is_retried(tmp_path, monkeypatch):
+    rollup, store = Rollups(24, 30, shared=True), RollupStore(str(tmp_path / "analytics.sqlite3"))
+    rollup.add("usage.analysis", [], 2)
+
+    def fail(*args):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(store, "_flush", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        store.sync(rollup)
+    monkeypatch.undo()
+    store.sync(rollup)
+
+    fresh = Rollups(24, 30, shared=True)
+    RollupStore(str(tmp_path / "analytics.sqlite3")).sync(fresh)
+    hour = int(time.time() // 3600)
+    assert fresh.query("usage.analysis", "all", "hour", hour, hour + 1, 10)["total"] == 2
@@ -0,0 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import BACKEND_DIR
+
+
+def test_api_benchmark_runs_without_errors(tmp_path):
+    output = tmp_path / "bench.json"
+    command = [
+        sys.executable, "-m", "benchmarks.api_bench",
+        "--sizes", "20", "--requests", "3", "--concurrency", "2", "--output", str(output),
+    ]
+
+    result = subprocess.run(command, cwd=BACKEND_DIR, env=dict(os.environ), capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    results = json.loads(output.read_text())["results"]
+    timed = [row for row in results if "requests" in row]
+    assert {row["operation"] for row in timed} >= {"usage/check", "payments/process", "GET /memberships?limit=100"}
+    assert all(row["errors"] == 0 for row in timed)
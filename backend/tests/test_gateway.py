@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from gateway import CircuitBreaker, GatewayUnavailable, PaymentGatewayClient
+
+
+def test_breaker_opens_after_threshold_and_probes_after_cooldown():
+    breaker = CircuitBreaker(threshold=2, cooldown=0)
+    breaker.record_failure()
+    assert breaker.opened_at is None
+    breaker.record_failure()
+    assert breaker.opened_at is not None
+
+    assert breaker.allow()      # the probe
+    assert not breaker.allow()  # everyone else waits for it
+    breaker.record_success()
+    assert breaker.allow() and breaker.opened_at is None
+
+
+def run_charge(client):
+    async def charge():
+        try:
+            await client.charge("card", 9.99, "USD", "key")
+        finally:
+            await client.close()
+    asyncio.run(charge())
+
+
+@pytest.mark.parametrize("error", [ValueError("not JSON"), asyncio.CancelledError()])
+def test_probe_that_dies_unexpectedly_frees_the_circuit(monkeypatch, error):
+    client = PaymentGatewayClient()
+    client.breaker = CircuitBreaker(threshold=1, cooldown=0)
+    client.breaker.record_failure()
+
+    async def attempt(*args):
+        raise error
+    monkeypatch.setattr(client, "_attempt", attempt)
+
+    with pytest.raises(type(error)):
+        run_charge(client)
+    assert not client.breaker.probing
+    # After the cooldown the next caller gets to probe again instead of a 503
+    assert client.breaker.allow()
+
+
+def test_cancelled_requests_never_open_the_circuit(monkeypatch):
+    client = PaymentGatewayClient()
+    client.breaker = CircuitBreaker(threshold=2, cooldown=60)
+
+    async def attempt(*args):
+        raise asyncio.CancelledError()
+    monkeypatch.setattr(client, "_attempt", attempt)
+
+    for _ in range(5):
+        with pytest.raises(asyncio.CancelledError):
+            run_charge(client)
+    assert client.breaker.failures == 0 and client.breaker.allow()
+
+
+def test_slow_gateway_times_out(monkeypatch):
+    client = PaymentGatewayClient()
+    monkeypatch.setattr("gateway.PAYMENT_GATEWAY_TIMEOUT_SECONDS", 0.01)
+    monkeypatch.setattr("gateway.PAYMENT_GATEWAY_RETRIES", 0)
+
+    async def post(*args):
+        await asyncio.sleep(1)
+    monkeypatch.setattr(client, "_post", post)
+
+    with pytest.raises(GatewayUnavailable):
+        run_charge(client)
+    assert client.breaker.failures == 1
+
+
+def test_open_circuit_fails_fast():
+    client = PaymentGatewayClient()
+    client.breaker = CircuitBreaker(threshold=1, cooldown=60)
+    client.breaker.record_failure()
+
+    with pytest.raises(GatewayUnavailable):
+        run_charge(client)
@@ -0,0 +1,28 @@
+import logging
+import queue
+
+from logging_setup import _QueueHandler
+
+
+def test_queued_records_keep_the_args_as_logged():
+    log_queue = queue.Queue()
+    handler = _QueueHandler(log_queue)
+    logger = logging.getLogger("tests.queued")
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    usage = {"conversation": 1}
+    try:
+        logger.warning("usage %s", usage)
+        usage["conversation"] = 2
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed")
+    finally:
+        logger.removeHandler(handler)
+
+    first, second = log_queue.get_nowait(), log_queue.get_nowait()
+    assert first.getMessage() == "usage {'conversation': 1}"
+    assert second.exc_info is None
+    assert "ValueError: boom" in second.exc_text
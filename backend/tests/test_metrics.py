@@ -0,0 +1,33 @@
+from uuid import uuid4
+
+import main
+import metrics
+
+
+def test_routes_are_labelled_by_template(client):
+    client.get("/api/v1/users/user-1")
+    client.get("/no-such-route")
+
+    text = client.get("/metrics").text
+
+    assert 'http_requests_total{method="GET",route="/api/v1/users/{user_id}",status="200"}' in text
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"}' in text
+
+
+def test_endpoints_are_wrapped_once():
+    route = next(route for route in main.app.routes if getattr(route, "path", None) == "/api/v1/users/{user_id}")
+
+    assert route.endpoint._profiled
+    assert not getattr(route.endpoint.__wrapped__, "_profiled", False)
+
+
+def test_whole_chat_replies_are_not_timed_as_first_byte(client):
+    def count(operation):
+        histogram = metrics._operation_latency.get(operation)
+        return sum(histogram.counts) if histogram else 0
+    ttfb, total = count("chat_ttfb"), count("chat_total")
+
+    response = client.post("/api/v1/chat", json={"messages": [{"role": "user", "content": f"Hello {uuid4()}"}]})
+
+    assert response.status_code == 200
+    assert (count("chat_ttfb"), count("chat_total")) == (ttfb, total + 1)
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def memberships(client, store, make_user, assign):
+    for _ in range(7):
+        assign(make_user().id)
+    return {membership.id for membership in store.iter_memberships()}
+
+
+def pages(client, path, limit, cursor=None):
+    ids = []
+    while True:
+        params = {"limit": limit} if cursor is None else {"limit": limit, "cursor": cursor}
+        response = client.get(path, params=params)
+        assert response.status_code == 200
+        ids += [item["id"] for item in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return ids
+
+
+def test_cursor_pages_cover_every_membership_once(client, memberships):
+    ids = pages(client, "/api/v1/memberships", limit=3)
+
+    assert len(ids) == len(set(ids))
+    assert set(ids) == memberships
+
+
+def test_rows_added_while_paging_show_up_later(client, store, memberships, make_user, assign):
+    first = client.get("/api/v1/memberships", params={"limit": 2})
+    added = assign(make_user().id)
+
+    rest = pages(client, "/api/v1/memberships", 1000, first.headers["X-Next-Cursor"])
+    ids = [item["id"] for item in first.json()] + rest
+
+    assert len(ids) == len(set(ids))
+    assert set(ids) == memberships | {added["id"]}
+
+
+def test_invalid_cursor(client, store):
+    assert client.get("/api/v1/memberships", params={"limit": 2, "cursor": "abc"}).status_code == 400
+
+
+def test_ndjson_stream(client, memberships):
+    response = client.get("/api/v1/memberships", headers={"Accept": "application/x-ndjson"})
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert {json.loads(line)["id"] for line in response.text.splitlines()} == memberships
+
+
+def test_rows_deleted_while_paging_skip_nothing(client, store, memberships):
+    first = client.get("/api/v1/memberships", params={"limit": 3})
+    seen = [item["id"] for item in first.json()]
+    for membership_id in seen[:2]:
+        store.delete_membership(membership_id)
+
+    rest = pages(client, "/api/v1/memberships", 2, first.headers["X-Next-Cursor"])
+
+    assert set(seen) | set(rest) == memberships
+    assert not set(seen) & set(rest)
+
+
+def test_scan_order_survives_compaction():
+    order = db._ScanOrder()
+    for key in range(3000):
+        order.add(str(key))
+    for key in range(2990):
+        order.remove(str(key))
+    order.add("0")  # back in, at the end
+
+    found, more = order.after(0, 100)
+    assert [key for _, key in found] == [str(key) for key in range(2990, 3000)] + ["0"]
+    assert not more
+    assert order.after(found[4][0], 3)[0] == found[5:8]
@@ -0,0 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from models import IdempotencyRecord
+
+
+def pay(client, user_id, key, amount=9.99):
+    return client.post(
+        "/api/v1/payments/process",
+        json={"user_id": user_id, "template_id": "basic-b2c", "payment_method": "card", "amount": amount},
+        headers={"Idempotency-Key": key}
+    )
+
+
+def test_retry_replays_the_first_response(client, store, make_user):
+    user = make_user()
+    key = str(uuid4())
+
+    first = pay(client, user.id, key)
+    retry = pay(client, user.id, key)
+
+    assert first.status_code == 200
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert len(store.memberships_for_user(user.id)) == 1
+
+
+def test_concurrent_retries_charge_once(client, store, make_user):
+    user = make_user()
+    key = str(uuid4())
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        responses = list(pool.map(lambda _: pay(client, user.id, key), range(6)))
+
+    assert [response.status_code for response in responses] == [200] * 6
+    assert len({response.json()["transaction_id"] for response in responses}) == 1
+    assert len(store.memberships_for_user(user.id)) == 1
+
+
+def test_key_reused_for_a_different_request(client, store, make_user):
+    user = make_user()
+    key = str(uuid4())
+
+    assert pay(client, user.id, key).status_code == 200
+    assert pay(client, user.id, key, amount=19.99).status_code == 422
+
+
+def test_client_errors_are_replayed(client, store, make_user):
+    user = make_user()
+    key = str(uuid4())
+
+    assert pay(client, user.id, key, amount=1.0).status_code == 400
+    retry = pay(client, user.id, key, amount=1.0)
+    assert retry.status_code == 400
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert store.memberships_for_user(user.id) == []
+
+
+def test_prune_keeps_pending_claims_and_recent_records(store):
+    # Later than every record earlier tests left behind, which expire along with `old`
+    now = time.time() + 1000
+    old, recent, pending = (f"{name}-{uuid4()}" for name in ("old", "recent", "pending"))
+    store.save_idempotency_record(IdempotencyRecord(key=old, fingerprint="f", created_at=now - 100, status_code=200, body="{}"))
+    assert store.claim_idempotency_key(
+        IdempotencyRecord(key=pending, fingerprint="f", created_at=now - 50), expired_before=now - 10, stale_before=now - 60
+    ) is None
+    store.save_idempotency_record(IdempotencyRecord(key=recent, fingerprint="f", created_at=now, status_code=200, body="{}"))
+
+    store.prune_idempotency_records(now - 10, keep=100)
+
+    assert store.get_idempotency_record(old) is None
+    assert store.get_idempotency_record(pending) is not None
+    assert store.get_idempotency_record(recent) is not None
+
+
+def test_prune_caps_the_number_of_records(store):
+    now = time.time() + 2000
+    # Every key is new and inside the TTL, like a client sending a fresh key each time
+    keys = [f"burst-{i}-{uuid4()}" for i in range(6)]
+    for offset, key in enumerate(keys[:2]):
+        store.save_idempotency_record(IdempotencyRecord(key=key, fingerprint="f", created_at=now + offset, status_code=200, body="{}"))
+    pending = f"pending-{uuid4()}"
+    assert store.claim_idempotency_key(
+        IdempotencyRecord(key=pending, fingerprint="f", created_at=now + 2), expired_before=0, stale_before=0
+    ) is None
+    for offset, key in enumerate(keys[2:], 3):
+        store.save_idempotency_record(IdempotencyRecord(key=key, fingerprint="f", created_at=now + offset, status_code=200, body="{}"))
+
+    store.prune_idempotency_records(0, keep=3)
+
+    assert [store.get_idempotency_record(key) is not None for key in keys] == [False] * 3 + [True] * 3
+    assert store.get_idempotency_record(pending) is not None
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import warnings
+
+from conftest import BACKEND_DIR
+import db
+import ledger
+from ledger import UsageLedger
+
+CREATE_USERS = """
+import os, db
+from models import User
+db.store.save_user(User(id="journal-user", name="Journaled", email="j@example.com", customer_type="B2C"))
+db.store.save_user(User(id="deleted-user", name="Deleted", email="d@example.com", customer_type="B2C"))
+db.store.delete_user("deleted-user")
+db._journal.sync()
+os._exit(0)  # die without compacting, as a crash would
+"""
+
+READ_USERS = """
+import db
+print(db.store.get_user("journal-user") is not None, db.store.get_user("deleted-user") is not None)
+"""
+
+BACKGROUND_LOAD = """
+import gc, db
+db._load_data()
+print(len(db.MEMBERSHIP_TEMPLATES) > 0, gc.isenabled(), gc.get_freeze_count())
+"""
+
+
+def run(data_dir, code, **env):
+    env = dict(os.environ, DATA_DIR=str(data_dir), PERSISTENCE_MODE="journal", PYTHONPATH=BACKEND_DIR, **env)
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=data_dir, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_journal_replays_after_a_crash(tmp_path):
+    shutil.copy(os.path.join(BACKEND_DIR, "data.json"), tmp_path)
+    run(tmp_path, CREATE_USERS)
+    assert "journal-user" not in (tmp_path / "data.json").read_text()
+    assert (tmp_path / "data.journal").exists()
+    # A torn final record from the crash is ignored
+    with open(tmp_path / "data.journal", "a") as f:
+        f.write('{"c":"users","k":"torn')
+
+    assert run(tmp_path, READ_USERS).splitlines()[-1] == "True False"
+    # The replay was folded into the snapshot
+    assert "journal-user" in (tmp_path / "data.json").read_text()
+
+
+def test_background_load_falls_back_to_seed_data_on_a_corrupt_file(tmp_path):
+    (tmp_path / "data.json").write_bytes(b'{"users": {"\xff": {}}}')
+    loaded = run(tmp_path, BACKGROUND_LOAD, LOAD_MODE="background")
+    # Seed templates, and the collector was neither paused nor frozen while serving
+    assert "initializing with seed data" in loaded
+    assert loaded.splitlines()[-1].split() == ["True", "True", "0"]
+
+
+def test_ledger_replays_to_a_point_in_time(tmp_path, monkeypatch):
+    # Small segments and checkpoints, so replays cross both
+    monkeypatch.setattr(ledger, "LEDGER_SEGMENT_EVENTS", 5)
+    monkeypatch.setattr(ledger, "LEDGER_CHECKPOINT_EVENTS", 4)
+    usage_ledger = UsageLedger(str(tmp_path))
+    usage_ledger.open(lambda: [("m-1", 2, 1)])
+    for _ in range(7):
+        usage_ledger.record("m-1", "conversation")
+    usage_ledger.record("m-2", "analysis", 3)
+    time.sleep(0.05)
+    middle = time.time()
+    time.sleep(0.05)
+    for _ in range(6):
+        usage_ledger.record("m-1", "analysis")
+    usage_ledger.record("m-2", "analysis", -1)
+    time.sleep(0.05)  # let background checkpoints land
+    usage_ledger.close()
+
+    reopened = UsageLedger(str(tmp_path))
+    assert reopened.usage_at("m-1", middle)["conversation"] == 9
+    assert reopened.usage_at("m-1", middle)["analysis"] == 1
+    assert reopened.usage_at("m-1")["analysis"] == 7
+    assert reopened.totals_at(middle) == {"m-1": (9, 1), "m-2": (0, 3)}
+    assert reopened.totals_at() == {"m-1": (9, 7), "m-2": (0, 2)}
+    assert reopened.usage_at("unknown") is None
+    assert [event["delta"] for event in reopened.events(middle, None, "m-2")] == [-1]
+
+
+def test_pooled_usage_is_kept_apart_from_the_seat(tmp_path):
+    usage_ledger = UsageLedger(str(tmp_path))
+    usage_ledger.open(lambda: [])
+    usage_ledger.record("m-1", "conversation")
+    usage_ledger.record(ledger.POOLED_PREFIX + "m-1", "conversation", 2)
+    usage_ledger.close()
+
+    reopened = UsageLedger(str(tmp_path))
+    assert reopened.usage_at("m-1")["conversation"] == 1
+    assert reopened.usage_at(ledger.POOLED_PREFIX + "m-1")["conversation"] == 2
+    events = [(event["membership_id"], event["delta"], event["pooled"]) for event in reopened.events(0, None, "m-1")]
+    assert events == [("m-1", 1, False), ("m-1", 2, True)]
+
+
+def test_snapshot_dumps_entries_like_the_journal(client):
+    user = next(iter(db.USERS.values()))
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        snapshot = db._snapshot_dict()
+
+    assert snapshot["users"][user.id] == user.model_dump(mode="json")
+    json.dumps(snapshot)
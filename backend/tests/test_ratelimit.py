@@ -0,0 +1,63 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import ratelimit
+from ratelimit import RateLimiter, RateLimitMiddleware, SharedMemoryRateLimitStore, SQLiteRateLimitStore, parse_policies
+
+
+def limited_client(store) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/limited")
+    def limited():
+        return {}
+
+    limiter = RateLimiter(parse_policies("/limited=ip:2/60"), store)
+    return TestClient(RateLimitMiddleware(app, limiter))
+
+
+@pytest.mark.parametrize("make_store", [
+    lambda tmp_path: SQLiteRateLimitStore(str(tmp_path / "limits.sqlite3")),
+    lambda tmp_path: SharedMemoryRateLimitStore(str(tmp_path / "limits.shm"), slots=64),
+])
+def test_shared_stores_limit_requests(tmp_path, make_store):
+    client = limited_client(make_store(tmp_path))
+
+    statuses = [client.get("/limited").status_code for _ in range(3)]
+
+    assert statuses == [200, 200, 429]
+
+
+def test_client_set_headers_do_not_change_the_caller(tmp_path):
+    client = limited_client(SQLiteRateLimitStore(str(tmp_path / "limits.sqlite3")))
+
+    statuses = [
+        client.get("/limited", headers={"X-User-Id": f"user-{i}", "X-Forwarded-For": f"10.0.0.{i}"}).status_code
+        for i in range(3)
+    ]
+
+    assert statuses == [200, 200, 429]
+
+
+def test_trusted_proxy_address_is_read_from_the_right(monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUSTED_PROXIES", 1)
+    scope = {"headers": [(b"x-forwarded-for", b"6.6.6.6, 203.0.113.7")], "client": ("10.0.0.1", 1234)}
+
+    assert ratelimit._identity(scope, parse_policies("/=ip:1/1")[0]) == "ip:203.0.113.7"
+
+
+def test_user_policies_trust_only_the_configured_header(monkeypatch):
+    policy = parse_policies("/api/v1/usage/=user:120/60")[0]
+    scope = {"headers": [(b"x-user-id", b"user-1")], "client": ("10.0.0.1", 1234)}
+    assert ratelimit._identity(scope, policy) == "ip:10.0.0.1"
+
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_USER_HEADER", b"x-user-id")
+    assert ratelimit._identity(scope, policy) == "user:user-1"
+    assert ratelimit._identity({"headers": [], "client": ("10.0.0.1", 1234)}, policy) == "ip:10.0.0.1"
+    assert ratelimit._identity(scope, parse_policies("/=ip:1/1")[0]) == "ip:10.0.0.1"
+
+
+def test_only_sqlite_updates_leave_the_event_loop(tmp_path):
+    assert SQLiteRateLimitStore(str(tmp_path / "limits.sqlite3")).blocking
+    assert not SharedMemoryRateLimitStore(str(tmp_path / "limits.shm"), slots=64).blocking
@@ -0,0 +1,36 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import BACKEND_DIR
+from models import CustomerType, User
+from storage import SQLiteStore
+
+
+def test_sqlite_store_keeps_data_across_reopening(tmp_path):
+    path = str(tmp_path / "data.sqlite3")
+    store = SQLiteStore(path)
+    assert store.is_empty()
+    store.save_user(User(id="user-a", name="A", email="a@example.com", customer_type=CustomerType.B2B, company_id="acme"))
+
+    reopened = SQLiteStore(path)
+
+    assert not reopened.is_empty()
+    assert reopened.get_user("user-a").company_id == "acme"
+    assert [user.id for user in reopened.users_for_company("acme")] == ["user-a"]
+
+
+def test_first_sqlite_start_imports_data_json(tmp_path):
+    shutil.copy(os.path.join(BACKEND_DIR, "data.json"), tmp_path)
+    with open(tmp_path / "data.json") as f:
+        expected = len(json.load(f)["memberships"])
+    env = dict(os.environ, DATA_DIR=str(tmp_path), STORAGE_BACKEND="sqlite", PYTHONPATH=BACKEND_DIR)
+    code = "import db; print(sum(1 for _ in db.store.iter_memberships()), len(db.MEMBERSHIPS))"
+
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=tmp_path, capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    # Imported into SQLite, and no longer held in the JSON store's dicts
+    assert result.stdout.splitlines()[-1].split() == [str(expected), "0"]
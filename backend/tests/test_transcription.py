@@ -0,0 +1,48 @@
+import math
+from array import array
+
+import pytest
+
+import transcription
+from transcription import TranscriptionJob, VoiceActivitySegmenter
+
+
+def speech(seconds: float, rate: int = 16000) -> bytes:
+    return array("h", (int(3000 * math.sin(i / 5)) for i in range(int(seconds * rate)))).tobytes()
+
+
+def silence(seconds: float, rate: int = 16000) -> bytes:
+    return bytes(2 * int(seconds * rate))
+
+
+AUDIO = speech(0.5) + silence(1) + speech(0.6) + silence(0.2)
+
+
+def segments(audio: bytes, chunk: int = 4000) -> list:
+    segmenter = VoiceActivitySegmenter(16000)
+    found = []
+    for offset in range(0, len(audio), chunk):
+        found += segmenter.feed(audio[offset:offset + chunk])
+    return found + [segmenter.flush()]
+
+
+@pytest.mark.skipif(transcription.np is None, reason="NumPy is not installed")
+def test_numpy_and_python_energies_agree(monkeypatch):
+    vectorized = segments(AUDIO)
+    monkeypatch.setattr(transcription, "np", None)
+
+    assert segments(AUDIO) == vectorized
+    assert len(vectorized) == 2 and vectorized[0][0] == 0
+
+
+def test_upload_is_segmented_and_the_job_closed(client, monkeypatch):
+    closed = []
+    close = TranscriptionJob.close
+    monkeypatch.setattr(TranscriptionJob, "close", lambda job: closed.append(job) or close(job))
+
+    response = client.post("/api/v1/transcribe", content=AUDIO, headers={"Content-Type": "audio/pcm"})
+
+    assert response.status_code == 200
+    assert len(response.json()["segments"]) == 2
+    assert response.json()["text"]
+    assert closed and closed[0]._spool.closed
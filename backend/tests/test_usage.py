@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from models import CustomerType
+
+
+def test_concurrent_spends_never_exceed_the_limit(client, store, make_user, assign):
+    user = make_user()
+    membership = assign(user.id)  # basic-b2c: 10 conversations
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        spent = list(pool.map(lambda _: store.consume_usage(user.id, "conversation"), range(40)))
+
+    assert sum(result is not None for result in spent) == 10
+    assert store.get_membership(membership["id"]).usage.conversation == 10
+
+
+def test_concurrent_requests_never_exceed_the_limit(client, store, make_user, assign):
+    user = make_user()
+    membership = assign(user.id)  # basic-b2c: 3 analyses
+
+    def update(_):
+        return client.post("/api/v1/usage/update", json={"user_id": user.id, "feature_type": "analysis"}).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(update, range(12)))
+
+    assert statuses.count(200) == 3
+    assert statuses.count(400) == 9
+    assert store.get_membership(membership["id"]).usage.analysis == 3
+
+
+def test_batch_applies_until_the_limit(client, store, make_user, assign):
+    user = make_user()
+    membership = assign(user.id)
+    updates = [{"user_id": user.id, "feature_type": "analysis"}] * 5 + [{"user_id": "missing", "feature_type": "analysis"}]
+
+    response = client.post("/api/v1/usage/batch", json={"updates": updates})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["applied"], body["rejected"]) == (3, 3)
+    assert body["results"][-1]["reason"] == "User not found"
+    assert store.get_membership(membership["id"]).usage.analysis == 3
+
+
+def test_company_pool_and_allocations(client, store, make_user, assign):
+    company_id = f"company-{uuid4()}"
+    capped, other = make_user(CustomerType.B2B, company_id), make_user(CustomerType.B2B, company_id)
+    seats = [assign(user.id, "basic-b2b") for user in (capped, other)]
+    client.put(f"/api/v1/admin/companies/{company_id}/quota", json={"limits": {"conversation": 3, "analysis": None}})
+    client.put(
+        f"/api/v1/admin/companies/{company_id}/quota/allocations/{capped.id}",
+        json={"limits": {"conversation": 1, "analysis": None}}
+    )
+
+    def start(user):
+        return client.post("/api/v1/usage/start-conversation", json={"user_id": user.id, "feature_type": "conversation"})
+
+    assert start(capped).status_code == 200
+    assert start(capped).status_code == 400  # over the allocation
+    assert [start(other).status_code for _ in range(3)] == [200, 200, 400]  # pool used up
+
+    quota = client.get(f"/api/v1/admin/companies/{company_id}/quota").json()
+    assert quota["quota"]["usage"]["conversation"] == 3
+    # The pool meters usage, not the seats
+    assert [store.get_membership(seat["id"]).usage.conversation for seat in seats] == [0, 0]
+
+
+def test_batch_and_coupons_draw_on_the_company_pool(client, store, make_user, assign):
+    company_id = f"company-{uuid4()}"
+    user = make_user(CustomerType.B2B, company_id)
+    seat = assign(user.id, "basic-b2b")
+    client.put(f"/api/v1/admin/companies/{company_id}/quota", json={"limits": {"conversation": 10, "analysis": None}})
+    client.put(
+        f"/api/v1/admin/companies/{company_id}/quota/allocations/{user.id}",
+        json={"limits": {"conversation": 3, "analysis": None}}
+    )
+
+    batch = client.post(
+        "/api/v1/usage/batch", json={"updates": [{"user_id": user.id, "feature_type": "conversation"}] * 2}
+    ).json()
+    assert batch["applied"] == 2
+    assert [item["current_usage"]["conversation"] for item in batch["results"]] == [1, 2]
+
+    assert client.post(f"/api/v1/memberships/{seat['id']}/deduct-coupon").status_code == 200
+    # The allocation caps the user at 3, whichever route they come through
+    assert client.post(f"/api/v1/memberships/{seat['id']}/deduct-coupon").status_code == 400
+    batch = client.post("/api/v1/usage/batch", json={"updates": [{"user_id": user.id, "feature_type": "conversation"}]})
+    assert batch.json()["results"][0]["reason"] == "Company quota for this feature is used up"
+
+    quota = client.get(f"/api/v1/admin/companies/{company_id}/quota").json()
+    assert quota["quota"]["usage"]["conversation"] == 3
+    assert store.get_membership(seat["id"]).usage.conversation == 0
+
+    history = client.get(f"/api/v1/admin/memberships/{seat['id']}/usage-history").json()
+    assert (history["pooled"]["conversation"], history["pooled"]["analysis"]) == (3, 0)
+    assert history["replayed"] is None
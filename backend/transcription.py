@@ -0,0 +1,274 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import struct
+import tempfile
+import time
+from array import array
+from typing import AsyncIterator, List, Optional, Tuple
+from metrics import observe
+from providers import Transcriber
+from response_cache import cache_key, transcript_cache
+
+try:
+    import numpy as np
+except ImportError:  # in requirements.txt; without it frame energies are computed in pure Python
+    np = None
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIBE_SAMPLE_RATE = int(os.getenv("TRANSCRIBE_SAMPLE_RATE", "16000"))
+TRANSCRIBE_MAX_BYTES = int(os.getenv("TRANSCRIBE_MAX_BYTES", str(25 * 1024 * 1024)))
+# Segments of one recording transcribed at the same time
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "4"))
+# Where uploads are spooled while they arrive (empty: the system temp directory)
+TRANSCRIBE_SPOOL_DIR = os.getenv("TRANSCRIBE_SPOOL_DIR", "") or None
+
+# Voice activity detection on 16-bit mono PCM: a frame is speech when its RMS energy
+# reaches the threshold; this much silence after speech ends a segment
+VAD_FRAME_MS = 30
+VAD_ENERGY_THRESHOLD = float(os.getenv("VAD_ENERGY_THRESHOLD", "500"))
+VAD_SILENCE_MS = int(os.getenv("VAD_SILENCE_MS", "500"))
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "150"))
+VAD_MAX_SEGMENT_SECONDS = float(os.getenv("VAD_MAX_SEGMENT_SECONDS", "15"))
+VAD_PADDING_MS = 150
+
+PCM_TYPES = ("audio/pcm", "audio/l16", "application/octet-stream")
+WAV_TYPES = ("audio/wav", "audio/x-wav", "audio/wave")
+
+_sumprod = getattr(math, "sumprod", None)  # Python 3.12+
+
+
+class AudioTooLarge(Exception):
+    pass
+
+
+def _frame_energy(frame: bytes) -> float:
+    samples = array("h", frame)
+    squares = _sumprod(samples, samples) if _sumprod else sum(s * s for s in samples)
+    return math.sqrt(squares / len(samples))
+
+
+def _frame_energies(data: bytes, frame_bytes: int) -> List[float]:
+    """RMS energy of each whole frame in data, all frames in one pass with NumPy"""
+    if np is None:
+        return [_frame_energy(data[offset:offset + frame_bytes]) for offset in range(0, len(data), frame_bytes)]
+    samples = np.frombuffer(data, dtype=np.int16).astype(np.float64).reshape(-1, frame_bytes // 2)
+    return np.sqrt(np.square(samples).mean(axis=1)).tolist()
+
+
+def wav_header(pcm_size: int, sample_rate: int) -> bytes:
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + pcm_size, b"WAVE", b"fmt ", 16, 1, 1,
+        sample_rate, sample_rate * 2, 2, 16, b"data", pcm_size
+    )
+
+
+class VoiceActivitySegmenter:
+    """Splits a PCM stream into speech segments as it arrives, in byte offsets of the stream"""
+
+    def __init__(self, sample_rate: int):
+        self.frame_bytes = sample_rate * VAD_FRAME_MS // 1000 * 2
+        self.bytes_per_ms = sample_rate * 2 / 1000
+        self.silence_frames = math.ceil(VAD_SILENCE_MS / VAD_FRAME_MS)
+        self.min_speech_frames = math.ceil(VAD_MIN_SPEECH_MS / VAD_FRAME_MS)
+        self.max_segment_bytes = int(VAD_MAX_SEGMENT_SECONDS * 1000 * self.bytes_per_ms)
+        self.padding = int(VAD_PADDING_MS * self.bytes_per_ms) // 2 * 2
+        self._pending = b""
+        self._position = 0           # bytes of the stream looked at so far
+        self._previous_end = 0       # segments never overlap
+        self._start: Optional[int] = None
+        self._last_voice_end = 0
+        self._speech_frames = 0
+        self._quiet_frames = 0
+
+    def feed(self, data: bytes) -> List[Tuple[int, int]]:
+        """Segments completed by this chunk of audio"""
+        data = self._pending + data
+        usable = len(data) - len(data) % self.frame_bytes
+        self._pending = data[usable:]
+        segments = []
+        for energy in _frame_energies(data[:usable], self.frame_bytes):
+            segment = self._frame(energy)
+            if segment is not None:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> Optional[Tuple[int, int]]:
+        """The segment still open when the stream ends"""
+        self._position += len(self._pending)
+        self._pending = b""
+        return self._close(self._position)
+
+    def _frame(self, energy: float) -> Optional[Tuple[int, int]]:
+        frame_start = self._position
+        self._position += self.frame_bytes
+        if energy >= VAD_ENERGY_THRESHOLD:
+            if self._start is None:
+                self._start = max(self._previous_end, frame_start - self.padding)
+                self._speech_frames = 0
+            self._speech_frames += 1
+            self._quiet_frames = 0
+            self._last_voice_end = self._position
+            if self._position - self._start >= self.max_segment_bytes:
+                return self._close(self._position)
+        elif self._start is not None:
+            self._quiet_frames += 1
+            if self._quiet_frames >= self.silence_frames:
+                return self._close(min(self._position, self._last_voice_end + self.padding))
+        return None
+
+    def _close(self, end: int) -> Optional[Tuple[int, int]]:
+        start, self._start = self._start, None
+        if start is None:
+            return None
+        self._previous_end = end
+        if self._speech_frames < self.min_speech_frames:
+            return None  # a click or a breath, not speech
+        return start, end
+
+
+class TranscriptionJob:
+    """One recording: spooled to a temp file as it arrives, transcribed segment by segment.
+
+    Segments found by voice activity detection are transcribed while the rest of the
+    audio is still arriving, so once the upload ends only the last segment is left.
+    Formats other than PCM/WAV can't be segmented without a decoder and are
+    transcribed whole.
+    """
+
+    def __init__(self, transcriber: Transcriber, media_type: str, sample_rate: int = TRANSCRIBE_SAMPLE_RATE):
+        self.transcriber = transcriber
+        media_type = media_type.split(";")[0].strip().lower()
+        self.media_type = media_type or "application/octet-stream"
+        self.sample_rate = sample_rate
+        self.segmenter: Optional[VoiceActivitySegmenter] = None
+        self._header: Optional[bytearray] = bytearray() if media_type in WAV_TYPES else None
+        self._pcm_offset = 0
+        if media_type in PCM_TYPES:
+            self.segmenter = VoiceActivitySegmenter(sample_rate)
+        self.received = 0
+        self._spool = tempfile.TemporaryFile(dir=TRANSCRIBE_SPOOL_DIR)
+        self._semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+        self._results: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._finished_at: Optional[float] = None
+
+    async def feed(self, chunk: bytes):
+        if self.received + len(chunk) > TRANSCRIBE_MAX_BYTES:
+            raise AudioTooLarge()
+        self.received += len(chunk)
+        # The spool write and voice detection run off the event loop; feeds are awaited
+        # one at a time, so only one thread touches the spool and segmenter at once
+        for start, end in await asyncio.to_thread(self._ingest, chunk):
+            self._schedule(start, end)
+
+    def _ingest(self, chunk: bytes) -> List[Tuple[int, int]]:
+        """Spool a chunk and return the segments it completed"""
+        self._spool.write(chunk)
+        # Make the bytes visible to the segments' os.pread
+        self._spool.flush()
+        if self._header is not None:
+            chunk = self._read_wav_header(chunk)
+        if self.segmenter is not None and chunk:
+            return self.segmenter.feed(chunk)
+        return []
+
+    def finish(self):
+        """No more audio: transcribe the open segment (or, unsegmented, the whole clip)"""
+        self._finished_at = time.perf_counter()
+        if self.segmenter is not None:
+            segment = self.segmenter.flush()
+            if segment is not None:
+                self._schedule(*segment)
+        elif self.received:
+            self._schedule(0, self.received, whole=True)
+        self._results.put_nowait(None)
+
+    async def events(self) -> AsyncIterator[dict]:
+        """A `partial` per segment as each finishes, then `final` with the text in order"""
+        texts = {}
+        input_done = False
+        try:
+            while not input_done or len(texts) < len(self._tasks):
+                result = await self._results.get()
+                if result is None:
+                    input_done = True
+                    continue
+                if "detail" in result:
+                    yield {"type": "error", **result}
+                    return
+                texts[result["segment"]] = result["text"]
+                yield {"type": "partial", **result}
+            if self._finished_at is not None:
+                observe("transcribe_tail", time.perf_counter() - self._finished_at)
+            text = " ".join(texts[index] for index in sorted(texts) if texts[index])
+            yield {"type": "final", "text": text, "segments": len(texts)}
+        finally:
+            self.close()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._spool.close()
+
+    def _read_wav_header(self, chunk: bytes) -> bytes:
+        """Buffer the WAV header until the data chunk starts; return the PCM after it"""
+        self._header += chunk
+        position = 12
+        while position + 8 <= len(self._header):
+            chunk_id, size = struct.unpack_from("<4sI", self._header, position)
+            if chunk_id == b"fmt " and position + 24 <= len(self._header):
+                channels, sample_rate = struct.unpack_from("<HI", self._header, position + 10)
+                bits = struct.unpack_from("<H", self._header, position + 22)[0]
+                if channels == 1 and bits == 16:
+                    self.sample_rate = sample_rate
+                    self.segmenter = VoiceActivitySegmenter(sample_rate)
+            if chunk_id == b"data":
+                self._pcm_offset = position + 8
+                pcm = bytes(self._header[self._pcm_offset:])
+                self._header = None
+                return pcm
+            position += 8 + size + size % 2
+        if len(self._header) > 64 * 1024:
+            self._header = None  # not a WAV we understand: transcribe it whole
+        return b""
+
+    def _seconds(self, position: int) -> float:
+        return round(position / (self.sample_rate * 2), 3)
+
+    def _schedule(self, start: int, end: int, whole: bool = False):
+        index = len(self._tasks)
+        self._tasks.append(asyncio.create_task(self._transcribe(index, start, end, whole)))
+
+    async def _transcribe(self, index: int, start: int, end: int, whole: bool):
+        if whole:
+            offset, size, media_type = 0, end, self.media_type
+        else:
+            offset, size, media_type = self._pcm_offset + start, end - start, "audio/wav"
+        result = {"segment": index}
+        if not whole:
+            result.update(start=self._seconds(start), end=self._seconds(end))
+        try:
+            async with self._semaphore:
+                # Read back just this segment; the recording as a whole never sits in memory
+                audio = await asyncio.to_thread(os.pread, self._spool.fileno(), size, offset)
+                if not whole:
+                    audio = wav_header(len(audio), self.sample_rate) + audio
+                key = cache_key(
+                    "transcript", transcriber=self.transcriber.name, model=self.transcriber.model,
+                    audio=hashlib.sha256(audio).hexdigest()
+                )
+                text = transcript_cache.get(key)
+                if text is None:
+                    started = time.perf_counter()
+                    text = (await self.transcriber.transcribe(audio, media_type)).strip()
+                    observe("transcribe_segment", time.perf_counter() - started)
+                    transcript_cache.put(key, text, len(text.encode()) + len(key))
+            result["text"] = text
+        except Exception as exc:
+            logger.error("Transcriber %s failed on segment %d: %r", self.transcriber.name, index, exc)
+            result["detail"] = "Transcription failed"
+        await self._results.put(result)